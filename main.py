@@ -1,4 +1,5 @@
 import os
+import sys
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,13 +12,11 @@ REQUIRED_ENV = [
     "HOSTING_FTP_HOST",
     "HOSTING_FTP_USER",
     "HOSTING_FTP_PASS",
-    "DB_HOST",
-    "DB_PORT",
-    "DB_NAME",
-    "DB_USER",
-    "DB_PASS",
     "GOOGLE_SHEETS_URL",  # ✅ НОВОЕ: URL для получения товаров
 ]
+# Параметры MySQL нужны только для MySQL-бэкенда (SQLite — локальные запуски и бенчмарки)
+if os.getenv("DB_BACKEND", "mysql").lower() == "mysql":
+    REQUIRED_ENV += ["DB_HOST", "DB_PORT", "DB_NAME", "DB_USER", "DB_PASS"]
 for key in REQUIRED_ENV:
     if not os.getenv(key):
         raise RuntimeError(f"❌ Переменная окружения {key} не найдена (.env)")
@@ -28,24 +27,36 @@ import asyncio
 import io
 import pymysql
 from pymysql.cursors import DictCursor
+import sqlite3
 import csv
+import gzip
+import zlib
+import tempfile
 import re
+import hashlib
+import random
+from bisect import bisect_left
+import time
+import threading
+import functools
 from datetime import datetime, timedelta
+from decimal import Decimal
 from ftplib import FTP
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import contextmanager
 from typing import Optional, Dict, Any, List
 from urllib.request import urlopen
+from urllib.parse import urlsplit
 from urllib.error import URLError, HTTPError
 import aiohttp  # ✅ НОВОЕ: для асинхронных запросов к Google Sheets
+from aiohttp import web
 from concurrent.futures import ThreadPoolExecutor
-
-# Создаем пул потоков для параллельной загрузки изображений
-image_download_executor = ThreadPoolExecutor(max_workers=10)
+from dataclasses import dataclass, field
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.types import (
+    FSInputFile,
     Message,
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -57,6 +68,9 @@ from aiogram.types import (
     InlineKeyboardButton,
     CallbackQuery,
     TelegramObject,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 from aiogram.fsm.state import StatesGroup, State
@@ -77,11 +91,141 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from PIL import Image
 
+# ==================== HTTP КЛИЕНТ ====================
+#
+# Все исходящие HTTP-запросы (Google Sheets, проверка дилера, картинки товаров)
+# идут через одну aiohttp-сессию: соединения и TLS переиспользуются (keep-alive),
+# DNS кешируется, число соединений к одному хосту ограничено.
+
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # сек
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))  # сек
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))  # сек
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))  # повторов после первой попытки
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))  # сек, удваивается
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass(slots=True)
+class HttpResponse:
+    """Ответ, прочитанный целиком (соединение уже вернулось в пул)"""
+    status: int
+    headers: Any
+    body: bytes
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError(f"HTTP {self.status}")
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+@dataclass(slots=True)
+class HostStats:
+    requests: int = 0
+    errors: int = 0
+    retries: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+
+class HttpClient:
+    """Общий HTTP-клиент с пулом соединений, таймаутами и повторами GET-запросов"""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.hosts: Dict[str, HostStats] = defaultdict(HostStats)
+
+    async def start(self):
+        if self._session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30, connect=HTTP_CONNECT_TIMEOUT),
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, url: str, *, timeout: float, params: Dict[str, Any] = None,
+                  headers: Dict[str, str] = None, retries: int = HTTP_RETRIES) -> HttpResponse:
+        """GET с повтором при сетевых ошибках и ответах 429/5xx (пауза растёт вдвое)"""
+        if self._session is None:
+            await self.start()
+
+        stats = self.hosts[urlsplit(url).hostname or "unknown"]
+        request_timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, HTTP_CONNECT_TIMEOUT))
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async with self._session.get(url, params=params, headers=headers, timeout=request_timeout) as response:
+                    result = HttpResponse(response.status, response.headers, await response.read())
+                error = f"HTTP {result.status}" if result.status >= 400 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result, error = None, e
+
+            elapsed_ms = (time.monotonic() - started) * 1000
+            stats.requests += 1
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            if error is not None:
+                stats.errors += 1
+
+            retryable = result is None or result.status in HTTP_RETRY_STATUSES
+            if error is None or not retryable or attempt >= retries:
+                if result is None:
+                    raise error
+                return result
+
+            attempt += 1
+            stats.retries += 1
+            await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def get_metrics(self) -> Dict[str, Dict[str, float]]:
+        return {
+            host: {
+                "requests": stats.requests,
+                "errors": stats.errors,
+                "retries": stats.retries,
+                "total_ms": stats.total_ms,
+                "max_ms": stats.max_ms,
+            }
+            for host, stats in self.hosts.items()
+        }
+
+
+http_client = HttpClient()
+
+
 # ==================== GOOGLE SHEETS INTEGRATION ====================
 GOOGLE_SHEETS_URL = os.getenv("GOOGLE_SHEETS_URL")
-products_cache = {}  # Кеш товаров
-cache_timestamp = None
-CACHE_LIFETIME = 3600  # 5 минут
+CATALOG_FETCH_TIMEOUT = int(os.getenv("CATALOG_FETCH_TIMEOUT", "10"))  # сек
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", "600"))  # сек
+CATALOG_REFRESH_JITTER = float(os.getenv("CATALOG_REFRESH_JITTER", "0.1"))  # ± доля интервала
+CATALOG_MAX_STALENESS = int(os.getenv("CATALOG_MAX_STALENESS", "86400"))  # сек; 0 — без ограничения
+# После ошибки загрузки повторяем не раньше, чем через паузу; она удваивается до максимума
+CATALOG_FAILURE_BACKOFF = float(os.getenv("CATALOG_FAILURE_BACKOFF", "5"))  # сек
+CATALOG_FAILURE_BACKOFF_MAX = float(os.getenv("CATALOG_FAILURE_BACKOFF_MAX", "300"))  # сек
+# Последний удачный каталог на диске: с него бот стартует, пока Google Sheets не ответит
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.json")
+CATALOG_SNAPSHOT_FORMAT = 2  # 2: у товаров есть category из таблицы
+# Сколько последних версий каталога держать в памяти: заказ подписывается
+# по ценам версии, с которой строился предпросмотр
+CATALOG_VERSIONS_KEEP = int(os.getenv("CATALOG_VERSIONS_KEEP", "5"))
+# Деградированный режим: если Sheets недоступен дольше CATALOG_MAX_STALENESS,
+# продолжаем отдавать последний удачный каталог (0 — не отдавать, заказы не принимаются)
+CATALOG_DEGRADED_MODE = os.getenv("CATALOG_DEGRADED_MODE", "1") != "0"
 
 # Кеш изображений товаров
 image_cache = {}  # {url: PIL.Image}
@@ -89,37 +233,459 @@ image_cache_timestamp = {}  # {url: datetime}
 IMAGE_CACHE_LIFETIME = 3600  # 1 час
 
 
-async def fetch_products_from_sheets():
-    """Асинхронная загрузка товаров из Google Sheets"""
-    global products_cache, cache_timestamp
-    
-    # Проверяем кеш
-    if cache_timestamp and (datetime.now() - cache_timestamp).total_seconds() < CACHE_LIFETIME:
-        return products_cache
-    
+def _atomic_write(path: str, data: bytes):
+    """Атомарная запись файла: временный файл + rename в том же каталоге"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(GOOGLE_SHEETS_URL, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Преобразуем в словарь {id: product}
-                    products_cache = {}
-                    for category_products in data.values():
-                        for product in category_products:
-                            product_id = int(product.get('id', 0))
-                            if product_id:
-                                products_cache[product_id] = product
-                    
-                    cache_timestamp = datetime.now()
-                    logger.info(f"✅ Loaded {len(products_cache)} products from Google Sheets")
-                    return products_cache
-                else:
-                    logger.error(f"❌ Failed to fetch products: HTTP {response.status}")
-                    return products_cache
-    except Exception as e:
-        logger.exception(f"❌ Error fetching products from Google Sheets: {e}")
-        return products_cache
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+async def _load_products_from_sheets(validators: Dict[str, str]) -> tuple:
+    """Загрузка каталога из Google Sheets; ошибки пробрасываются.
+
+    validators — etag / last_modified / content_hash прошлой загрузки.
+    Возвращает (products, validators); products = None, если каталог
+    не изменился (304 или тот же хэш содержимого) — тогда JSON не разбирается.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = await http_client.get(GOOGLE_SHEETS_URL, headers=headers, timeout=CATALOG_FETCH_TIMEOUT)
+    if response.status == 304:
+        return None, validators
+    if response.status != 200:
+        raise RuntimeError(f"HTTP {response.status}")
+    body = response.body
+    new_validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_hash": hashlib.sha256(body).hexdigest(),
+    }
+
+    if new_validators["content_hash"] == validators.get("content_hash"):
+        return None, new_validators
+
+    return _parse_sheet_products(json.loads(body)), new_validators
+
+
+def _parse_sheet_products(data: Dict[str, List[Dict]]) -> Dict[int, Dict]:
+    """Ответ таблицы {категория: [товары]} -> {id: product}; категория листа сохраняется в товаре"""
+    products = {}
+    for category, category_products in data.items():
+        for product in category_products:
+            product_id = int(product.get('id', 0))
+            if product_id:
+                product.setdefault("category", category)
+                products[product_id] = product
+    return products
+
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _name_tokens(text: str) -> List[str]:
+    """Нормализованные слова названия: нижний регистр, ё -> е"""
+    return _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+class CatalogIndex:
+    """Вторичные индексы версии каталога; строятся один раз при загрузке.
+
+    by_category — ID товаров по категории из таблицы; tokens/postings —
+    инвертированный индекс слов названия (и ID) с поиском по префиксу
+    через bisect; sorted_ids — для выборок по диапазону ID.
+    """
+
+    __slots__ = ("by_category", "category_by_id", "sorted_ids", "tokens", "postings")
+
+    def __init__(self, products: Dict[int, Dict]):
+        by_category = defaultdict(list)
+        postings = defaultdict(set)
+        self.category_by_id: Dict[int, str] = {}
+        for product_id, product in products.items():
+            category = product.get("category")
+            if category:
+                by_category[category].append(product_id)
+                self.category_by_id[product_id] = category
+            for token in _name_tokens(str(product.get("name", ""))):
+                postings[token].add(product_id)
+            postings[str(product_id)].add(product_id)
+
+        self.by_category: Dict[str, List[int]] = {c: sorted(ids) for c, ids in by_category.items()}
+        self.sorted_ids: List[int] = sorted(products)
+        self.tokens: List[str] = sorted(postings)
+        self.postings: Dict[str, set] = dict(postings)
+
+    def _prefix_ids(self, prefix: str) -> set:
+        ids = set()
+        position = bisect_left(self.tokens, prefix)
+        while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+            ids |= self.postings[self.tokens[position]]
+            position += 1
+        return ids
+
+    def search(self, query: str, limit: int = 20) -> List[int]:
+        """ID товаров, в названии которых есть слова, начинающиеся с каждого слова запроса"""
+        terms = set(_name_tokens(query))
+        if not terms:
+            return []
+        result = None
+        # Длинные префиксы избирательнее — с них пересечение быстрее сужается
+        for term in sorted(terms, key=len, reverse=True):
+            ids = self._prefix_ids(term)
+            result = ids if result is None else result & ids
+            if not result:
+                return []
+        return sorted(result)[:limit]
+
+    def ids_in_range(self, start: int, end: int) -> List[int]:
+        """ID в полуинтервале [start, end)"""
+        return self.sorted_ids[bisect_left(self.sorted_ids, start):bisect_left(self.sorted_ids, end)]
+
+
+@dataclass(slots=True)
+class CatalogVersion:
+    """Неизменяемый снимок каталога; version — начало SHA-256 содержимого таблицы"""
+    version: str
+    products: Dict[int, Dict]
+    loaded_at: datetime
+    index: CatalogIndex
+
+
+def _catalog_version(products: Dict[int, Dict], validators: Dict[str, str]) -> str:
+    content_hash = validators.get("content_hash") or hashlib.sha256(
+        json.dumps(products, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    return content_hash[:12]
+
+
+def _product_price(product: Dict) -> int:
+    return int(product.get("price", 0))
+
+
+def diff_catalog_versions(old: CatalogVersion, new: CatalogVersion) -> Dict[str, list]:
+    """Разница версий: добавленные и удалённые ID, изменения цен [(id, было, стало)]"""
+    old_ids = old.products.keys()
+    new_ids = new.products.keys()
+    price_changes = []
+    for product_id in sorted(old_ids & new_ids):
+        old_product = old.products[product_id]
+        new_product = new.products[product_id]
+        if old_product is new_product:
+            continue
+        old_price, new_price = _product_price(old_product), _product_price(new_product)
+        if old_price != new_price:
+            price_changes.append((product_id, old_price, new_price))
+    return {
+        "added": sorted(new_ids - old_ids),
+        "removed": sorted(old_ids - new_ids),
+        "price_changes": price_changes,
+    }
+
+
+def enrich_cart_items(products: Dict[int, Dict], cart_items: List[Dict]) -> tuple:
+    """[{id, qty}] -> (позиции заказа с данными товара, сумма) по снимку каталога.
+
+    KeyError(id), если товара нет в каталоге.
+    """
+    items = []
+    total = 0
+    for cart_item in cart_items:
+        product_id = cart_item["id"]
+        qty = cart_item["qty"]
+        product = products.get(product_id)
+        if not product:
+            raise KeyError(product_id)
+        item = {
+            "id": product_id,
+            "name": product.get("name", "Без названия"),
+            "price": _product_price(product),
+            "qty": qty,
+            "image": product.get("image", ""),
+            "category": product.get("category", "unknown"),
+            "weight": float(product.get("weight", 0)),
+            "cube": float(product.get("cube", 0))
+        }
+        items.append(item)
+        total += item["price"] * qty
+    return items, total
+
+
+def _save_catalog_snapshot(path: str, products: Dict[int, Dict], validators: Dict[str, str]):
+    payload = {
+        "format": CATALOG_SNAPSHOT_FORMAT,
+        "saved_at": datetime.now().isoformat(),
+        "validators": validators,
+        "products": products,
+    }
+    _atomic_write(path, json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _read_catalog_snapshot(path: str) -> Optional[tuple]:
+    """(products, validators, возраст в секундах) или None, если снимка нет или он другого формата.
+
+    Возраст считается по mtime файла: при подтверждении «каталог не изменился»
+    файл не переписывается, а только «трогается».
+    """
+    try:
+        with open(path, "rb") as f:
+            payload = json.loads(f.read())
+        age = max(time.time() - os.path.getmtime(path), 0.0)
+    except FileNotFoundError:
+        return None
+    if payload.get("format") != CATALOG_SNAPSHOT_FORMAT:
+        return None
+    products = {int(product_id): product for product_id, product in payload["products"].items()}
+    return products, payload.get("validators") or {}, age
+
+
+class SingleFlight:
+    """Одновременные вызовы с одним ключом выполняются один раз, остальные ждут тот же результат"""
+
+    def __init__(self):
+        self._inflight: Dict[Any, asyncio.Task] = {}
+        self.shared = 0  # вызовов, присоединившихся к уже идущему
+
+    async def do(self, key: Any, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.shared += 1
+        # shield: отмена одного ожидающего не отменяет загрузку для остальных
+        return await asyncio.shield(task)
+
+
+class CatalogCache:
+    """Каталог товаров в памяти (stale-while-revalidate).
+
+    Запросы получают текущий снимок сразу, без обращения к Google Sheets;
+    обновляет его фоновая задача run_refresher. Снимок старше max_staleness
+    не отдаётся — тогда каталог загружается синхронно.
+
+    Одновременно идёт не больше одной загрузки (SingleFlight), а после
+    ошибки новые попытки откладываются с растущей паузой.
+
+    Каждый новый каталог сохраняется в snapshot_path; при старте бот
+    поднимается с этого снимка и обновляет его в фоне.
+
+    Загруженные версии (CatalogVersion) хранятся в кольцевом буфере
+    из versions_keep последних — по ним заказ подписывается по ценам предпросмотра.
+    """
+
+    def __init__(self, max_staleness: float, snapshot_path: str, degraded_mode: bool = True,
+                 versions_keep: int = 5):
+        self.max_staleness = max_staleness
+        self.versions: deque = deque(maxlen=max(versions_keep, 1))
+        self.snapshot_path = snapshot_path
+        self.degraded_mode = degraded_mode
+        self.validators: Dict[str, str] = {}
+        self.source = "none"  # откуда текущий снимок: none / snapshot / sheets
+        self.unchanged = 0
+        self.degraded_hits = 0
+        self._flight = SingleFlight()
+        self._backoff = 0.0
+        self._retry_at: Optional[float] = None  # time.monotonic(), раньше которого не загружаем
+        self.negative_hits = 0
+        self.products: Dict[int, Dict] = {}
+        self.loaded_at: Optional[float] = None  # time.monotonic() последней удачной загрузки
+        self.refreshes = 0
+        self.failures = 0
+        self.refresh_total_ms = 0.0
+        self.last_refresh_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def age(self) -> Optional[float]:
+        """Возраст снимка в секундах (None — каталог ещё не загружался)"""
+        return time.monotonic() - self.loaded_at if self.loaded_at is not None else None
+
+    def is_usable(self) -> bool:
+        age = self.age()
+        return age is not None and (not self.max_staleness or age <= self.max_staleness)
+
+    def in_backoff(self) -> bool:
+        return self._retry_at is not None and time.monotonic() < self._retry_at
+
+    @property
+    def version(self) -> Optional[CatalogVersion]:
+        return self.versions[-1] if self.versions else None
+
+    def get_version(self, version: str) -> Optional[CatalogVersion]:
+        """Версия из буфера по id (None — вытеснена или не загружалась)"""
+        for entry in reversed(self.versions):
+            if entry.version == version:
+                return entry
+        return None
+
+    def _install(self, products: Dict[int, Dict], validators: Dict[str, str]):
+        """Делает каталог текущим; новая версия добавляется в буфер"""
+        version = _catalog_version(products, validators)
+        previous = self.version
+        if previous and previous.version == version:
+            return
+        entry = CatalogVersion(version, products, datetime.now(), CatalogIndex(products))
+        self.versions.append(entry)
+        # Словарь заменяется целиком: читатели видят либо старый снимок, либо новый
+        self.products = products
+        if previous:
+            diff = diff_catalog_versions(previous, entry)
+            logger.info(
+                f"🔖 Catalog {previous.version} → {entry.version}: +{len(diff['added'])} "
+                f"-{len(diff['removed'])}, {len(diff['price_changes'])} price changes"
+            )
+
+    async def refresh(self) -> bool:
+        """Загружает каталог; при ошибке прежний снимок остаётся в работе.
+
+        Если загрузка уже идёт, ждёт её результат вместо новой.
+        """
+        if self.in_backoff():
+            self.negative_hits += 1
+            return False
+        return await self._flight.do(GOOGLE_SHEETS_URL, self._refresh)
+
+    def load_snapshot(self) -> bool:
+        """Поднимает каталог со снимка на диске (вызывается при старте, в потоке)"""
+        try:
+            snapshot = _read_catalog_snapshot(self.snapshot_path)
+        except Exception:
+            logger.exception(f"❌ Failed to read catalog snapshot {self.snapshot_path}")
+            return False
+        if not snapshot or not snapshot[0]:
+            return False
+
+        products, validators, age = snapshot
+        self._install(products, validators)
+        self.validators = validators
+        self.loaded_at = time.monotonic() - age
+        self.source = "snapshot"
+        logger.info(f"✅ Loaded {len(products)} products from snapshot ({age / 60:.0f} min old)")
+        return True
+
+    async def _refresh(self) -> bool:
+        started = time.monotonic()
+        try:
+            products, validators = await _load_products_from_sheets(self.validators)
+            if products is not None and not products:
+                raise RuntimeError("empty catalog")
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            self._backoff = min(self._backoff * 2 or CATALOG_FAILURE_BACKOFF, CATALOG_FAILURE_BACKOFF_MAX)
+            self._retry_at = time.monotonic() + self._backoff
+            logger.error(f"❌ Catalog refresh failed: {self.last_error}; next attempt in {self._backoff:.0f}s")
+            return False
+        finally:
+            self.last_refresh_ms = (time.monotonic() - started) * 1000
+            self.refresh_total_ms += self.last_refresh_ms
+
+        self.loaded_at = time.monotonic()
+        self.validators = validators
+        self.refreshes += 1
+        self.last_error = None
+        self._backoff = 0.0
+        self._retry_at = None
+
+        if products is None:
+            # Каталог не изменился — снимок на диске остаётся, отмечаем только время проверки
+            self.unchanged += 1
+            if self.products and os.path.exists(self.snapshot_path):
+                os.utime(self.snapshot_path)
+            return True
+
+        self._install(products, validators)
+        self.source = "sheets"
+        logger.info(f"✅ Loaded {len(products)} products from Google Sheets in {self.last_refresh_ms:.0f} ms")
+        try:
+            await asyncio.to_thread(_save_catalog_snapshot, self.snapshot_path, products, validators)
+        except Exception:
+            logger.exception(f"❌ Failed to save catalog snapshot {self.snapshot_path}")
+        return True
+
+    def is_degraded(self) -> bool:
+        """Каталог есть, но Google Sheets не отвечает"""
+        return bool(self.products) and self.last_error is not None
+
+    async def current(self) -> Optional[CatalogVersion]:
+        """Текущая версия каталога; None, если каталог недоступен"""
+        if not self.is_usable():
+            await self.refresh()
+            if not self.is_usable():
+                if self.degraded_mode and self.products:
+                    self.degraded_hits += 1
+                    return self.version
+                return None
+        return self.version
+
+    async def get(self) -> Dict[int, Dict]:
+        """Текущий снимок; пустой словарь, если каталог недоступен"""
+        version = await self.current()
+        return version.products if version else {}
+
+    async def run_refresher(self, interval: float, jitter: float, refresh_now: bool = False):
+        """Фоновое обновление; разброс интервала разводит запросы нескольких экземпляров бота.
+
+        refresh_now — первое обновление сразу (после старта со снимка).
+        """
+        while True:
+            delay = 0 if refresh_now else interval * random.uniform(1 - jitter, 1 + jitter)
+            refresh_now = False
+            if self._retry_at is not None:
+                # После ошибки пробуем снова по окончании паузы, не дожидаясь полного интервала
+                delay = min(delay, max(self._retry_at - time.monotonic(), 0))
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("❌ Catalog refresher iteration failed")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "products": len(self.products),
+            "age": self.age(),
+            "max_staleness": self.max_staleness,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "refresh_total_ms": self.refresh_total_ms,
+            "last_refresh_ms": self.last_refresh_ms,
+            "last_error": self.last_error,
+            "shared": self._flight.shared,
+            "negative_hits": self.negative_hits,
+            "backoff": self._backoff if self.in_backoff() else 0.0,
+            "source": self.source,
+            "version": self.version.version if self.version else None,
+            "versions": len(self.versions),
+            "unchanged": self.unchanged,
+            "degraded": self.is_degraded(),
+            "degraded_hits": self.degraded_hits,
+        }
+
+
+product_catalog = CatalogCache(
+    CATALOG_MAX_STALENESS, CATALOG_SNAPSHOT_PATH, CATALOG_DEGRADED_MODE, CATALOG_VERSIONS_KEEP
+)
+
+
+async def fetch_products_from_sheets() -> Dict[int, Dict]:
+    """Каталог товаров {id: product} из памяти (обновляется в фоне)"""
+    return await product_catalog.get()
 
 
 async def get_product_info(product_id: int) -> Optional[Dict]:
@@ -175,7 +741,7 @@ async def refresh_main_menu(user_id: int, state: FSMContext):
     data = await state.get_data()
     old_message_id = data.get("menu_message_id")
 
-    lang = get_user_lang(user_id)
+    lang = await run_db(get_user_lang, user_id)
     kb = get_main_menu_keyboard(user_id, lang)
 
     try:
@@ -305,30 +871,19 @@ def get_order_category(order_items: list) -> str:
     if not order_items:
         return None
 
-    # Получаем ID первого товара
-    first_item_id = order_items[0].get("id", 0)
-
-    # Определяем категорию по диапазону ID
-    if 10000 <= first_item_id < 20000:
-        return "cleaning"
-    elif 20000 <= first_item_id < 30000:
-        return "plasticpe"
-    elif 30000 <= first_item_id < 40000:
-        return "plasticpet"
-    elif 40000 <= first_item_id < 50000:
-        return "plasticpp"
-    elif 50000 <= first_item_id < 60000:
-        return "plastictd"
-    elif 60000 <= first_item_id < 70000:
-        return "chemicals"
-    elif 70000 <= first_item_id < 80000:
-        return "fragrances"
-
-    return None
+    # Категория по первому товару
+    return get_category_by_item_id(order_items[0].get("id", 0))
 
 
 def get_category_by_item_id(item_id: int) -> str:
-    """Определяет категорию по ID товара"""
+    """Определяет категорию по ID товара: из каталога, иначе по диапазону ID"""
+    catalog = product_catalog.version
+    if catalog:
+        category = catalog.index.category_by_id.get(item_id)
+        # Категории таблицы, которых нет в справочнике, не маршрутизируются — берём диапазон
+        if category in CATEGORY_NAMES:
+            return category
+
     if 10000 <= item_id < 20000:
         return "cleaning"
     elif 20000 <= item_id < 30000:
@@ -402,6 +957,28 @@ class OrderStatus:
     REJECTED = "rejected"  # Отклонен
 
 
+# Допустимые переходы статусов: текущий статус -> возможные следующие
+ORDER_STATUS_TRANSITIONS = {
+    OrderStatus.PENDING: {OrderStatus.APPROVED, OrderStatus.REJECTED},
+    OrderStatus.APPROVED: {OrderStatus.PRODUCTION_RECEIVED},
+    OrderStatus.PRODUCTION_RECEIVED: {OrderStatus.PRODUCTION_STARTED},
+    OrderStatus.PRODUCTION_STARTED: {OrderStatus.SENT_TO_WAREHOUSE},
+    OrderStatus.SENT_TO_WAREHOUSE: {OrderStatus.WAREHOUSE_RECEIVED},
+    OrderStatus.WAREHOUSE_RECEIVED: set(),
+    OrderStatus.REJECTED: set(),
+}
+
+
+def can_transition(current_status: Optional[str], new_status: str) -> bool:
+    """Проверяет, разрешён ли переход статуса"""
+    return new_status in ORDER_STATUS_TRANSITIONS.get(current_status or OrderStatus.PENDING, set())
+
+
+def get_previous_statuses(new_status: str) -> List[str]:
+    """Статусы, из которых можно перейти в new_status"""
+    return sorted(status for status, allowed in ORDER_STATUS_TRANSITIONS.items() if new_status in allowed)
+
+
 STATUS_MESSAGES = {
     OrderStatus.APPROVED: {
         "ru": "✅ Ваш заказ #{order_id} одобрен отделом продаж!",
@@ -467,6 +1044,12 @@ USERS_FILE = "users.txt"
 LANG_FILE = "user_lang.json"
 PROFILE_FILE = "user_profile.json"
 
+# Хранилище: mysql (продакшен) или sqlite (локальные запуски, CI, бенчмарки)
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
+if DB_BACKEND not in ("mysql", "sqlite"):
+    raise RuntimeError(f"❌ Неизвестный DB_BACKEND: {DB_BACKEND} (mysql или sqlite)")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.sqlite3")
+
 # MySQL настройки
 DB_CONFIG = {
     'host': os.getenv("DB_HOST"),
@@ -479,6 +1062,18 @@ DB_CONFIG = {
     'autocommit': False
 }
 
+# Реплика для отчётных запросов (необязательно): включается, если задан DB_REPLICA_HOST
+DB_REPLICA_CONFIG = {
+    **DB_CONFIG,
+    'host': os.getenv("DB_REPLICA_HOST"),
+    'port': int(os.getenv("DB_REPLICA_PORT", str(DB_CONFIG['port']))),
+    'user': os.getenv("DB_REPLICA_USER", DB_CONFIG['user']),
+    'password': os.getenv("DB_REPLICA_PASS", DB_CONFIG['password']),
+    'database': os.getenv("DB_REPLICA_NAME", DB_CONFIG['database']),
+} if os.getenv("DB_REPLICA_HOST") and DB_BACKEND == "mysql" else None
+DB_REPLICA_MAX_LAG = int(os.getenv("DB_REPLICA_MAX_LAG", "30"))  # допустимое отставание, сек
+DB_REPLICA_CHECK_INTERVAL = int(os.getenv("DB_REPLICA_CHECK_INTERVAL", "10"))  # проверка отставания, сек
+
 
 # FTP настройки
 HOSTING_BASE_URL = os.getenv("HOSTING_BASE_URL", "")
@@ -535,24 +1130,711 @@ logger = logging.getLogger(__name__)
 
 # ==================== MYSQL CONNECTION POOL ====================
 
-from contextlib import contextmanager
+# Настройки пула соединений
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # ожидание свободного соединения, сек
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))  # максимальный возраст соединения, сек
+DB_POOL_PING_INTERVAL = int(os.getenv("DB_POOL_PING_INTERVAL", "30"))  # проверка простаивающих соединений, сек
+
+
+class PoolTimeoutError(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+    pass
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с проверкой и пересозданием соединений"""
+
+    def __init__(
+            self,
+            connect: Callable[[], Any],
+            min_size: int = 2,
+            max_size: int = 10,
+            timeout: float = 10,
+            recycle: int = 3600,
+            ping_interval: int = 30
+    ):
+        self._connect_factory = connect
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+
+        # Свободные соединения: [connection, created_at, last_used]
+        self._idle: deque = deque()
+        self._size = 0  # всего открытых соединений (свободные + занятые)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Метрики
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.created = 0
+        self.recycled = 0
+        self.broken = 0
+
+    def _connect(self):
+        return self._connect_factory()
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def warmup(self):
+        """Открывает минимальное количество соединений заранее"""
+        with self._cond:
+            missing = self.min_size - self._size
+            self._size += max(0, missing)
+
+        opened = 0
+        for _ in range(max(0, missing)):
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                logger.exception("Failed to open pooled database connection")
+                continue
+            now = time.monotonic()
+            with self._cond:
+                self.created += 1
+                self._idle.append([connection, now, now])
+                self._cond.notify()
+            opened += 1
+
+        logger.info(f"✅ Database pool warmed up: {opened} connections (max {self.max_size})")
+
+    def acquire(self) -> list:
+        """Берёт соединение из пула (блокирует поток до timeout)"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        entry = None
+
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._closed:
+                        self.checkout_failures += 1
+                        raise PoolTimeoutError("Connection pool is closed")
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        # Резервируем место под новое соединение
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.checkout_failures += 1
+                        raise PoolTimeoutError(
+                            f"No free database connection within {self.timeout}s "
+                            f"(in use: {self._in_use}/{self.max_size})"
+                        )
+                    self._cond.wait(remaining)
+                self._in_use += 1
+            finally:
+                self._waiting -= 1
+
+        # Проверка здоровья и открытие соединения — вне блокировки
+        try:
+            entry = self._prepare(entry)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self.checkout_failures += 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        return entry
+
+    def _prepare(self, entry: Optional[list]) -> list:
+        """Пересоздаёт старые соединения и пингует давно простаивающие"""
+        now = time.monotonic()
+
+        if entry is not None:
+            connection, created_at, last_used = entry
+            if now - created_at > self.recycle:
+                self._close_quietly(connection)
+                with self._cond:
+                    self.recycled += 1
+                entry = None
+            elif now - last_used > self.ping_interval:
+                try:
+                    connection.ping(reconnect=False)
+                except Exception:
+                    self._close_quietly(connection)
+                    with self._cond:
+                        self.broken += 1
+                    entry = None
+
+        if entry is None:
+            connection = self._connect()
+            with self._cond:
+                self.created += 1
+            entry = [connection, now, now]
+
+        return entry
+
+    def release(self, entry: list, discard: bool = False):
+        """Возвращает соединение в пул (или закрывает сломанное)"""
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._size -= 1
+                if discard:
+                    self.broken += 1
+            else:
+                entry[2] = time.monotonic()
+                self._idle.append(entry)
+                entry = None
+            self._cond.notify()
+
+        if entry is not None:
+            self._close_quietly(entry[0])
+
+    def close(self):
+        """Закрывает все свободные соединения; занятые закроются при возврате"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for connection, _, _ in idle:
+            self._close_quietly(connection)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Снимок метрик пула"""
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": (self.total_wait / self.checkouts * 1000) if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait * 1000,
+                "created": self.created,
+                "recycled": self.recycled,
+                "broken": self.broken,
+            }
+
+
+# ==================== SQLITE BACKEND ====================
+#
+# Те же DB-функции работают поверх SQLite: соединение-обёртка повторяет
+# интерфейс pymysql (плейсхолдеры %s, строки-словари, commit/rollback/ping),
+# а различия диалектов закрывает sql_upsert() и отдельная схема SQLITE_SCHEMA.
+
+# Как DATETIME в MySQL — с точностью до секунды: курсоры страниц
+# (CURSOR_TIME_FORMAT) тоже секундные, иначе строки на границе терялись бы
+sqlite3.register_adapter(datetime, lambda value: value.replace(microsecond=0).isoformat(" "))
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+
+
+@functools.lru_cache(maxsize=512)
+def _sqlite_sql(sql: str) -> str:
+    """Перевод плейсхолдеров pymysql (%s, %%) в формат sqlite3"""
+    return sql.replace("%%", "\0").replace("%s", "?").replace("\0", "%")
+
+
+class SQLiteCursor:
+    """Курсор sqlite3 с интерфейсом курсора pymysql"""
+
+    def __init__(self, cursor: sqlite3.Cursor, as_dict: bool = True):
+        self._cursor = cursor
+        self._as_dict = as_dict
+
+    def _row(self, row):
+        if row is None or not self._as_dict:
+            return row
+        return {column[0]: value for column, value in zip(self._cursor.description, row)}
+
+    def execute(self, sql: str, params=None) -> int:
+        self._cursor.execute(_sqlite_sql(sql), tuple(params or ()))
+        return self._cursor.rowcount
+
+    def executemany(self, sql: str, rows) -> int:
+        self._cursor.executemany(_sqlite_sql(sql), [tuple(row) for row in rows])
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self) -> list:
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield self._row(row)
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """Соединение SQLite (WAL) с интерфейсом соединения pymysql"""
+
+    def __init__(self, path: str, timeout: float = 10):
+        self._conn = sqlite3.connect(
+            path,
+            timeout=timeout,
+            check_same_thread=False,  # соединение переходит между потоками пула, но не делится
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+
+    def cursor(self, cursorclass=None) -> SQLiteCursor:
+        # Как в pymysql: DictCursor по умолчанию, SSCursor и прочие — кортежи
+        as_dict = cursorclass is None or issubclass(cursorclass, DictCursor)
+        return SQLiteCursor(self._conn.cursor(), as_dict=as_dict)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def ping(self, reconnect: bool = False):
+        self._conn.execute("SELECT 1").fetchone()
+
+    def close(self):
+        self._conn.close()
+
+
+def sql_upsert(table: str, columns: List[str], key: List[str], update=None) -> str:
+    """INSERT с обработкой конфликта ключа в синтаксисе текущего бэкенда.
+
+    update — список колонок, которые перезаписываются новым значением, или
+    {колонка: выражение}, где {new} — вставляемое значение колонки
+    (VALUES(col) в MySQL, excluded.col в SQLite). Без update существующая
+    строка не меняется.
+    """
+    placeholders = ", ".join(["%s"] * len(columns))
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if isinstance(update, (list, tuple)):
+        update = {column: "{new}" for column in update}
+
+    if DB_BACKEND == "sqlite":
+        if not update:
+            return f"{sql} ON CONFLICT ({', '.join(key)}) DO NOTHING"
+        assignments = ", ".join(
+            f"{column} = {expr.format(new=f'excluded.{column}')}" for column, expr in update.items()
+        )
+        return f"{sql} ON CONFLICT ({', '.join(key)}) DO UPDATE SET {assignments}"
+
+    if not update:
+        update = {key[0]: key[0]}
+    assignments = ", ".join(
+        f"{column} = {expr.format(new=f'VALUES({column})')}" for column, expr in update.items()
+    )
+    return f"{sql} ON DUPLICATE KEY UPDATE {assignments}"
+
+
+# Маршруты запросов: транзакционные — только primary, отчётные — реплика (если есть)
+ROUTE_PRIMARY = "primary"
+ROUTE_REPORTING = "reporting"
+
+
+class ReplicaRouter:
+    """Выбор пула для отчётных чтений: реплика, пока она доступна и не отстаёт"""
+
+    def __init__(self, pool: ConnectionPool, max_lag: int = 30, check_interval: int = 10):
+        self.pool = pool
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self.lag: Optional[float] = None  # None — реплика недоступна или репликация стоит
+        self.healthy = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+        # Метрики: (маршрут, фактическая цель) -> число запросов
+        self.routed: Dict[tuple, int] = defaultdict(int)
+        self.lag_checks = 0
+        self.lag_check_failures = 0
+
+    def _read_lag(self) -> Optional[float]:
+        entry = self.pool.acquire()
+        discard = False
+        try:
+            cursor = entry[0].cursor()
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except pymysql.err.MySQLError as e:
+                if e.args[0] != 1064:  # синтаксис — старые MySQL/MariaDB
+                    raise
+                cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            entry[0].commit()
+        except pymysql.err.MySQLError:
+            discard = True
+            raise
+        finally:
+            self.pool.release(entry, discard=discard)
+
+        if not row:
+            # Сервер не настроен как реплика (например, вторая тестовая база) — отставания нет
+            return 0.0
+        lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        return float(lag) if lag is not None else None
+
+    def refresh(self):
+        """Перепроверяет отставание реплики"""
+        try:
+            lag = self._read_lag()
+        except Exception as e:
+            lag = None
+            self.lag_check_failures += 1
+            logger.warning(f"⚠️ Replica lag check failed: {e}")
+
+        was_healthy = self.healthy
+        self.lag = lag
+        self.healthy = lag is not None and lag <= self.max_lag
+        self.lag_checks += 1
+        self._checked_at = time.monotonic()
+
+        if was_healthy != self.healthy:
+            if self.healthy:
+                logger.info(f"✅ Replica is healthy (lag {lag:.0f}s), routing reports to it")
+            else:
+                logger.warning(f"⚠️ Replica unavailable or lagging (lag {lag}), reports go to primary")
+
+    def choose(self) -> Optional[ConnectionPool]:
+        """Пул реплики или None, если читать нужно с primary"""
+        if time.monotonic() - self._checked_at > self.check_interval:
+            # Проверяет один поток, остальные используют прошлый результат
+            if self._lock.acquire(blocking=False):
+                try:
+                    self.refresh()
+                finally:
+                    self._lock.release()
+        return self.pool if self.healthy else None
+
+    def mark_failed(self):
+        """Реплика не выдала соединение — до следующей проверки читаем с primary"""
+        self.healthy = False
+        self._checked_at = time.monotonic()
+
+    def record(self, route: str, target: str):
+        with self._lock:
+            self.routed[(route, target)] += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            routed = dict(self.routed)
+        return {
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+            "lag_checks": self.lag_checks,
+            "lag_check_failures": self.lag_check_failures,
+            "routed": routed,
+        }
+
+
+if DB_BACKEND == "sqlite":
+    _db_connect = functools.partial(SQLiteConnection, SQLITE_PATH, DB_POOL_TIMEOUT)
+else:
+    _db_connect = functools.partial(pymysql.connect, **DB_CONFIG)
+
+db_pool = ConnectionPool(
+    _db_connect,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    recycle=DB_POOL_RECYCLE,
+    ping_interval=DB_POOL_PING_INTERVAL
+)
+
+replica_router: Optional[ReplicaRouter] = None
+if DB_REPLICA_CONFIG:
+    replica_router = ReplicaRouter(
+        ConnectionPool(
+            functools.partial(pymysql.connect, **DB_REPLICA_CONFIG),
+            min_size=1,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_TIMEOUT,
+            recycle=DB_POOL_RECYCLE,
+            ping_interval=DB_POOL_PING_INTERVAL
+        ),
+        max_lag=DB_REPLICA_MAX_LAG,
+        check_interval=DB_REPLICA_CHECK_INTERVAL
+    )
+
+# Отдельный пул потоков для БД: размер совпадает с пулами соединений,
+# поэтому поток никогда не ждёт соединение дольше, чем запрос в очереди
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_POOL_MAX_SIZE * (2 if replica_router else 1),
+    thread_name_prefix="db"
+)
+
+
+# ==================== МЕТРИКИ ЗАПРОСОВ ====================
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Границы корзин гистограммы задержек, мс
+QUERY_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+@functools.lru_cache(maxsize=1024)
+def _statement_name(sql: str) -> str:
+    """Имя запроса по умолчанию: «таблица.операция» (например, orders.select)"""
+    verb_match = re.match(r"\s*(\w+)", sql)
+    verb = verb_match.group(1).lower() if verb_match else "unknown"
+    patterns = {
+        "select": r"\bFROM\s+(\w+)",
+        "delete": r"\bFROM\s+(\w+)",
+        "insert": r"\bINTO\s+(\w+)",
+        "update": r"^\s*UPDATE\s+(\w+)",
+    }
+    table_match = re.search(patterns[verb], sql, re.IGNORECASE) if verb in patterns else None
+    return f"{table_match.group(1)}.{verb}" if table_match else verb
+
+
+def _redact_params(params) -> str:
+    """Параметры для лога: только типы и размеры, без значений"""
+    if not params:
+        return "()"
+    if isinstance(params, list) and isinstance(params[0], (tuple, list, dict)):
+        # executemany: описываем первую строку пачки
+        return f"{len(params)} × {_redact_params(params[0])}"
+    if isinstance(params, dict):
+        params = params.values()
+    described = []
+    for value in params:
+        if isinstance(value, (bytes, bytearray, str)):
+            described.append(f"{type(value).__name__}[{len(value)}]")
+        else:
+            described.append(type(value).__name__)
+    return "(" + ", ".join(described) + ")"
+
+
+def _row_size(row) -> int:
+    """Примерный объём строки результата в байтах"""
+    if row is None:
+        return 0
+    values = row.values() if isinstance(row, dict) else row
+    size = 0
+    for value in values:
+        if isinstance(value, (bytes, bytearray, str)):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+
+class QueryStats:
+    """Гистограммы задержек, строки и байты по именам запросов"""
+
+    def __init__(self, buckets=QUERY_LATENCY_BUCKETS_MS, slow_ms: float = 200):
+        self.buckets = buckets
+        self.slow_ms = slow_ms
+        self.slow_queries = 0
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, name: str) -> Dict[str, Any]:
+        entry = self._stats.get(name)
+        if entry is None:
+            entry = self._stats[name] = {
+                "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "rows": 0, "bytes": 0, "buckets": [0] * (len(self.buckets) + 1),
+            }
+        return entry
+
+    def observe(self, name: str, elapsed_ms: float, failed: bool = False) -> bool:
+        """Учитывает выполнение запроса; True — запрос медленный"""
+        slow = elapsed_ms >= self.slow_ms
+        with self._lock:
+            entry = self._entry(name)
+            entry["count"] += 1
+            entry["errors"] += int(failed)
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            index = next((i for i, bound in enumerate(self.buckets) if elapsed_ms <= bound), len(self.buckets))
+            entry["buckets"][index] += 1
+            self.slow_queries += int(slow)
+        return slow
+
+    def add_rows(self, name: str, rows: int, size: int):
+        with self._lock:
+            entry = self._entry(name)
+            entry["rows"] += rows
+            entry["bytes"] += size
+
+    def percentile(self, name: str, fraction: float) -> float:
+        """Оценка перцентиля по корзинам (верхняя граница корзины)"""
+        with self._lock:
+            entry = self._stats.get(name)
+            if not entry or not entry["count"]:
+                return 0.0
+            target = entry["count"] * fraction
+            seen = 0
+            for i, count in enumerate(entry["buckets"]):
+                seen += count
+                if seen >= target:
+                    return float(self.buckets[i]) if i < len(self.buckets) else entry["max_ms"]
+            return entry["max_ms"]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: {**entry, "buckets": list(entry["buckets"])} for name, entry in self._stats.items()}
+
+
+query_stats = QueryStats(slow_ms=SLOW_QUERY_MS)
+
+
+class InstrumentedCursor:
+    """Курсор с замером каждого запроса; execute(..., name="orders.page") задаёт имя"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._name = None
+
+    def _run(self, method, sql: str, params, name: Optional[str]):
+        self._name = name or _statement_name(sql)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return method(sql, params)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if query_stats.observe(self._name, elapsed_ms, failed):
+                logger.warning(
+                    f"🐢 Slow query {self._name}: {elapsed_ms:.0f} ms, "
+                    f"sql={' '.join(sql.split())[:300]}, params={_redact_params(params)}"
+                )
+
+    def execute(self, sql: str, params=None, name: Optional[str] = None):
+        return self._run(self._cursor.execute, sql, params, name)
+
+    def executemany(self, sql: str, rows, name: Optional[str] = None):
+        rows = list(rows)
+        return self._run(self._cursor.executemany, sql, rows, name)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            query_stats.add_rows(self._name, 1, _row_size(row))
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        query_stats.add_rows(self._name, len(rows), sum(_row_size(row) for row in rows))
+        return rows
+
+    def __iter__(self):
+        rows = size = 0
+        try:
+            for row in self._cursor:
+                rows += 1
+                size += _row_size(row)
+                yield row
+        finally:
+            query_stats.add_rows(self._name, rows, size)
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+
+class InstrumentedConnection:
+    """Соединение, выдающее InstrumentedCursor; остальное — как у исходного"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs) -> InstrumentedCursor:
+        return InstrumentedCursor(self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, item):
+        return getattr(self._connection, item)
+
+
+def _acquire_for_route(route: str) -> tuple:
+    """Пул и соединение для маршрута; при проблемах с репликой — primary"""
+    if route == ROUTE_REPORTING and replica_router:
+        pool = replica_router.choose()
+        if pool is not None:
+            try:
+                entry = pool.acquire()
+                replica_router.record(route, "replica")
+                return pool, entry
+            except Exception as e:
+                logger.warning(f"⚠️ Replica connection failed, falling back to primary: {e}")
+                replica_router.mark_failed()
+        replica_router.record(route, "primary")
+    elif replica_router:
+        replica_router.record(route, "primary")
+
+    return db_pool, db_pool.acquire()
+
 
 @contextmanager
-def get_db_connection():
-    """Контекстный менеджер для MySQL соединения"""
-    connection = None
+def get_db_connection(route: str = ROUTE_PRIMARY):
+    """Контекстный менеджер для соединения с БД из пула.
+
+    route=ROUTE_REPORTING — только чтение, допускающее отставание реплики
+    до DB_REPLICA_MAX_LAG секунд; всё остальное идёт на primary.
+    """
+    pool, entry = _acquire_for_route(route)
+    connection = InstrumentedConnection(entry[0])
+    discard = False
     try:
-        connection = pymysql.connect(**DB_CONFIG)
         yield connection
         connection.commit()
     except Exception as e:
-        if connection:
+        try:
             connection.rollback()
+        except Exception:
+            discard = True
+        # Сетевые ошибки — соединение больше не годится для повторного использования
+        if isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+            discard = True
         logger.exception(f"Database error: {e}")
         raise
     finally:
-        if connection:
-            connection.close()
+        pool.release(entry, discard=discard)
+
+
+async def run_db(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполняет синхронную DB-функцию в пуле потоков, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
 
 
 
@@ -767,275 +2049,1697 @@ class OrderDataValidator:
 # ==================== БАЗА ДАННЫХ ====================
 
 def init_db():
-    """Инициализация базы данных MySQL с новыми статусами"""
+    """Инициализация базы данных MySQL: применение недостающих миграций схемы"""
+    version = run_migrations()
+    logger.info(f"✅ Database schema at version {version}")
+
+
+def _alter_online(cursor, table: str, clause: str):
+    """ALTER TABLE без блокировки записи (INPLACE, LOCK=NONE), если сервер это поддерживает"""
+    try:
+        cursor.execute(f"ALTER TABLE {table} {clause}, ALGORITHM=INPLACE, LOCK=NONE")
+    except pymysql.err.MySQLError as e:
+        # 1845/1846 — операция не поддерживает онлайн-режим: выполняем обычный ALTER
+        if e.args[0] not in (1845, 1846):
+            raise
+        logger.warning(f"⚠️ Online ALTER not supported for {table} ({clause}), falling back to locking ALTER")
+        cursor.execute(f"ALTER TABLE {table} {clause}")
+
+
+def _ensure_column(cursor, table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, если её ещё нет"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (table, column))
+    if not cursor.fetchone():
+        _alter_online(cursor, table, f"ADD COLUMN {column} {definition}")
+        logger.info(f"Added column {table}.{column}")
+
+
+def _ensure_index(cursor, table: str, index: str, columns: str):
+    """Добавляет индекс в существующую таблицу, если его ещё нет"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        LIMIT 1
+    """, (table, index))
+    if not cursor.fetchone():
+        _alter_online(cursor, table, f"ADD INDEX {index} ({columns})")
+        logger.info(f"Added index {table}.{index}")
+
+
+def _drop_index(cursor, table: str, index: str):
+    """Удаляет индекс, если он есть (например, ставший лишним префиксом)"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        LIMIT 1
+    """, (table, index))
+    if cursor.fetchone():
+        _alter_online(cursor, table, f"DROP INDEX {index}")
+        logger.info(f"Dropped index {table}.{index}")
+
+
+LEGACY_MIGRATION_MARKER = "legacy_user_files_migrated"
+LEGACY_MIGRATION_CHUNK = 1000
+
+
+def get_app_meta(key: str) -> Optional[str]:
+    """Чтение служебного значения из app_meta"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # Создаем таблицу пользователей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                language VARCHAR(10) DEFAULT 'ru',
-                phone VARCHAR(50),
-                city VARCHAR(255),
-                full_name VARCHAR(255),
-                latitude DECIMAL(10, 7),
-                longitude DECIMAL(10, 7),
-                created_at DATETIME NOT NULL,
-                last_activity DATETIME,
-                INDEX idx_phone (phone),
-                INDEX idx_created_at (created_at)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        """)
-        
-        # Создаем таблицу заказов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                order_id VARCHAR(50) PRIMARY KEY,
-                client_name VARCHAR(255) NOT NULL,
-                user_id BIGINT NOT NULL,
-                total DECIMAL(15, 2) NOT NULL,
-                created_at DATETIME NOT NULL,
-                status VARCHAR(50) DEFAULT 'pending',
-                pdf_draft LONGBLOB,
-                pdf_final LONGBLOB,
-                order_json TEXT,
-                approved_by BIGINT,
-                production_received_by BIGINT,
-                production_started_by BIGINT,
-                sent_to_warehouse_by BIGINT,
-                warehouse_received_by BIGINT,
-                category VARCHAR(50),
-                base_order_id VARCHAR(50),
-                INDEX idx_user_id (user_id),
-                INDEX idx_status (status),
-                INDEX idx_created_at (created_at),
-                INDEX idx_base_order_id (base_order_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        """)
-
-        # Создаем таблицу уведомлений клиентов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS client_notifications (
-                base_order_id VARCHAR(50) PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                message_id BIGINT NOT NULL,
-                created_at DATETIME NOT NULL,
-                INDEX idx_user_id (user_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        """)
+        cursor.execute("SELECT meta_value FROM app_meta WHERE meta_key = %s", (key,))
+        row = cursor.fetchone()
+        return row['meta_value'] if row else None
+
+
+def set_app_meta(key: str, value: str):
+    """Запись служебного значения в app_meta"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            sql_upsert("app_meta", ["meta_key", "meta_value", "updated_at"], ["meta_key"],
+                       update=["meta_value", "updated_at"]),
+            (key, value, datetime.now())
+        )
+        conn.commit()
 
+
+def _chunked(iterable, size: int):
+    """Разбивает поток на списки по size элементов"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _read_legacy_user_ids(path: str):
+    """Построчно читает users.txt, не загружая файл целиком"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield int(line)
+            except ValueError:
+                logger.warning(f"Skipping invalid user id in {path}: {line!r}")
+
+
+def _bulk_execute(sql: str, rows) -> int:
+    """Пакетная запись: одна транзакция, executemany по LEGACY_MIGRATION_CHUNK строк"""
+    count = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for chunk in _chunked(rows, LEGACY_MIGRATION_CHUNK):
+            cursor.executemany(sql, chunk)
+            count += len(chunk)
         conn.commit()
-        logger.info("✅ Database tables created/verified")
+    return count
 
 
 def migrate_users_from_files():
-    """Миграция данных пользователей из локальных файлов в базу данных"""
+    """Однократная пакетная миграция пользователей из локальных файлов в базу данных"""
+    if not any(os.path.exists(path) for path in (USERS_FILE, LANG_FILE, PROFILE_FILE)):
+        return
+
     try:
-        migrated_count = 0
-        
+        if get_app_meta(LEGACY_MIGRATION_MARKER):
+            logger.info("Legacy user files already migrated, skipping")
+            return
+
+        now = datetime.now()
+
         # Миграция user IDs из users.txt
         if os.path.exists(USERS_FILE):
             logger.info("Migrating users from users.txt...")
-            with open(USERS_FILE, "r", encoding="utf-8") as f:
-                user_ids = [int(line.strip()) for line in f if line.strip()]
-            
-            for user_id in user_ids:
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-                    if not cursor.fetchone():
-                        cursor.execute("""
-                            INSERT INTO users (user_id, created_at, last_activity, language)
-                            VALUES (%s, %s, %s, %s)
-                        """, (user_id, datetime.now(), datetime.now(), 'ru'))
-                        conn.commit()
-                        migrated_count += 1
-            
-            logger.info(f"Migrated {migrated_count} users from users.txt")
-        
+            count = _bulk_execute(
+                sql_upsert("users", ["user_id", "created_at", "last_activity", "language"], ["user_id"]),
+                ((user_id, now, now, 'ru') for user_id in _read_legacy_user_ids(USERS_FILE))
+            )
+            logger.info(f"Migrated {count} users from users.txt")
+
         # Миграция языков из user_lang.json
         if os.path.exists(LANG_FILE):
             logger.info("Migrating languages from user_lang.json...")
             with open(LANG_FILE, "r", encoding="utf-8") as f:
                 lang_data = json.load(f)
-            
-            for user_id_str, lang in lang_data.items():
-                user_id = int(user_id_str)
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE users SET language = %s WHERE user_id = %s
-                    """, (lang, user_id))
-                    conn.commit()
-            
-            logger.info(f"Migrated languages for {len(lang_data)} users")
-        
+
+            # Только UPDATE: язык без строки в users.txt не создаёт нового пользователя
+            count = _bulk_execute(
+                "UPDATE users SET language = %s WHERE user_id = %s",
+                ((lang, int(user_id)) for user_id, lang in lang_data.items())
+            )
+            logger.info(f"Migrated languages for {count} users")
+
         # Миграция профилей из user_profile.json
         if os.path.exists(PROFILE_FILE):
             logger.info("Migrating profiles from user_profile.json...")
             with open(PROFILE_FILE, "r", encoding="utf-8") as f:
                 profile_data = json.load(f)
-            
-            for user_id_str, profile in profile_data.items():
-                user_id = int(user_id_str)
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE users 
-                        SET phone = %s, city = %s, full_name = %s, latitude = %s, longitude = %s
-                        WHERE user_id = %s
-                    """, (
-                        profile.get('phone'),
-                        profile.get('city'),
-                        profile.get('full_name'),
-                        profile.get('latitude'),
-                        profile.get('longitude'),
-                        user_id
-                    ))
-                    conn.commit()
-            
-            logger.info(f"Migrated profiles for {len(profile_data)} users")
-        
+
+            # Только UPDATE: профиль без строки в users.txt не создаёт нового пользователя
+            count = _bulk_execute(
+                """
+                UPDATE users
+                SET phone = %s, city = %s, full_name = %s, latitude = %s, longitude = %s
+                WHERE user_id = %s
+                """,
+                ((
+                    profile.get('phone'),
+                    profile.get('city'),
+                    profile.get('full_name'),
+                    profile.get('latitude'),
+                    profile.get('longitude'),
+                    int(user_id)
+                ) for user_id, profile in profile_data.items())
+            )
+            logger.info(f"Migrated profiles for {count} users")
+
+        # Отметка о миграции: следующие запуски её пропускают
+        set_app_meta(LEGACY_MIGRATION_MARKER, now.isoformat())
         logger.info("✅ User data migration completed successfully")
-        
-    except Exception as e:
+
+    except Exception:
         logger.exception("❌ Error during user data migration")
 
 
-def save_order(order_id: str, client_name: str, user_id: int, total: float,
-               pdf_draft: bytes, order_json: dict, category: str = None, base_order_id: str = None):
-    """Сохранение нового заказа"""
+# ==================== ХРАНИЛИЩЕ PDF ====================
+
+def _store_blob(cursor, data: bytes) -> str:
+    """Сохраняет PDF в order_blobs и возвращает его SHA-256"""
+    sha = hashlib.sha256(data).hexdigest()
+    now = datetime.now()
+
+    # Не гоняем мегабайты по сети, если такой PDF уже есть. Вместо
+    # SELECT обновляем created_at: сборщик мусора не тронет блоб моложе
+    # grace-периода, а блокировка строки держится до коммита ссылки
+    cursor.execute("UPDATE order_blobs SET created_at = %s WHERE sha256 = %s", (now, sha))
+    if cursor.rowcount == 0:
+        # rowcount == 0 бывает и при том же created_at — тогда строка уже есть
+        cursor.execute("SELECT 1 FROM order_blobs WHERE sha256 = %s", (sha,))
+        if not cursor.fetchone():
+            cursor.execute(
+                sql_upsert("order_blobs", ["sha256", "data", "size", "created_at"], ["sha256"]),
+                (sha, data, len(data), now)
+            )
+
+    return sha
+
+
+# Холодное хранилище: старые PDF переносятся из order_blobs в файлы
+# (storage = 'file'), в базе остаётся только ссылка cold_path.
+# Каталог должен быть постоянным томом: копии в базе после переноса нет
+PDF_COLD_DIR = os.getenv("PDF_COLD_DIR", "")
+
+
+def _cold_blob_path(sha: str) -> str:
+    """Относительный путь PDF в холодном хранилище (подкаталог по первым символам хэша)"""
+    return os.path.join(sha[:2], f"{sha}.pdf")
+
+
+def get_blob(sha: str) -> Optional[bytes]:
+    """Загрузка PDF по SHA-256 (из базы или из холодного хранилища)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT data, storage, cold_path FROM order_blobs WHERE sha256 = %s", (sha,),
+            name="order_blobs.get"
+        )
+        row = cursor.fetchone()
+
+    if not row:
+        return None
+    if row['storage'] != 'file':
+        return row['data']
+
+    try:
+        with open(os.path.join(PDF_COLD_DIR, row['cold_path']), "rb") as f:
+            return f.read()
+    except OSError:
+        logger.exception(f"❌ Cold PDF {sha} is missing at {row['cold_path']}")
+        return None
+
+
+def get_order_pdf_ref(order_id: str, user_id: int = None) -> Optional[Dict[str, Any]]:
+    """Ссылки на PDF заказа (без самих данных); user_id ограничивает доступ владельцем.
+
+    Заказы, перенесённые в orders_archive, тоже находятся.
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        for table in ("orders", "orders_archive"):
+            if user_id is None:
+                cursor.execute(f"""
+                    SELECT order_id, pdf_final_sha, pdf_draft_sha FROM {table} WHERE order_id = %s
+                """, (order_id,))
+            else:
+                cursor.execute(f"""
+                    SELECT order_id, pdf_final_sha, pdf_draft_sha FROM {table} WHERE order_id = %s AND user_id = %s
+                """, (order_id, user_id))
+            row = cursor.fetchone()
+            if row:
+                return dict(row)
+        return None
+
+
+# ==================== МИГРАЦИИ СХЕМЫ ====================
+#
+# Каждая миграция — (номер, имя, функция(conn)). Номера только растут;
+# применённые записываются в schema_version. Миграции идемпотентны
+# (IF NOT EXISTS / _ensure_*), т.к. DDL в MySQL не откатывается транзакцией.
+
+SCHEMA_LOCK_NAME = "dillers_bot_schema_migrations"
+SCHEMA_LOCK_TIMEOUT = int(os.getenv("SCHEMA_LOCK_TIMEOUT", "120"))  # сек
+
+
+def _m0001_baseline(conn):
+    """Исходные таблицы users, orders, client_notifications"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            language VARCHAR(10) DEFAULT 'ru',
+            phone VARCHAR(50),
+            city VARCHAR(255),
+            full_name VARCHAR(255),
+            latitude DECIMAL(10, 7),
+            longitude DECIMAL(10, 7),
+            created_at DATETIME NOT NULL,
+            last_activity DATETIME,
+            INDEX idx_phone (phone),
+            INDEX idx_created_at (created_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id VARCHAR(50) PRIMARY KEY,
+            client_name VARCHAR(255) NOT NULL,
+            user_id BIGINT NOT NULL,
+            total DECIMAL(15, 2) NOT NULL,
+            created_at DATETIME NOT NULL,
+            status VARCHAR(50) DEFAULT 'pending',
+            pdf_draft LONGBLOB,
+            pdf_final LONGBLOB,
+            order_json TEXT,
+            approved_by BIGINT,
+            production_received_by BIGINT,
+            production_started_by BIGINT,
+            sent_to_warehouse_by BIGINT,
+            warehouse_received_by BIGINT,
+            category VARCHAR(50),
+            base_order_id VARCHAR(50),
+            INDEX idx_user_id (user_id),
+            INDEX idx_status (status),
+            INDEX idx_created_at (created_at),
+            INDEX idx_base_order_id (base_order_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS client_notifications (
+            base_order_id VARCHAR(50) PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            created_at DATETIME NOT NULL,
+            INDEX idx_user_id (user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+
+
+def _m0002_order_blobs(conn):
+    """PDF хранятся отдельно от заказов, по SHA-256 (дубликаты не сохраняются)"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_blobs (
+            sha256 CHAR(64) PRIMARY KEY,
+            data LONGBLOB NOT NULL,
+            size INT NOT NULL,
+            created_at DATETIME NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+    _ensure_column(cursor, "orders", "pdf_draft_sha", "CHAR(64) NULL AFTER pdf_final")
+    _ensure_column(cursor, "orders", "pdf_final_sha", "CHAR(64) NULL AFTER pdf_draft_sha")
+
+
+def _m0003_orders_keyset_indexes(conn):
+    """Индексы для keyset-пагинации списков заказов"""
+    cursor = conn.cursor()
+    _ensure_index(cursor, "orders", "idx_user_created_order", "user_id, created_at, order_id")
+    _ensure_index(cursor, "orders", "idx_created_order", "created_at, order_id")
+
+
+def _m0004_order_events(conn):
+    """История статусов заказа (пишется в той же транзакции, что и смена статуса)"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_events (
+            event_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            order_id VARCHAR(50) NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            actor BIGINT,
+            created_at DATETIME NOT NULL,
+            INDEX idx_order_events_order (order_id, event_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+
+
+def _m0005_app_meta(conn):
+    """Служебные отметки (например, о выполненных миграциях данных)"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS app_meta (
+            meta_key VARCHAR(100) PRIMARY KEY,
+            meta_value TEXT,
+            updated_at DATETIME NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+
+
+def _m0006_users_stats_rollup(conn):
+    """Предрасчитанная статистика пользователей и индекс по last_activity"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users_stats_rollup (
+            metric VARCHAR(32) NOT NULL,
+            dimension VARCHAR(255) NOT NULL DEFAULT '',
+            value INT NOT NULL,
+            refreshed_at DATETIME NOT NULL,
+            PRIMARY KEY (metric, dimension)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+    _ensure_index(cursor, "users", "idx_last_activity", "last_activity")
+
+
+def _m0007_orders_base_status_indexes(conn):
+    """Части заказа ищутся по (base_order_id, order_id); экспорт — по (status, created_at)"""
+    cursor = conn.cursor()
+    _ensure_index(cursor, "orders", "idx_status_created_order", "status, created_at, order_id")
+    _ensure_index(cursor, "orders", "idx_base_order", "base_order_id, order_id")
+    _drop_index(cursor, "orders", "idx_base_order_id")  # покрыт idx_base_order
+
+
+def _m0008_move_pdfs_to_blob_store(conn, batch_size: int = 20):
+    """Перенос PDF из колонок orders.pdf_draft/pdf_final в order_blobs небольшими пачками"""
+    cursor = conn.cursor()
+    moved = 0
+    while True:
         cursor.execute("""
-            INSERT INTO orders 
-            (order_id, client_name, user_id, total, created_at, status, pdf_draft, order_json, category, base_order_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
+            SELECT order_id, pdf_draft, pdf_final FROM orders
+            WHERE pdf_draft IS NOT NULL OR pdf_final IS NOT NULL
+            LIMIT %s
+        """, (batch_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        for row in rows:
+            draft_sha = _store_blob(cursor, row['pdf_draft']) if row['pdf_draft'] else None
+            final_sha = _store_blob(cursor, row['pdf_final']) if row['pdf_final'] else None
+            cursor.execute("""
+                UPDATE orders
+                SET pdf_draft_sha = COALESCE(pdf_draft_sha, %s),
+                    pdf_final_sha = COALESCE(pdf_final_sha, %s),
+                    pdf_draft = NULL,
+                    pdf_final = NULL
+                WHERE order_id = %s
+            """, (draft_sha, final_sha, row['order_id']))
+
+        conn.commit()
+        moved += len(rows)
+
+    if moved:
+        logger.info(f"Moved PDFs of {moved} orders into blob store")
+
+
+def _m0009_backfill_base_order_id(conn, batch_size: int = 1000):
+    """Проставляет base_order_id = order_id у одиночных заказов (пачками).
+
+    После этого все части заказа, включая «корневой», находятся одним
+    условием base_order_id = %s по индексу (base_order_id, order_id).
+    """
+    cursor = conn.cursor()
+    updated = 0
+    while True:
+        cursor.execute("""
+            UPDATE orders SET base_order_id = order_id
+            WHERE base_order_id IS NULL
+            LIMIT %s
+        """, (batch_size,))
+        count = cursor.rowcount
+        conn.commit()
+        updated += count
+        if count < batch_size:
+            break
+
+    if updated:
+        logger.info(f"Backfilled base_order_id for {updated} orders")
+
+
+def _m0010_order_items(conn):
+    """Товары заказа отдельными строками — для агрегаций на стороне SQL"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id VARCHAR(50) NOT NULL,
+            line_no SMALLINT NOT NULL,
+            product_id BIGINT NOT NULL,
+            name VARCHAR(255),
+            qty INT NOT NULL,
+            price DECIMAL(15, 2) NOT NULL,
+            weight DECIMAL(12, 3) NOT NULL DEFAULT 0,
+            cube DECIMAL(12, 4) NOT NULL DEFAULT 0,
+            category VARCHAR(50),
+            PRIMARY KEY (order_id, line_no),
+            INDEX idx_order_items_product (product_id),
+            INDEX idx_order_items_category (category)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+
+
+def _m0011_backfill_order_items(conn, batch_size: int = 500):
+    """Заполняет order_items из order_json уже существующих заказов (keyset по order_id)"""
+    cursor = conn.cursor()
+    last_order_id = ""
+    filled = 0
+    while True:
+        cursor.execute("""
+            SELECT order_id, category, order_json FROM orders
+            WHERE order_id > %s
+              AND NOT EXISTS (SELECT 1 FROM order_items i WHERE i.order_id = orders.order_id)
+            ORDER BY order_id
+            LIMIT %s
+        """, (last_order_id, batch_size))
+        orders = [OrderRecord.from_row(row) for row in cursor.fetchall()]
+        if not orders:
+            break
+
+        rows = []
+        for order in orders:
+            rows.extend(_order_item_rows(order.order_id, order.items, order.category))
+        if rows:
+            cursor.executemany(ORDER_ITEMS_INSERT_SQL, rows)
+        conn.commit()
+
+        filled += len(orders)
+        last_order_id = orders[-1].order_id
+
+    if filled:
+        logger.info(f"Backfilled order_items for {filled} orders")
+
+
+def _m0012_client_notifications_nullable_message(conn):
+    """Строка уведомления создаётся вместе с заказом, message_id появляется позже"""
+    cursor = conn.cursor()
+    _alter_online(cursor, "client_notifications", "MODIFY COLUMN message_id BIGINT NULL")
+
+
+def _m0013_retention(conn):
+    """Холодное хранение PDF, индексы для сборки мусора в order_blobs и архив заказов"""
+    cursor = conn.cursor()
+    _ensure_column(cursor, "order_blobs", "storage", "VARCHAR(10) NOT NULL DEFAULT 'db'")
+    _ensure_column(cursor, "order_blobs", "cold_path", "VARCHAR(255) NULL")
+    _ensure_index(cursor, "order_blobs", "idx_storage_created", "storage, created_at")
+    _ensure_index(cursor, "orders", "idx_pdf_draft_sha", "pdf_draft_sha")
+    _ensure_index(cursor, "orders", "idx_pdf_final_sha", "pdf_final_sha")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            order_id VARCHAR(50) PRIMARY KEY,
+            client_name VARCHAR(255) NOT NULL,
+            user_id BIGINT NOT NULL,
+            total DECIMAL(15, 2) NOT NULL,
+            created_at DATETIME NOT NULL,
+            status VARCHAR(50),
+            pdf_draft_sha CHAR(64),
+            pdf_final_sha CHAR(64),
+            order_json TEXT,
+            approved_by BIGINT,
+            production_received_by BIGINT,
+            production_started_by BIGINT,
+            sent_to_warehouse_by BIGINT,
+            warehouse_received_by BIGINT,
+            category VARCHAR(50),
+            base_order_id VARCHAR(50),
+            archived_at DATETIME NOT NULL,
+            INDEX idx_archive_user_created (user_id, created_at),
+            INDEX idx_archive_base_order (base_order_id),
+            INDEX idx_archive_pdf_draft_sha (pdf_draft_sha),
+            INDEX idx_archive_pdf_final_sha (pdf_final_sha)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    """)
+
+
+def _m0014_orders_catalog_version(conn):
+    """Версия каталога, по ценам которой собран заказ"""
+    cursor = conn.cursor()
+    _ensure_column(cursor, "orders", "catalog_version", "VARCHAR(16) NULL")
+    _ensure_column(cursor, "orders_archive", "catalog_version", "VARCHAR(16) NULL")
+
+
+def _m0015_share_group_created_at(conn, batch_size: int = 500):
+    """Выравнивает created_at частей одного заказа по первой части.
+
+    Старый код сохранял части по одной, и их created_at расходились на
+    секунды — keyset-пагинация по (created_at, order_id) рвала такой заказ
+    между страницами. save_order_bundle пишет общий created_at.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT base_order_id, MIN(created_at) AS group_created_at
+        FROM orders
+        GROUP BY base_order_id
+        HAVING MIN(created_at) <> MAX(created_at)
+    """)
+    groups = cursor.fetchall()
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start:start + batch_size]
+        cursor.executemany(
+            "UPDATE orders SET created_at = %s WHERE base_order_id = %s",
+            [(group['group_created_at'], group['base_order_id']) for group in batch]
+        )
+        conn.commit()
+
+    if groups:
+        logger.info(f"Aligned created_at for {len(groups)} multi-part orders")
+
+
+MIGRATIONS = [
+    (1, "baseline", _m0001_baseline),
+    (2, "order_blobs", _m0002_order_blobs),
+    (3, "orders_keyset_indexes", _m0003_orders_keyset_indexes),
+    (4, "order_events", _m0004_order_events),
+    (5, "app_meta", _m0005_app_meta),
+    (6, "users_stats_rollup", _m0006_users_stats_rollup),
+    (7, "orders_base_status_indexes", _m0007_orders_base_status_indexes),
+    (8, "move_pdfs_to_blob_store", _m0008_move_pdfs_to_blob_store),
+    (9, "backfill_base_order_id", _m0009_backfill_base_order_id),
+    (10, "order_items", _m0010_order_items),
+    (11, "backfill_order_items", _m0011_backfill_order_items),
+    (12, "client_notifications_nullable_message", _m0012_client_notifications_nullable_message),
+    (13, "retention", _m0013_retention),
+    (14, "orders_catalog_version", _m0014_orders_catalog_version),
+    (15, "share_group_created_at", _m0015_share_group_created_at),
+]
+
+
+def _get_schema_version(cursor) -> int:
+    """Текущая версия схемы (0 — таблицы schema_version ещё нет)"""
+    try:
+        cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version")
+        return cursor.fetchone()['version']
+    except pymysql.err.MySQLError as e:
+        if e.args[0] == 1146:  # ER_NO_SUCH_TABLE
+            return 0
+        raise
+
+
+# Схема SQLite — сразу в состоянии последней миграции MIGRATIONS.
+# Имена индексов в SQLite общие на всю базу, поэтому с префиксом таблицы.
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username VARCHAR(255),
+        first_name VARCHAR(255),
+        last_name VARCHAR(255),
+        language VARCHAR(10) DEFAULT 'ru',
+        phone VARCHAR(50),
+        city VARCHAR(255),
+        full_name VARCHAR(255),
+        latitude DECIMAL(10, 7),
+        longitude DECIMAL(10, 7),
+        created_at DATETIME NOT NULL,
+        last_activity DATETIME
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_users_phone ON users (phone)",
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)",
+    """CREATE TABLE IF NOT EXISTS orders (
+        order_id VARCHAR(50) PRIMARY KEY,
+        client_name VARCHAR(255) NOT NULL,
+        user_id BIGINT NOT NULL,
+        total DECIMAL(15, 2) NOT NULL,
+        created_at DATETIME NOT NULL,
+        status VARCHAR(50) DEFAULT 'pending',
+        pdf_draft_sha CHAR(64),
+        pdf_final_sha CHAR(64),
+        order_json TEXT,
+        approved_by BIGINT,
+        production_received_by BIGINT,
+        production_started_by BIGINT,
+        sent_to_warehouse_by BIGINT,
+        warehouse_received_by BIGINT,
+        category VARCHAR(50),
+        base_order_id VARCHAR(50),
+        catalog_version VARCHAR(16)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_orders_base_order ON orders (base_order_id, order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_user_created_order ON orders (user_id, created_at, order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created_order ON orders (created_at, order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_status_created_order ON orders (status, created_at, order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_pdf_draft_sha ON orders (pdf_draft_sha)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_pdf_final_sha ON orders (pdf_final_sha)",
+    """CREATE TABLE IF NOT EXISTS orders_archive (
+        order_id VARCHAR(50) PRIMARY KEY,
+        client_name VARCHAR(255) NOT NULL,
+        user_id BIGINT NOT NULL,
+        total DECIMAL(15, 2) NOT NULL,
+        created_at DATETIME NOT NULL,
+        status VARCHAR(50),
+        pdf_draft_sha CHAR(64),
+        pdf_final_sha CHAR(64),
+        order_json TEXT,
+        approved_by BIGINT,
+        production_received_by BIGINT,
+        production_started_by BIGINT,
+        sent_to_warehouse_by BIGINT,
+        warehouse_received_by BIGINT,
+        category VARCHAR(50),
+        base_order_id VARCHAR(50),
+        archived_at DATETIME NOT NULL,
+        catalog_version VARCHAR(16)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_orders_archive_user_created ON orders_archive (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_archive_base_order ON orders_archive (base_order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_archive_pdf_draft_sha ON orders_archive (pdf_draft_sha)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_archive_pdf_final_sha ON orders_archive (pdf_final_sha)",
+    """CREATE TABLE IF NOT EXISTS order_blobs (
+        sha256 CHAR(64) PRIMARY KEY,
+        data BLOB NOT NULL,
+        size INT NOT NULL,
+        created_at DATETIME NOT NULL,
+        storage VARCHAR(10) NOT NULL DEFAULT 'db',
+        cold_path VARCHAR(255)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_order_blobs_storage_created ON order_blobs (storage, created_at)",
+    """CREATE TABLE IF NOT EXISTS order_events (
+        event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id VARCHAR(50) NOT NULL,
+        status VARCHAR(50) NOT NULL,
+        actor BIGINT,
+        created_at DATETIME NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events (order_id, event_id)",
+    """CREATE TABLE IF NOT EXISTS order_items (
+        order_id VARCHAR(50) NOT NULL,
+        line_no SMALLINT NOT NULL,
+        product_id BIGINT NOT NULL,
+        name VARCHAR(255),
+        qty INT NOT NULL,
+        price DECIMAL(15, 2) NOT NULL,
+        weight DECIMAL(12, 3) NOT NULL DEFAULT 0,
+        cube DECIMAL(12, 4) NOT NULL DEFAULT 0,
+        category VARCHAR(50),
+        PRIMARY KEY (order_id, line_no)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_category ON order_items (category)",
+    """CREATE TABLE IF NOT EXISTS client_notifications (
+        base_order_id VARCHAR(50) PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        message_id BIGINT,
+        created_at DATETIME NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_client_notifications_user ON client_notifications (user_id)",
+    """CREATE TABLE IF NOT EXISTS app_meta (
+        meta_key VARCHAR(100) PRIMARY KEY,
+        meta_value TEXT,
+        updated_at DATETIME NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS users_stats_rollup (
+        metric VARCHAR(32) NOT NULL,
+        dimension VARCHAR(255) NOT NULL DEFAULT '',
+        value INT NOT NULL,
+        refreshed_at DATETIME NOT NULL,
+        PRIMARY KEY (metric, dimension)
+    )""",
+    """CREATE TABLE IF NOT EXISTS schema_version (
+        version INT PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        applied_at DATETIME NOT NULL,
+        duration_ms INT NOT NULL
+    )""",
+]
+
+
+def _apply_sqlite_schema() -> int:
+    """SQLite: создаёт схему целиком (локальная база не мигрирует по шагам)"""
+    latest = MIGRATIONS[-1][0]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+        if cursor.fetchone():
+            current = _get_schema_version(cursor)
+            if current >= latest:
+                return current
+            if current:
+                raise RuntimeError(
+                    f"SQLite schema {current} is older than {latest}; delete {SQLITE_PATH} to recreate it"
+                )
+
+        started = time.monotonic()
+        for statement in SQLITE_SCHEMA:
+            cursor.execute(statement)
+        cursor.execute("""
+            INSERT INTO schema_version (version, name, applied_at, duration_ms)
+            VALUES (%s, %s, %s, %s)
+        """, (latest, "sqlite_schema", datetime.now(), int((time.monotonic() - started) * 1000)))
+        conn.commit()
+        logger.info(f"✅ SQLite schema created at {SQLITE_PATH} (version {latest})")
+    return latest
+
+
+def run_migrations() -> int:
+    """Применяет недостающие миграции под advisory-lock; возвращает версию схемы.
+
+    Если схема актуальна, DDL не выполняется вовсе — только один SELECT.
+    Блокировка GET_LOCK гарантирует, что мигрирует один экземпляр бота;
+    остальные дожидаются её и видят уже обновлённую версию.
+    """
+    if DB_BACKEND == "sqlite":
+        return _apply_sqlite_schema()
+
+    latest = MIGRATIONS[-1][0]
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        current = _get_schema_version(cursor)
+        conn.commit()  # закрываем снимок чтения перед повторной проверкой под блокировкой
+        if current >= latest:
+            return current
+
+        cursor.execute("SELECT GET_LOCK(%s, %s) AS acquired", (SCHEMA_LOCK_NAME, SCHEMA_LOCK_TIMEOUT))
+        if cursor.fetchone()['acquired'] != 1:
+            raise RuntimeError(f"Could not acquire schema migration lock in {SCHEMA_LOCK_TIMEOUT}s")
+
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    name VARCHAR(100) NOT NULL,
+                    applied_at DATETIME NOT NULL,
+                    duration_ms INT NOT NULL
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """)
+            current = _get_schema_version(cursor)
+            conn.commit()
+
+            for version, name, migration in MIGRATIONS:
+                if version <= current:
+                    continue
+
+                logger.info(f"🔧 Applying migration {version:04d}_{name}...")
+                started = time.monotonic()
+                migration(conn)
+                duration_ms = int((time.monotonic() - started) * 1000)
+
+                cursor.execute("""
+                    INSERT INTO schema_version (version, name, applied_at, duration_ms)
+                    VALUES (%s, %s, %s, %s)
+                """, (version, name, datetime.now(), duration_ms))
+                conn.commit()
+                current = version
+                logger.info(f"✅ Migration {version:04d}_{name} applied in {duration_ms} ms")
+        finally:
+            try:
+                cursor.execute("DO RELEASE_LOCK(%s)", (SCHEMA_LOCK_NAME,))
+            except pymysql.err.MySQLError:
+                pass  # соединение потеряно — сервер снимет блокировку сам
+
+    return current
+
+
+# ==================== ЗАКАЗЫ ====================
+
+@dataclass(slots=True)
+class OrderRecord:
+    """Строка заказа (без PDF); товары декодируются из order_json один раз"""
+    order_id: str
+    user_id: Optional[int] = None
+    client_name: Optional[str] = None
+    total: Any = 0
+    created_at: Optional[datetime] = None
+    status: Optional[str] = None
+    category: Optional[str] = None
+    base_order_id: Optional[str] = None
+    order_json: Optional[str] = None
+    item_count: Optional[int] = None
+    _payload: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "OrderRecord":
+        return cls(**{key: value for key, value in row.items() if key in ORDER_RECORD_FIELDS})
+
+    @property
+    def root_order_id(self) -> str:
+        """Базовый номер заказа (для мультикатегорийных заказов)"""
+        return self.base_order_id or self.order_id
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        """Декодированный order_json (кешируется на записи)"""
+        if self._payload is None:
+            try:
+                self._payload = json.loads(self.order_json) if self.order_json else {}
+            except (TypeError, ValueError):
+                logger.warning(f"Invalid order_json for order {self.order_id}")
+                self._payload = {}
+        return self._payload
+
+    @property
+    def items(self) -> List[Dict[str, Any]]:
+        return self.payload.get("items", [])
+
+
+ORDER_RECORD_FIELDS = {"order_id", "user_id", "client_name", "total", "created_at",
+                       "status", "category", "base_order_id", "order_json", "item_count"}
+
+# Проекции для разных мест вызова
+ORDER_STATUS_COLUMNS = "order_id, user_id, status, category, base_order_id"
+ORDER_HEADER_COLUMNS = "order_id, user_id, client_name, total, created_at, status, category, base_order_id"
+ORDER_FULL_COLUMNS = ORDER_HEADER_COLUMNS + ", order_json"
+# Число позиций считается по PK order_items, без разбора order_json
+ORDER_ITEM_COUNT_COLUMN = "(SELECT COUNT(*) FROM order_items i WHERE i.order_id = orders.order_id) AS item_count"
+ORDER_SUMMARY_COLUMNS = ORDER_HEADER_COLUMNS + ", " + ORDER_ITEM_COUNT_COLUMN
+
+ORDER_ITEMS_INSERT_SQL = """
+    INSERT INTO order_items (order_id, line_no, product_id, name, qty, price, weight, cube, category)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+def _order_item_rows(order_id: str, items: List[Dict[str, Any]], category: Optional[str]) -> List[tuple]:
+    """Строки order_items для executemany; категория части заказа важнее категории из каталога"""
+    rows = []
+    for line_no, item in enumerate(items, start=1):
+        try:
+            product_id = int(item.get("id", 0) or 0)
+        except (TypeError, ValueError):
+            logger.warning(f"Skipping item with invalid id {item.get('id')!r} in order {order_id}")
+            continue
+        rows.append((
             order_id,
+            line_no,
+            product_id,
+            str(item.get("name", ""))[:255],
+            int(item.get("qty", 0) or 0),
+            item.get("price", 0) or 0,
+            float(item.get("weight", 0) or 0),
+            float(item.get("cube", 0) or 0),
+            category or item.get("category"),
+        ))
+    return rows
+
+
+def save_order_bundle(base_order_id: str, client_name: str, user_id: int,
+                      parts: List[Dict[str, Any]], created_at: datetime = None,
+                      catalog_version: str = None):
+    """Сохранение всех частей заказа одной транзакцией.
+
+    parts — список {"order_id", "category", "total", "items"}. Части, их товары,
+    события «pending» и строка client_notifications вставляются пакетно и
+    коммитятся вместе, до генерации PDF: сбой на рендере или FTP не оставит
+    половину заказа. PDF прикрепляются потом через attach_order_draft_pdf.
+    catalog_version — версия каталога, по ценам которой собран заказ.
+    """
+    if not parts:
+        raise ValidationError(f"Order {base_order_id} has no parts to save")
+
+    # Секундная точность на обоих бэкендах (MySQL иначе округлил бы доли секунды)
+    created_at = (created_at or datetime.now()).replace(microsecond=0)
+    order_rows = []
+    item_rows = []
+    event_rows = []
+    for part in parts:
+        order_rows.append((
+            part["order_id"],
             client_name,
             user_id,
-            total,
-            datetime.now(),
+            part["total"],
+            created_at,
             OrderStatus.PENDING,
-            pdf_draft,
-            json.dumps(order_json, ensure_ascii=False),
-            category,
-            base_order_id
+            json.dumps({"items": part["items"], "total": part["total"]}, ensure_ascii=False),
+            part["category"],
+            base_order_id,
+            catalog_version
         ))
+        item_rows.extend(_order_item_rows(part["order_id"], part["items"], part["category"]))
+        event_rows.append((part["order_id"], OrderStatus.PENDING, user_id, created_at))
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO orders 
+            (order_id, client_name, user_id, total, created_at, status, order_json, category, base_order_id,
+             catalog_version)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, order_rows)
+        if item_rows:
+            cursor.executemany(ORDER_ITEMS_INSERT_SQL, item_rows)
+        cursor.executemany("""
+            INSERT INTO order_events (order_id, status, actor, created_at)
+            VALUES (%s, %s, %s, %s)
+        """, event_rows)
+        # message_id проставит первое уведомление клиенту о статусе
+        cursor.execute(
+            sql_upsert("client_notifications", ["base_order_id", "user_id", "message_id", "created_at"],
+                       ["base_order_id"], update=["user_id"]),
+            (base_order_id, user_id, None, created_at)
+        )
         conn.commit()
 
 
-def update_order_status(order_id: str, new_status: str, pdf_final: bytes = None, updated_by: int = None):
-    """Обновление статуса заказа"""
+def attach_order_draft_pdf(order_id: str, pdf: bytes):
+    """Прикрепляет PDF-черновик к уже сохранённому заказу"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        sha = _store_blob(cursor, pdf)
+        cursor.execute("UPDATE orders SET pdf_draft_sha = %s WHERE order_id = %s", (sha, order_id))
+        conn.commit()
+
+
+def _record_order_event(cursor, order_id: str, status: str, actor: Optional[int]):
+    """Добавляет запись в историю статусов (в текущей транзакции)"""
+    cursor.execute("""
+        INSERT INTO order_events (order_id, status, actor, created_at)
+        VALUES (%s, %s, %s, %s)
+    """, (order_id, status, actor, datetime.now()))
+
+
+# Колонка с ID администратора для каждого статуса
+STATUS_ACTOR_FIELDS = {
+    OrderStatus.APPROVED: "approved_by",
+    OrderStatus.PRODUCTION_RECEIVED: "production_received_by",
+    OrderStatus.PRODUCTION_STARTED: "production_started_by",
+    OrderStatus.SENT_TO_WAREHOUSE: "sent_to_warehouse_by",
+    OrderStatus.WAREHOUSE_RECEIVED: "warehouse_received_by"
+}
+
+
+def update_order_status(order_id: str, new_status: str, updated_by: int = None,
+                        pdf_final: Optional[bytes] = None) -> bool:
+    """Атомарный переход статуса (compare-and-set).
+
+    Возвращает False, если заказ уже не в ожидаемом статусе — например,
+    его обработал другой администратор. Если передан pdf_final, он
+    сохраняется в той же транзакции, что и переход.
+    """
+    expected = get_previous_statuses(new_status)
+    if not expected:
+        raise ValueError(f"No transition leads to status {new_status}")
+
+    assignments = ["status = %s"]
+    params: List[Any] = [new_status]
+
+    field_name = STATUS_ACTOR_FIELDS.get(new_status)
+    if updated_by and field_name:
+        assignments.append(f"{field_name} = %s")
+        params.append(updated_by)
+
+    placeholders = ", ".join(["%s"] * len(expected))
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if pdf_final is not None:
+            assignments.append("pdf_final_sha = %s")
+            params.append(_store_blob(cursor, pdf_final))
+        params.append(order_id)
+        params.extend(expected)
+
+        cursor.execute(f"""
+            UPDATE orders 
+            SET {", ".join(assignments)}
+            WHERE order_id = %s AND status IN ({placeholders})
+        """, params, name="orders.status_cas")
+        changed = cursor.rowcount == 1
+        if changed:
+            _record_order_event(cursor, order_id, new_status, updated_by)
+            conn.commit()
+        else:
+            conn.rollback()
+
+    if not changed:
+        logger.info(f"Order {order_id}: transition to {new_status} lost (expected {expected})")
+    return changed
+
+
+def _fetch_order(columns: str, order_id: str, name: str) -> Optional[OrderRecord]:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {columns} FROM orders WHERE order_id = %s", (order_id,), name=name)
+        row = cursor.fetchone()
+        return OrderRecord.from_row(row) if row else None
+
+
+def get_order_status(order_id: str) -> Optional[OrderRecord]:
+    """Статус, категория и владелец заказа — для переходов статусов"""
+    return _fetch_order(ORDER_STATUS_COLUMNS, order_id, "orders.get_status")
+
+
+def get_order_header(order_id: str) -> Optional[OrderRecord]:
+    """Шапка заказа (клиент, сумма, дата) без товаров"""
+    return _fetch_order(ORDER_HEADER_COLUMNS, order_id, "orders.get_header")
+
+
+def get_order_summary(order_id: str) -> Optional[OrderRecord]:
+    """Шапка заказа и число позиций (из order_items)"""
+    return _fetch_order(ORDER_SUMMARY_COLUMNS, order_id, "orders.get_summary")
+
+
+def get_order_record(order_id: str) -> Optional[OrderRecord]:
+    """Полный заказ вместе с товарами"""
+    return _fetch_order(ORDER_FULL_COLUMNS, order_id, "orders.get_full")
+
+
+def get_top_products(days: int = 7, limit: int = 10) -> List[Dict[str, Any]]:
+    """Самые заказываемые товары за период (агрегация по order_items)"""
+    with get_db_connection(ROUTE_REPORTING) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT i.product_id, MAX(i.name) AS name, SUM(i.qty) AS qty,
+                   SUM(i.qty * i.price) AS amount, SUM(i.qty * i.cube) AS cube
+            FROM orders o
+            JOIN order_items i ON i.order_id = o.order_id
+            WHERE o.created_at >= %s
+            GROUP BY i.product_id
+            ORDER BY qty DESC
+            LIMIT %s
+        """, (datetime.now() - timedelta(days=days), limit))
+        return cursor.fetchall()
+
+
+# ==================== ПРОВЕРКА ПЛАНОВ ЗАПРОСОВ ====================
+
+# (название, SQL, параметры, ожидаемый индекс) — горячие запросы бота
+QUERY_PLAN_CHECKS = [
+    ("orders_by_base_id",
+     f"SELECT {ORDER_HEADER_COLUMNS} FROM orders WHERE base_order_id = %s ORDER BY order_id",
+     ("sample_base",), "idx_base_order"),
+    ("my_orders_page",
+     f"SELECT {ORDER_HEADER_COLUMNS} FROM orders WHERE user_id = %s "
+     "ORDER BY created_at DESC, order_id DESC LIMIT 30",
+     (0,), "idx_user_created_order"),
+    ("admin_orders_page",
+     f"SELECT {ORDER_HEADER_COLUMNS} FROM orders "
+     "WHERE (created_at < %s OR (created_at = %s AND order_id < %s)) "
+     "ORDER BY created_at DESC, order_id DESC LIMIT 30",
+     (datetime(2100, 1, 1), datetime(2100, 1, 1), ""), "idx_created_order"),
+    ("orders_export_by_status",
+     "SELECT order_id FROM orders WHERE status = %s AND created_at >= %s ORDER BY created_at, order_id",
+     (OrderStatus.PENDING, datetime(2000, 1, 1)), "idx_status_created_order"),
+    ("order_events_by_order",
+     "SELECT status, actor, created_at FROM order_events WHERE order_id = %s ORDER BY event_id",
+     ("sample_order",), "idx_order_events_order"),
+    ("users_active_since",
+     "SELECT COUNT(*) FROM users WHERE last_activity >= %s",
+     (datetime(2100, 1, 1),), "idx_last_activity"),
+]
+
+
+def check_query_plans() -> bool:
+    """EXPLAIN горячих запросов: каждый должен идти по ожидаемому индексу.
+
+    Запуск: python main.py --explain-check (нужна доступная MySQL/MariaDB).
+    На почти пустых таблицах оптимизатор может предпочесть полный скан —
+    проверяйте на базе с реальным объёмом данных.
+    """
+    if DB_BACKEND != "mysql":
+        logger.warning("⚠️ EXPLAIN check is only available for the MySQL backend")
+        return True
+
+    ok = True
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for name, sql, params, expected_key in QUERY_PLAN_CHECKS:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            plan = cursor.fetchall()
+            first = plan[0] if plan else {}
+            key = first.get("key")
+            extra = first.get("Extra") or ""
+
+            if key == expected_key:
+                verdict = "OK"
+            elif key is None and "Impossible WHERE" in extra:
+                verdict = "SKIP"  # оптимизатор отбросил запрос по константам
+            else:
+                verdict = "FAIL"
+                ok = False
+
+            logger.info(
+                f"{'✅' if verdict == 'OK' else '⚠️' if verdict == 'SKIP' else '❌'} "
+                f"{name}: type={first.get('type')} key={key} (expected {expected_key}) "
+                f"rows={first.get('rows')} extra={extra}"
+            )
+    return ok
+
+
+# ==================== ЭКСПОРТ ЗАКАЗОВ ====================
+
+# Лимит Telegram на документ от бота — 50 МБ; оставляем запас
+EXPORT_PART_MAX_BYTES = int(os.getenv("EXPORT_PART_MAX_MB", "45")) * 1024 * 1024
+# Как часто сверяем размер архива (в строках): сброс сжатия на каждой строке дорогой
+EXPORT_SIZE_CHECK_ROWS = 200
+EXPORT_SIZE_MARGIN_BYTES = 1024 * 1024
+EXPORT_COLUMNS = ["order_id", "base_order_id", "client_name", "user_id", "category", "total", "created_at", "status"]
+
+
+class _ExportPart:
+    """Один gzip-файл экспорта на диске"""
+
+    def __init__(self, index: int):
+        fd, self.path = tempfile.mkstemp(prefix=f"orders_export_{index}_", suffix=".csv.gz")
+        self.raw = os.fdopen(fd, "wb")
+        self.gzip = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        self.text = io.TextIOWrapper(self.gzip, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.text, delimiter=";")
+        self.writer.writerow(EXPORT_COLUMNS)
+        self.rows = 0
+        self.checked_size = 0
+
+    def compressed_size(self) -> int:
+        """Размер архива с учётом всего, что ещё лежит в буферах.
+
+        Текст, буфер GzipFile и внутреннее состояние zlib сбрасываются
+        (Z_SYNC_FLUSH — словарь сохраняется, сжатие почти не страдает).
+        """
+        self.text.flush()
+        self.gzip.flush(zlib.Z_SYNC_FLUSH)
+        return self.raw.tell()
+
+    def is_near_limit(self, max_bytes: int) -> bool:
+        """Пора ли закрывать часть: запас — не меньше удвоенного прироста за интервал проверки"""
+        size = self.compressed_size()
+        margin = max(EXPORT_SIZE_MARGIN_BYTES, 2 * (size - self.checked_size))
+        self.checked_size = size
+        return size + margin >= max_bytes
+
+    def close(self):
+        self.text.close()  # закрывает gzip, дописывая хвост архива
+        self.raw.close()
+
+
+def export_orders_to_files(
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        status: Optional[str] = None,
+        max_part_bytes: int = EXPORT_PART_MAX_BYTES
+) -> List[Dict[str, Any]]:
+    """Потоковый экспорт заказов в gzip-CSV (выполняется в рабочем потоке).
+
+    Строки читаются серверным курсором (SSCursor) без PDF и без order_json,
+    поэтому память не растёт с числом заказов. Если архив приближается к
+    лимиту Telegram, начинается следующая часть.
+    """
+    conditions = []
+    params: List[Any] = []
+    if date_from:
+        conditions.append("created_at >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append("created_at < %s")
+        params.append(date_to)
+    if status:
+        conditions.append("status = %s")
+        params.append(status)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    parts: List[_ExportPart] = []
+    try:
+        with get_db_connection(ROUTE_REPORTING) as conn:
+            cursor = conn.cursor(pymysql.cursors.SSCursor)
+            try:
+                cursor.execute(f"""
+                    SELECT {", ".join(EXPORT_COLUMNS)}
+                    FROM orders
+                    {where}
+                    ORDER BY created_at, order_id
+                """, params, name="orders.export")
+
+                part = None
+                for row in cursor:
+                    if part is None:
+                        part = _ExportPart(len(parts) + 1)
+                        parts.append(part)
+                    part.writer.writerow(["" if value is None else value for value in row])
+                    part.rows += 1
+
+                    if part.rows % EXPORT_SIZE_CHECK_ROWS == 0 and part.is_near_limit(max_part_bytes):
+                        part.close()
+                        part = None
+            finally:
+                cursor.close()
+
+        for part in parts:
+            if not part.raw.closed:
+                part.close()
+    except Exception:
+        for part in parts:
+            try:
+                part.close()
+            except Exception:
+                pass
+            if os.path.exists(part.path):
+                os.remove(part.path)
+        raise
+
+    return [{"path": part.path, "rows": part.rows} for part in parts]
+
+
+def parse_export_filters(args: List[str]) -> Dict[str, Any]:
+    """Разбор аргументов /orders_export: [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [статус]"""
+    dates = []
+    status = None
+    for arg in args:
+        if arg in ORDER_STATUS_TRANSITIONS:
+            status = arg
+            continue
+        try:
+            dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+        except ValueError:
+            raise ValidationError(f"Неизвестный аргумент: {arg}")
+
+    if len(dates) > 2:
+        raise ValidationError("Укажите не больше двух дат")
+
+    date_from = dates[0] if dates else None
+    # Дата «по» включительно
+    date_to = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+    return {"date_from": date_from, "date_to": date_to, "status": status}
+
+
+# ==================== ХРАНЕНИЕ И АРХИВ ====================
+#
+# Фоновая задача небольшими пачками (каждая — отдельная короткая транзакция):
+#   1. у заказов с финальным PDF отвязывается черновик;
+#   2. завершённые заказы старше ORDER_ARCHIVE_AFTER_DAYS переносятся в orders_archive
+#      (их order_items и order_events удаляются);
+#   3. PDF, на которые больше не ссылается ни один заказ, удаляются;
+#   4. PDF старше PDF_COLD_AFTER_DAYS переносятся из базы в файлы PDF_COLD_DIR.
+
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))  # сек
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "200"))
+RETENTION_COLD_BATCH_SIZE = int(os.getenv("RETENTION_COLD_BATCH_SIZE", "20"))  # PDF читаются целиком
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", "50"))  # за один проход, на политику
+PDF_COLD_AFTER_DAYS = int(os.getenv("PDF_COLD_AFTER_DAYS", "0"))  # 0 — не переносить
+ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv("ORDER_ARCHIVE_AFTER_DAYS", "365"))  # 0 — не архивировать
+BLOB_GC_GRACE_HOURS = int(os.getenv("BLOB_GC_GRACE_HOURS", "24"))
+
+# Рабочий каталог хостинга теряется при редеплое, а PDF после переноса из базы
+# удаляются — поэтому перенос включается только с явным абсолютным PDF_COLD_DIR
+if PDF_COLD_AFTER_DAYS and not os.path.isabs(PDF_COLD_DIR):
+    raise RuntimeError("❌ PDF_COLD_AFTER_DAYS требует PDF_COLD_DIR — абсолютный путь к постоянному тому")
+
+# Статусы, из которых нет переходов, — заказ завершён
+ORDER_FINAL_STATUSES = sorted(status for status, allowed in ORDER_STATUS_TRANSITIONS.items() if not allowed)
+
+ORDER_ARCHIVE_COLUMNS = [
+    "order_id", "client_name", "user_id", "total", "created_at", "status",
+    "pdf_draft_sha", "pdf_final_sha", "order_json", "approved_by",
+    "production_received_by", "production_started_by", "sent_to_warehouse_by",
+    "warehouse_received_by", "category", "base_order_id", "catalog_version",
+]
+
+BLOB_UNREFERENCED_SQL = """
+    NOT EXISTS (SELECT 1 FROM orders o WHERE o.pdf_draft_sha = order_blobs.sha256)
+    AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.pdf_final_sha = order_blobs.sha256)
+    AND NOT EXISTS (SELECT 1 FROM orders_archive a WHERE a.pdf_draft_sha = order_blobs.sha256)
+    AND NOT EXISTS (SELECT 1 FROM orders_archive a WHERE a.pdf_final_sha = order_blobs.sha256)
+"""
+
+
+def _in_clause(values: List[Any]) -> str:
+    return ", ".join(["%s"] * len(values))
 
-        # Определяем, какое поле обновлять
-        field_map = {
-            OrderStatus.APPROVED: "approved_by",
-            OrderStatus.PRODUCTION_RECEIVED: "production_received_by",
-            OrderStatus.PRODUCTION_STARTED: "production_started_by",
-            OrderStatus.SENT_TO_WAREHOUSE: "sent_to_warehouse_by",
-            OrderStatus.WAREHOUSE_RECEIVED: "warehouse_received_by"
-        }
 
-        if pdf_final:
+def retention_drop_drafts(batch_size: int = RETENTION_BATCH_SIZE) -> int:
+    """Отвязывает черновой PDF у заказов, для которых уже есть финальный"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT order_id FROM orders
+            WHERE pdf_draft_sha IS NOT NULL AND pdf_final_sha IS NOT NULL
+            LIMIT %s
+        """, (batch_size,), name="orders.retention_drafts")
+        order_ids = [row['order_id'] for row in cursor.fetchall()]
+        if not order_ids:
+            return 0
+
+        cursor.execute(f"""
+            UPDATE orders SET pdf_draft_sha = NULL
+            WHERE order_id IN ({_in_clause(order_ids)}) AND pdf_final_sha IS NOT NULL
+        """, order_ids, name="orders.retention_drop_drafts")
+        conn.commit()
+        return len(order_ids)
+
+
+def retention_move_cold_blobs(days: int = PDF_COLD_AFTER_DAYS,
+                              batch_size: int = RETENTION_COLD_BATCH_SIZE) -> int:
+    """Переносит старые PDF из order_blobs в файлы; в базе остаётся cold_path"""
+    cutoff = datetime.now() - timedelta(days=days)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT sha256, data FROM order_blobs
+            WHERE storage = 'db' AND created_at < %s
+            LIMIT %s
+        """, (cutoff, batch_size), name="order_blobs.retention_cold")
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        for row in rows:
+            rel_path = _cold_blob_path(row['sha256'])
+            # Сначала файл, потом ссылка: при сбое между ними остаётся лишний файл, но не битая ссылка
+            _atomic_write(os.path.join(PDF_COLD_DIR, rel_path), bytes(row['data']))
+            cursor.execute("""
+                UPDATE order_blobs SET storage = 'file', cold_path = %s, data = %s
+                WHERE sha256 = %s AND storage = 'db'
+            """, (rel_path, b"", row['sha256']), name="order_blobs.retention_mark_cold")
+        conn.commit()
+        return len(rows)
+
+
+def retention_gc_blobs(grace_hours: int = BLOB_GC_GRACE_HOURS,
+                       batch_size: int = RETENTION_BATCH_SIZE) -> int:
+    """Удаляет PDF, на которые не ссылается ни один заказ (в том числе архивный).
+
+    Свежие PDF (моложе grace_hours) не трогаем: заказ мог быть ещё не записан.
+    """
+    cutoff = datetime.now() - timedelta(hours=grace_hours)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT sha256, storage, cold_path FROM order_blobs
+            WHERE created_at < %s AND {BLOB_UNREFERENCED_SQL}
+            LIMIT %s
+        """, (cutoff, batch_size), name="order_blobs.retention_unreferenced")
+        candidates = cursor.fetchall()
+        if not candidates:
+            return 0
+
+        shas = [row['sha256'] for row in candidates]
+        # Условия повторяются в DELETE: PDF мог снова понадобиться после SELECT
+        # (_store_blob при повторном использовании обновляет created_at)
+        cursor.execute(f"""
+            DELETE FROM order_blobs
+            WHERE sha256 IN ({_in_clause(shas)}) AND created_at < %s AND {BLOB_UNREFERENCED_SQL}
+        """, shas + [cutoff], name="order_blobs.retention_delete")
+        deleted = cursor.rowcount
+
+        cursor.execute(f"SELECT sha256 FROM order_blobs WHERE sha256 IN ({_in_clause(shas)})", shas)
+        kept = {row['sha256'] for row in cursor.fetchall()}
+        conn.commit()
+
+    for row in candidates:
+        if row['storage'] == 'file' and row['sha256'] not in kept:
+            try:
+                os.remove(os.path.join(PDF_COLD_DIR, row['cold_path']))
+            except FileNotFoundError:
+                pass
+    return deleted
+
+
+def retention_archive_orders(days: int = ORDER_ARCHIVE_AFTER_DAYS,
+                             batch_size: int = RETENTION_BATCH_SIZE,
+                             after: Optional[tuple] = None) -> tuple:
+    """Переносит в orders_archive одну пачку завершённых заказов.
+
+    Пачка — не больше batch_size строк orders с created_at < cutoff
+    по индексу (created_at, order_id), после курсора after. Заказ
+    переносится целиком (все части base_order_id), только когда каждая
+    часть в финальном статусе и старше days дней.
+
+    Возвращает (перенесено заказов, курсор следующей пачки или None).
+    """
+    cutoff = datetime.now() - timedelta(days=days)
+    columns = ", ".join(ORDER_ARCHIVE_COLUMNS)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if after is None:
             cursor.execute("""
-                UPDATE orders 
-                SET status = %s, pdf_final = %s
-                WHERE order_id = %s
-            """, (new_status, pdf_final, order_id))
+                SELECT created_at, order_id, base_order_id FROM orders
+                WHERE created_at < %s
+                ORDER BY created_at, order_id
+                LIMIT %s
+            """, (cutoff, batch_size), name="orders.retention_scan")
         else:
             cursor.execute("""
-                UPDATE orders 
-                SET status = %s
-                WHERE order_id = %s
-            """, (new_status, order_id))
+                SELECT created_at, order_id, base_order_id FROM orders
+                WHERE created_at < %s
+                  AND (created_at > %s OR (created_at = %s AND order_id > %s))
+                ORDER BY created_at, order_id
+                LIMIT %s
+            """, (cutoff, after[0], after[0], after[1], batch_size), name="orders.retention_scan")
+        rows = cursor.fetchall()
+        if not rows:
+            return 0, None
+        next_after = (rows[-1]['created_at'], rows[-1]['order_id']) if len(rows) == batch_size else None
+
+        candidates = sorted({row['base_order_id'] for row in rows if row['base_order_id']})
+        if not candidates:
+            return 0, next_after
+        # Проверяем заказы целиком, но только найденные в пачке — по индексу (base_order_id, order_id)
+        cursor.execute(f"""
+            SELECT base_order_id FROM orders
+            WHERE base_order_id IN ({_in_clause(candidates)})
+            GROUP BY base_order_id
+            HAVING MAX(created_at) < %s
+               AND SUM(CASE WHEN status IN ({_in_clause(ORDER_FINAL_STATUSES)}) THEN 0 ELSE 1 END) = 0
+        """, (*candidates, cutoff, *ORDER_FINAL_STATUSES), name="orders.retention_archivable")
+        base_ids = [row['base_order_id'] for row in cursor.fetchall()]
+        if not base_ids:
+            return 0, next_after
+
+        placeholders = _in_clause(base_ids)
+        cursor.execute(f"""
+            INSERT INTO orders_archive ({columns}, archived_at)
+            SELECT {columns}, %s FROM orders WHERE base_order_id IN ({placeholders})
+        """, (datetime.now(), *base_ids), name="orders_archive.insert")
+        cursor.execute(
+            f"DELETE FROM orders WHERE base_order_id IN ({placeholders})", base_ids,
+            name="orders.retention_delete"
+        )
+        cursor.execute(
+            f"DELETE FROM client_notifications WHERE base_order_id IN ({placeholders})", base_ids,
+            name="client_notifications.retention_delete"
+        )
+        # Товары и история статусов без заказа не нужны: позиции остаются в order_json архива
+        cursor.execute(f"""
+            DELETE FROM order_items WHERE order_id IN (
+                SELECT order_id FROM orders_archive WHERE base_order_id IN ({placeholders})
+            )
+        """, base_ids, name="order_items.retention_delete")
+        cursor.execute(f"""
+            DELETE FROM order_events WHERE order_id IN (
+                SELECT order_id FROM orders_archive WHERE base_order_id IN ({placeholders})
+            )
+        """, base_ids, name="order_events.retention_delete")
+        conn.commit()
+        return len(base_ids), next_after
+
+
+def _run_retention_policy(name: str, func: Callable[..., int], batch_size: int, *args) -> int:
+    """Повторяет политику пачками, пока пачки полные (не больше RETENTION_MAX_BATCHES)"""
+    total = 0
+    for _ in range(RETENTION_MAX_BATCHES):
+        count = func(*args, batch_size=batch_size)
+        total += count
+        if count < batch_size:
+            break
+        time.sleep(0.05)  # даём дорогу рабочей нагрузке между пачками
+    if total:
+        logger.info(f"🧹 Retention {name}: {total}")
+    return total
+
+
+def _run_archive_policy(days: int) -> int:
+    """Архивация пачками по курсору, пока не пройден весь диапазон created_at < cutoff"""
+    total = 0
+    after = None
+    for _ in range(RETENTION_MAX_BATCHES):
+        archived, after = retention_archive_orders(days, RETENTION_BATCH_SIZE, after)
+        total += archived
+        if after is None:
+            break
+        time.sleep(0.05)  # даём дорогу рабочей нагрузке между пачками
+    if total:
+        logger.info(f"🧹 Retention orders_archived: {total}")
+    return total
+
+
+def run_retention() -> Dict[str, int]:
+    """Один проход всех политик хранения (вызывается периодически из фона)"""
+    result = {
+        "drafts_dropped": _run_retention_policy("drafts_dropped", retention_drop_drafts, RETENTION_BATCH_SIZE),
+        "orders_archived": 0,
+        "blobs_cold": 0,
+    }
+    if ORDER_ARCHIVE_AFTER_DAYS:
+        result["orders_archived"] = _run_archive_policy(ORDER_ARCHIVE_AFTER_DAYS)
+    # Сначала удаляем ненужные PDF, чтобы не переносить их в файлы
+    result["blobs_deleted"] = _run_retention_policy(
+        "blobs_deleted", retention_gc_blobs, RETENTION_BATCH_SIZE, BLOB_GC_GRACE_HOURS
+    )
+    if PDF_COLD_AFTER_DAYS:
+        result["blobs_cold"] = _run_retention_policy(
+            "blobs_cold", retention_move_cold_blobs, RETENTION_COLD_BATCH_SIZE, PDF_COLD_AFTER_DAYS
+        )
+    return result
 
-        # Обновляем поле с ID администратора
-        if updated_by and new_status in field_map:
-            field_name = field_map[new_status]
-            cursor.execute(f"""
-                UPDATE orders 
-                SET {field_name} = %s
-                WHERE order_id = %s
-            """, (updated_by, order_id))
 
-        conn.commit()
+# ==================== ПАГИНАЦИЯ ЗАКАЗОВ ====================
 
+ORDERS_PAGE_SIZE = 5
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S"
 
-def get_order_raw(order_id: str) -> Optional[Dict[str, Any]]:
-    """Получение сырых данных заказа"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM orders WHERE order_id = %s", (order_id,))
-        row = cursor.fetchone()
-        if row:
-            return dict(row)
-        return None
 
+def encode_order_cursor(order: OrderRecord) -> str:
+    """Курсор страницы: время создания + order_id строки-границы"""
+    created_at = order.created_at if isinstance(order.created_at, datetime) else datetime.now()
+    return f"{created_at.strftime(CURSOR_TIME_FORMAT)}:{order.order_id}"
 
-def get_order_for_user(order_id: str, user_id: int) -> Optional[Dict[str, Any]]:
-    """Получение заказа для конкретного пользователя"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM orders WHERE order_id = %s AND user_id = %s", (order_id, user_id))
-        row = cursor.fetchone()
-        if row:
-            return dict(row)
+
+def decode_order_cursor(value: str) -> Optional[tuple]:
+    try:
+        ts, order_id = value.split(":", 1)
+        return datetime.strptime(ts, CURSOR_TIME_FORMAT), order_id
+    except ValueError:
         return None
 
 
-def get_all_orders(limit: int = 100) -> List[Dict[str, Any]]:
-    """Получение всех заказов"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM orders ORDER BY created_at DESC LIMIT %s", (limit,))
-        return [dict(row) for row in cursor.fetchall()]
+def get_order_groups_page(
+        user_id: Optional[int] = None,
+        cursor: Optional[tuple] = None,
+        direction: str = "next",
+        page_size: int = ORDERS_PAGE_SIZE
+) -> Dict[str, Any]:
+    """Keyset-страница заказов, сгруппированных по base_order_id.
 
+    Курсор — (created_at, order_id) граничной строки; "next" идёт к более
+    старым заказам, "prev" — к более новым. Стоимость не зависит от глубины
+    страницы: индексы (user_id, created_at, order_id) / (created_at, order_id).
 
-def get_user_orders(user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
-    """Получение заказов пользователя"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM orders 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
+    Группировка опирается на то, что все части заказа имеют общий
+    created_at: так пишет save_order_bundle, а старые заказы выровнены
+    миграцией 15. Тогда части идут подряд и не рвутся между страницами.
+    """
+    conditions = []
+    params: List[Any] = []
+
+    if user_id is not None:
+        conditions.append("user_id = %s")
+        params.append(user_id)
+
+    if cursor:
+        ts, order_id = cursor
+        op = "<" if direction == "next" else ">"
+        conditions.append(f"(created_at {op} %s OR (created_at = %s AND order_id {op} %s))")
+        params.extend([ts, ts, order_id])
+
+    sort = "DESC" if direction == "next" else "ASC"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # Части одного заказа идут подряд; берём строк на page_size + 1 полных групп
+    params.append((page_size + 1) * len(CATEGORY_NAMES))
+
+    # Общий список — с реплики; «Мои заказы» — с primary, чтобы клиент сразу видел новый заказ
+    route = ROUTE_PRIMARY if user_id is not None else ROUTE_REPORTING
+    with get_db_connection(route) as conn:
+        db_cursor = conn.cursor()
+        db_cursor.execute(f"""
+            SELECT {ORDER_HEADER_COLUMNS}
+            FROM orders
+            {where}
+            ORDER BY created_at {sort}, order_id {sort}
             LIMIT %s
-        """, (user_id, limit))
-        return [dict(row) for row in cursor.fetchall()]
+        """, params, name="orders.page")
+        rows = [OrderRecord.from_row(row) for row in db_cursor.fetchall()]
+
+    groups: Dict[str, List[OrderRecord]] = {}
+    for order in rows:
+        groups.setdefault(order.root_order_id, []).append(order)
+
+    group_list = list(groups.values())
+    has_more = len(group_list) > page_size
+    page = group_list[:page_size]
+
+    if direction != "next":
+        # Для "prev" читали в обратном порядке — разворачиваем к показу (новые сверху)
+        page = [list(reversed(group)) for group in reversed(page)]
+
+    return {
+        "groups": page,
+        "has_next": has_more if direction == "next" else True,
+        "has_prev": (cursor is not None) if direction == "next" else has_more,
+        "next_cursor": encode_order_cursor(page[-1][-1]) if page else None,
+        "prev_cursor": encode_order_cursor(page[0][0]) if page else None,
+    }
+
 
+def build_orders_page_keyboard(prefix: str, page: Dict[str, Any], lang: str = "ru") -> Optional[InlineKeyboardMarkup]:
+    """Кнопки «назад/вперёд»; курсор передаётся в callback_data"""
+    buttons = []
+    if page["has_prev"] and page["prev_cursor"]:
+        data = f"{prefix}:p:{page['prev_cursor']}"
+        if len(data) <= 64:
+            buttons.append(InlineKeyboardButton(text="⬅️ Новее" if lang == "ru" else "⬅️ Yangiroq", callback_data=data))
+    if page["has_next"] and page["next_cursor"]:
+        data = f"{prefix}:n:{page['next_cursor']}"
+        if len(data) <= 64:
+            buttons.append(InlineKeyboardButton(text="Старее ➡️" if lang == "ru" else "Eskiroq ➡️", callback_data=data))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+def format_order_groups(groups: List[List[OrderRecord]], lang: str = "ru", with_client: bool = False) -> str:
+    """Текст страницы заказов: одна запись на базовый заказ"""
+    status_names = STATUS_NAMES_RU if lang == "ru" else STATUS_NAMES_UZ
+    text = ""
+    for parts in groups:
+        first = parts[0]
+        created_at = first.created_at
+        text += f"№{first.root_order_id}\n"
+        if with_client:
+            text += f"👤 {first.client_name} (ID: {first.user_id})\n"
+        text += f"💰 {format_currency(sum(part.total or 0 for part in parts))}\n"
+        text += f"📅 {created_at.strftime('%Y-%m-%d') if isinstance(created_at, datetime) else str(created_at)[:10]}\n"
+        if len(parts) == 1:
+            text += f"📊 {status_names.get(first.status, first.status)}\n\n"
+        else:
+            for part in parts:
+                text += f"{get_category_emoji(part.category)} {status_names.get(part.status, part.status)}\n"
+            text += "\n"
+    return text
 
-def get_orders_by_base_id(base_order_id: str) -> List[Dict[str, Any]]:
+
+def get_orders_by_base_id(base_order_id: str, with_item_counts: bool = False) -> List[OrderRecord]:
     """Получение всех под-заказов по базовому ID"""
+    columns = ORDER_SUMMARY_COLUMNS if with_item_counts else ORDER_HEADER_COLUMNS
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM orders 
-            WHERE base_order_id = %s OR order_id = %s
+        cursor.execute(f"""
+            SELECT {columns}
+            FROM orders 
+            WHERE base_order_id = %s
             ORDER BY order_id
-        """, (base_order_id, base_order_id))
-        return [dict(row) for row in cursor.fetchall()]
+        """, (base_order_id,), name="orders.by_base_id")
+        return [OrderRecord.from_row(row) for row in cursor.fetchall()]
 
 
 def save_client_notification(base_order_id: str, user_id: int, message_id: int):
     """Сохранение ID сообщения клиенту"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO client_notifications 
-            (base_order_id, user_id, message_id, created_at)
-            VALUES (%s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE 
-                message_id = VALUES(message_id),
-                created_at = VALUES(created_at)
-        """, (base_order_id, user_id, message_id, datetime.now()))
+        cursor.execute(
+            sql_upsert("client_notifications", ["base_order_id", "user_id", "message_id", "created_at"],
+                       ["base_order_id"], update=["message_id", "created_at"]),
+            (base_order_id, user_id, message_id, datetime.now())
+        )
         conn.commit()
 
 
@@ -1053,11 +3757,144 @@ def get_client_notification(base_order_id: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+# ==================== ИСТОРИЯ ЗАКАЗА (CAPTION) ====================
+
+ADMIN_CAPTION_LIMIT = 1024  # лимит Telegram на подпись к документу
+CAPTION_DIVIDER = "━━━━━━━━━━━━━━━━━━━━━━"
+
+# Строка статуса в шапке админ-сообщения
+ADMIN_STATUS_LINES = {
+    OrderStatus.PENDING: "⏳ Ожидает одобрения",
+    OrderStatus.APPROVED: "✅ Одобрен",
+    OrderStatus.REJECTED: "❌ Отклонён",
+    OrderStatus.PRODUCTION_RECEIVED: "📋 Получен производством",
+    OrderStatus.PRODUCTION_STARTED: "🏭 Производство начато",
+    OrderStatus.SENT_TO_WAREHOUSE: "📦 Передано на склад",
+    OrderStatus.WAREHOUSE_RECEIVED: "✅ Получено складом (ГОТОВО)",
+}
+
+# Подписи событий в истории действий
+ORDER_EVENT_LABELS = {
+    OrderStatus.APPROVED: "✅ Одобрен",
+    OrderStatus.REJECTED: "❌ Отклонён",
+    OrderStatus.PRODUCTION_RECEIVED: "📋 Получено производством",
+    OrderStatus.PRODUCTION_STARTED: "🏭 Производство начато",
+    OrderStatus.SENT_TO_WAREHOUSE: "📦 Передано на склад",
+    OrderStatus.WAREHOUSE_RECEIVED: "✅ Получено складом",
+}
+
+
+def format_admin_caption(
+        order: OrderRecord,
+        part_num: int,
+        parts_total: int,
+        order_sum: Any,
+        category_item_count: int,
+        order_item_count: int,
+        profile: Dict[str, Any],
+        events: List[Dict[str, Any]]
+) -> str:
+    """Caption админ-сообщения: шапка заказа + история действий из order_events"""
+    latitude = profile.get("latitude")
+    longitude = profile.get("longitude")
+    location_text = ""
+    if latitude is not None and longitude is not None:
+        location_text = f"📍 Координаты: {float(latitude):.6f}, {float(longitude):.6f}\n"
+
+    status = order.status or OrderStatus.PENDING
+    header = (
+        f"🆕 Новый заказ №{order.order_id}\n"
+        f"📋 Часть {part_num} из {parts_total} (Базовый номер: {order.root_order_id})\n\n"
+        f"👤 Клиент: {order.client_name}\n"
+        f"👤 User ID: {order.user_id}\n"
+        f"📱 Телефон: {profile.get('phone') or 'Не указан'}\n"
+        f"🏙 Город: {profile.get('city') or 'Не указан'}\n"
+        f"{location_text}"
+        f"🏭 Категория: {get_category_name(order.category)}\n"
+        f"💰 Сумма (этой категории): {format_currency(order.total)}\n"
+        f"💰 Общая сумма заказа: {format_currency(order_sum)}\n"
+        f"📦 Товаров (в этой категории): {category_item_count}\n"
+        f"📦 Товаров (всего в заказе): {order_item_count}\n\n"
+        f"📊 Статус: {ADMIN_STATUS_LINES.get(status, status)}\n"
+        f"{CAPTION_DIVIDER}"
+    )
+
+    history = []
+    for event in events:
+        label = ORDER_EVENT_LABELS.get(event["status"])
+        if not label:
+            continue
+        actor = event.get("actor")
+        created_at = event["created_at"]
+        time_text = created_at.strftime("%d.%m.%Y %H:%M") if isinstance(created_at, datetime) else str(created_at)[:16]
+        history.append(f"{label}: {get_admin_name(actor)} (ID: {actor})\n   Время: {time_text}")
+
+    footer = "\n\n🎉 Заказ полностью выполнен!" if status == OrderStatus.WAREHOUSE_RECEIVED else ""
+
+    # Если история не помещается в лимит — скрываем самые старые записи
+    skipped = 0
+    while True:
+        lines = history[skipped:]
+        if skipped:
+            lines = [f"… ранее: {skipped} зап."] + lines
+        caption = header + ("\n" + "\n".join(lines) if lines else "") + footer
+        if len(caption) <= ADMIN_CAPTION_LIMIT or skipped >= len(history):
+            break
+        skipped += 1
+
+    return caption[:ADMIN_CAPTION_LIMIT]
+
+
+def build_admin_caption(order_id: str) -> Optional[str]:
+    """Собирает caption админ-сообщения из БД (заказ, части заказа, профиль, история)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {ORDER_HEADER_COLUMNS} FROM orders WHERE order_id = %s", (order_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        order = OrderRecord.from_row(row)
+
+        cursor.execute(f"""
+            SELECT order_id, total, {ORDER_ITEM_COUNT_COLUMN} FROM orders
+            WHERE base_order_id = %s
+            ORDER BY order_id
+        """, (order.root_order_id,), name="orders.caption_parts")
+        parts = [OrderRecord.from_row(r) for r in cursor.fetchall()]
+
+        cursor.execute("""
+            SELECT phone, city, latitude, longitude FROM users WHERE user_id = %s
+        """, (order.user_id,))
+        profile = cursor.fetchone() or {}
+
+        cursor.execute("""
+            SELECT status, actor, created_at FROM order_events
+            WHERE order_id = %s
+            ORDER BY event_id
+        """, (order_id,), name="order_events.history")
+        events = cursor.fetchall()
+
+    part_ids = [part.order_id for part in parts]
+    part_num = part_ids.index(order_id) + 1 if order_id in part_ids else 1
+    item_counts = {part.order_id: part.item_count or 0 for part in parts}
+
+    return format_admin_caption(
+        order,
+        part_num=part_num,
+        parts_total=max(len(parts), 1),
+        order_sum=sum(part.total or 0 for part in parts),
+        category_item_count=item_counts.get(order_id, 0),
+        order_item_count=sum(item_counts.values()),
+        profile=dict(profile),
+        events=list(events)
+    )
+
+
 def build_grouped_status_message(base_order_id: str, lang: str = "ru") -> str:
     """Создает сводное сообщение о статусе всех категорий заказа"""
 
     # Получаем все под-заказы
-    sub_orders = get_orders_by_base_id(base_order_id)
+    sub_orders = get_orders_by_base_id(base_order_id, with_item_counts=True)
 
     if not sub_orders:
         return ""
@@ -1068,25 +3905,19 @@ def build_grouped_status_message(base_order_id: str, lang: str = "ru") -> str:
     total_items = 0
 
     for order in sub_orders:
-        category = order.get("category")
-        status = order.get("status", OrderStatus.PENDING)
-        total_sum += order.get("total", 0)
+        category = order.category
+        status = order.status or OrderStatus.PENDING
+        total_sum += order.total or 0
 
-        # Получаем количество товаров из order_json
-        order_json_str = order.get("order_json", "{}")
-        try:
-            order_json = json.loads(order_json_str)
-            items = order_json.get("items", [])
-            item_count = len(items)
-            total_items += item_count
-        except:
-            item_count = 0
+        # Количество позиций из order_items
+        item_count = order.item_count or 0
+        total_items += item_count
 
         if category:
             categories_info[category] = {
                 "status": status,
                 "item_count": item_count,
-                "sum": order.get("total", 0)
+                "sum": order.total or 0
             }
 
     # Строим сообщение
@@ -1130,16 +3961,16 @@ async def send_or_update_client_notification(base_order_id: str, user_id: int, l
     """Отправляет или обновляет сводное сообщение клиенту"""
 
     # Получаем текст сообщения
-    message_text = build_grouped_status_message(base_order_id, lang)
+    message_text = await run_db(build_grouped_status_message, base_order_id, lang)
 
     if not message_text:
         return
 
     # Проверяем, есть ли уже сообщение
-    notification = get_client_notification(base_order_id)
+    notification = await run_db(get_client_notification, base_order_id)
 
     try:
-        if notification:
+        if notification and notification["message_id"]:
             # Обновляем существующее сообщение
             await bot.edit_message_text(
                 chat_id=user_id,
@@ -1154,7 +3985,7 @@ async def send_or_update_client_notification(base_order_id: str, user_id: int, l
                 text=message_text
             )
             # Сохраняем message_id
-            save_client_notification(base_order_id, user_id, sent_message.message_id)
+            await run_db(save_client_notification, base_order_id, user_id, sent_message.message_id)
             logger.info(f"Sent new client notification for order {base_order_id}")
 
     except Exception as e:
@@ -1164,21 +3995,14 @@ async def send_or_update_client_notification(base_order_id: str, user_id: int, l
 async def send_category_completion_notification(order_id: str, category: str, user_id: int, lang: str = "ru"):
     """Отправляет отдельное уведомление о готовности конкретной категории"""
 
-    order_data = get_order_raw(order_id)
-    if not order_data:
+    order = await run_db(get_order_summary, order_id)
+    if not order:
         return
 
     emoji = get_category_emoji(category)
     cat_name = get_category_name(category)
 
-    # Получаем информацию о товарах
-    order_json_str = order_data.get("order_json", "{}")
-    try:
-        order_json = json.loads(order_json_str)
-        items = order_json.get("items", [])
-        item_count = len(items)
-    except:
-        item_count = 0
+    item_count = order.item_count or 0
 
     if lang == "ru":
         text = (
@@ -1187,7 +4011,7 @@ async def send_category_completion_notification(order_id: str, category: str, us
             f"Заказ №{order_id}\n\n"
             f"🎉 Полностью готов и ожидает на складе!\n\n"
             f"📦 Товаров: {item_count}\n"
-            f"💰 Сумма: {format_currency(order_data.get('total', 0))}\n\n"
+            f"💰 Сумма: {format_currency(order.total)}\n\n"
 
         )
     else:
@@ -1197,7 +4021,7 @@ async def send_category_completion_notification(order_id: str, category: str, us
             f"Buyurtma №{order_id}\n\n"
             f"🎉 To'liq tayyor va omborda kutmoqda!\n\n"
             f"📦 Mahsulotlar: {item_count}\n"
-            f"💰 Summa: {format_currency(order_data.get('total', 0))}\n\n"
+            f"💰 Summa: {format_currency(order.total)}\n\n"
 
         )
 
@@ -1215,39 +4039,85 @@ async def send_category_completion_notification(order_id: str, category: str, us
 # ==================== ПОЛЬЗОВАТЕЛИ ====================
 
 def add_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Добавление/обновление пользователя в базе данных"""
+    """Добавление/обновление пользователя в базе данных (один upsert)"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-            exists = cursor.fetchone()
-            
-            if exists:
-                # Обновляем last_activity
-                cursor.execute("""
-                    UPDATE users 
-                    SET last_activity = %s, username = %s, first_name = %s, last_name = %s
-                    WHERE user_id = %s
-                """, (datetime.now(), username, first_name, last_name, user_id))
-            else:
-                # Создаем нового пользователя
-                cursor.execute("""
-                    INSERT INTO users (user_id, username, first_name, last_name, created_at, last_activity, language)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (user_id, username, first_name, last_name, datetime.now(), datetime.now(), 'ru'))
-            
+            now = datetime.now()
+            cursor.execute(
+                sql_upsert(
+                    "users",
+                    ["user_id", "username", "first_name", "last_name", "created_at", "last_activity", "language"],
+                    ["user_id"],
+                    update=["username", "first_name", "last_name", "last_activity"]
+                ),
+                (user_id, username, first_name, last_name, now, now, 'ru')
+            )
             conn.commit()
             logger.info(f"User {user_id} added/updated in database")
     except Exception as e:
         logger.exception(f"Error adding user {user_id} to database")
 
 
+# ==================== ОТЛОЖЕННАЯ ЗАПИСЬ АКТИВНОСТИ ====================
+
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))  # сек
+ACTIVITY_FLUSH_BATCH = 500
+ACTIVITY_UPSERT_SQL = sql_upsert("users", ["user_id", "created_at", "last_activity"], ["user_id"],
+                                 update=["last_activity"])
+
+
+class ActivityBuffer:
+    """Буфер отметок last_activity: копит в памяти и пишет в БД пачками"""
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self._pending: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def touch(self, user_id: int):
+        """Отмечает активность пользователя (без обращения к БД)"""
+        with self._lock:
+            self._pending[user_id] = datetime.now()
+
+    def flush(self) -> int:
+        """Записывает накопленные отметки; возвращает количество пользователей"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        rows = [(user_id, ts, ts) for user_id, ts in pending.items()]
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                # pymysql склеивает INSERT ... VALUES в один многострочный запрос на пачку
+                for i in range(0, len(rows), self.batch_size):
+                    cursor.executemany(ACTIVITY_UPSERT_SQL, rows[i:i + self.batch_size])
+                conn.commit()
+        except Exception:
+            # Возвращаем отметки в буфер, не затирая более свежие
+            with self._lock:
+                for user_id, ts in pending.items():
+                    self._pending.setdefault(user_id, ts)
+            logger.exception(f"Error flushing activity for {len(pending)} users")
+            return 0
+
+        logger.debug(f"Flushed last_activity for {len(rows)} users")
+        return len(rows)
+
+
+activity_buffer = ActivityBuffer(batch_size=ACTIVITY_FLUSH_BATCH)
+
+
 def get_all_user_ids() -> List[int]:
     """Получение всех ID пользователей из базы данных"""
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(ROUTE_REPORTING) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT user_id FROM users ORDER BY created_at DESC")
             return [row['user_id'] for row in cursor.fetchall()]
@@ -1300,11 +4170,13 @@ async def check_dealer_status(user_id: int, phone: str, force_check: bool = Fals
             return cached
 
     clean_phone = re.sub(r'\D', '', phone)
-    url = f"{GOOGLE_SCRIPT_URL}?telegram_id={user_id}&phone={clean_phone}"
 
     try:
-        response = await asyncio.to_thread(urlopen, url, timeout=10)
-        result = json.loads(response.read().decode())
+        response = await http_client.get(
+            GOOGLE_SCRIPT_URL, params={"telegram_id": user_id, "phone": clean_phone}, timeout=10
+        )
+        response.raise_for_status()
+        result = response.json()
 
         info = {
             "is_dealer": result.get("found", False),
@@ -1455,40 +4327,257 @@ def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
         return None
 
 
+# ==================== СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ ====================
+
+USER_STATS_WINDOWS = (1, 7, 30)  # дни
+USER_STATS_REFRESH_INTERVAL = int(os.getenv("USER_STATS_REFRESH_INTERVAL", "600"))  # сек
+USER_STATS_CACHE_TTL = int(os.getenv("USER_STATS_CACHE_TTL", "60"))  # сек
+
+# Кеш последнего прочитанного снимка: {"stats": ..., "expires_at": monotonic}
+_users_stats_cache: Dict[str, Any] = {"stats": None, "expires_at": 0.0}
+
+
+def _rollup_rows_to_stats(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Сборка словаря статистики из строк users_stats_rollup"""
+    stats: Dict[str, Any] = {"total": 0, "by_city": [], "by_language": [], "refreshed_at": None}
+    for days in USER_STATS_WINDOWS:
+        stats[f"active_{days}d"] = 0
+        stats[f"new_{days}d"] = 0
+
+    for row in rows:
+        metric = row["metric"]
+        if metric == "city":
+            stats["by_city"].append((row["dimension"], row["value"]))
+        elif metric == "language":
+            stats["by_language"].append((row["dimension"], row["value"]))
+        else:
+            stats[metric] = row["value"]
+        if stats["refreshed_at"] is None or row["refreshed_at"] > stats["refreshed_at"]:
+            stats["refreshed_at"] = row["refreshed_at"]
+
+    stats["by_city"].sort(key=lambda item: item[1], reverse=True)
+    stats["by_language"].sort(key=lambda item: item[1], reverse=True)
+    return stats
+
+
+def refresh_users_stats_rollup() -> Dict[str, Any]:
+    """Пересчёт статистики пользователей в users_stats_rollup.
+
+    Все счётчики считаются одним проходом по users (плюс две группировки),
+    границы окон вычисляются в Python. Запускается фоновой задачей, а не
+    на каждый /users_stats.
+    """
+    now = datetime.now().replace(microsecond=0)
+
+    columns = ["COUNT(*) AS total"]
+    params: List[Any] = []
+    for days in USER_STATS_WINDOWS:
+        cutoff = now - timedelta(days=days)
+        columns.append(f"SUM(last_activity >= %s) AS active_{days}d")
+        columns.append(f"SUM(created_at >= %s) AS new_{days}d")
+        params.extend([cutoff, cutoff])
+
+    # Тяжёлые агрегаты читаем с реплики, снимок пишем на primary
+    with get_db_connection(ROUTE_REPORTING) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(columns)} FROM users", params, name="users.stats_scan")
+        totals = cursor.fetchone()
+
+        rows = [
+            {"metric": metric, "dimension": "", "value": int(value or 0), "refreshed_at": now}
+            for metric, value in totals.items()
+        ]
+
+        for metric, column in (("city", "city"), ("language", "language")):
+            cursor.execute(f"""
+                SELECT COALESCE({column}, '') AS dimension, COUNT(*) AS value
+                FROM users
+                GROUP BY COALESCE({column}, '')
+            """, name=f"users.stats_by_{metric}")
+            rows.extend(
+                {"metric": metric, "dimension": row["dimension"], "value": row["value"], "refreshed_at": now}
+                for row in cursor.fetchall()
+            )
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Полная замена снимка в одной транзакции — читатели видят либо старый, либо новый
+        cursor.execute("DELETE FROM users_stats_rollup")
+        cursor.executemany("""
+            INSERT INTO users_stats_rollup (metric, dimension, value, refreshed_at)
+            VALUES (%s, %s, %s, %s)
+        """, [(r["metric"], r["dimension"], r["value"], r["refreshed_at"]) for r in rows])
+        conn.commit()
+
+    stats = _rollup_rows_to_stats(rows)
+    _users_stats_cache["stats"] = stats
+    _users_stats_cache["expires_at"] = time.monotonic() + USER_STATS_CACHE_TTL
+    logger.info(f"📊 Users stats rollup refreshed: {stats['total']} users")
+    return stats
+
+
 def get_users_stats() -> Dict[str, Any]:
-    """Получение статистики пользователей"""
+    """Получение статистики пользователей из предрасчитанного снимка"""
+    cached = _users_stats_cache["stats"]
+    if cached is not None and time.monotonic() < _users_stats_cache["expires_at"]:
+        return cached
+
+    try:
+        with get_db_connection(ROUTE_REPORTING) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT metric, dimension, value, refreshed_at FROM users_stats_rollup")
+            rows = cursor.fetchall()
+
+        # Снимка ещё нет (первый запуск) — считаем сразу
+        if not rows:
+            return refresh_users_stats_rollup()
+
+        stats = _rollup_rows_to_stats(rows)
+        _users_stats_cache["stats"] = stats
+        _users_stats_cache["expires_at"] = time.monotonic() + USER_STATS_CACHE_TTL
+        return stats
+    except Exception as e:
+        logger.exception("Error getting users stats")
+        return cached or _rollup_rows_to_stats([])
+
+
+def count_dealer_statuses() -> Dict[str, int]:
+    """Подсчёт проверенных дилеров по кешу статусов (в памяти)"""
+    active = sum(1 for info in dealer_cache.values() if info.get("is_active", True))
+    return {"active": active, "inactive": len(dealer_cache) - active}
+
+
+# ==================== КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ====================
+
+@dataclass(slots=True)
+class UserContext:
+    """Строка пользователя, загруженная один раз на апдейт"""
+    user_id: int
+    exists: bool = False
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    language: str = "ru"
+    phone: Optional[str] = None
+    city: Optional[str] = None
+    full_name: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+    @property
+    def lang(self) -> str:
+        return self.language or "ru"
+
+    @property
+    def profile(self) -> Dict[str, Any]:
+        """Профиль в том же формате, что и get_user_profile"""
+        profile = {}
+        if self.phone:
+            profile['phone'] = self.phone
+        if self.city:
+            profile['city'] = self.city
+        if self.full_name:
+            profile['full_name'] = self.full_name
+        if self.latitude:
+            profile['latitude'] = self.latitude
+        if self.longitude:
+            profile['longitude'] = self.longitude
+        return profile
+
+    @property
+    def is_registered(self) -> bool:
+        return bool(self.phone and self.city and self.full_name)
+
+    @property
+    def dealer_status(self) -> Optional[Dict[str, Any]]:
+        """Последний известный статус дилера (из кеша проверок)"""
+        return dealer_cache.get(self.user_id)
+
+    @property
+    def is_dealer_active(self) -> bool:
+        return is_dealer_active(self.user_id)
+
+    async def register(self, username: str = None, first_name: str = None, last_name: str = None):
+        """Добавление/обновление пользователя через контекст"""
+        if self.exists and (self.username, self.first_name, self.last_name) == (username, first_name, last_name):
+            # Данные не изменились — достаточно отметить активность в буфере
+            activity_buffer.touch(self.user_id)
+            return
+
+        await run_db(add_user, self.user_id, username, first_name, last_name)
+        self.exists = True
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+
+    async def set_lang(self, lang: str):
+        """Смена языка с обновлением контекста"""
+        await run_db(set_user_lang, self.user_id, lang)
+        self.language = lang
+
+    async def set_profile(self, profile: Dict[str, Any]):
+        """Сохранение профиля с обновлением контекста"""
+        await run_db(set_user_profile, self.user_id, profile)
+        self.phone = profile.get('phone')
+        self.city = profile.get('city')
+        self.full_name = profile.get('full_name')
+        self.latitude = profile.get('latitude')
+        self.longitude = profile.get('longitude')
+
+
+def load_user_context(user_id: int) -> UserContext:
+    """Загрузка всей строки пользователя одним запросом"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # Общее количество пользователей
-            cursor.execute("SELECT COUNT(*) as total FROM users")
-            total = cursor.fetchone()['total']
-            
-            # Активные пользователи (за последние 30 дней)
-            cursor.execute("""
-                SELECT COUNT(*) as active 
-                FROM users 
-                WHERE last_activity >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-            """)
-            active = cursor.fetchone()['active']
-            
-            # Новые пользователи (за последние 7 дней)
             cursor.execute("""
-                SELECT COUNT(*) as new_users 
+                SELECT username, first_name, last_name, language,
+                       phone, city, full_name, latitude, longitude
                 FROM users 
-                WHERE created_at >= DATE_SUB(NOW(), INTERVAL 7 DAY)
-            """)
-            new_users = cursor.fetchone()['new_users']
-            
-            return {
-                'total': total,
-                'active_30d': active,
-                'new_7d': new_users
-            }
+                WHERE user_id = %s
+            """, (user_id,))
+            row = cursor.fetchone()
     except Exception as e:
-        logger.exception("Error getting users stats")
-        return {'total': 0, 'active_30d': 0, 'new_7d': 0}
+        logger.exception(f"Error loading context for user {user_id}")
+        return UserContext(user_id=user_id)
+
+    if not row:
+        return UserContext(user_id=user_id)
+
+    return UserContext(
+        user_id=user_id,
+        exists=True,
+        username=row['username'],
+        first_name=row['first_name'],
+        last_name=row['last_name'],
+        language=row['language'] or 'ru',
+        phone=row['phone'],
+        city=row['city'],
+        full_name=row['full_name'],
+        latitude=float(row['latitude']) if row['latitude'] else None,
+        longitude=float(row['longitude']) if row['longitude'] else None,
+    )
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Middleware: загружает UserContext для хендлеров, которые его принимают"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+
+        # Не ходим в БД, если хендлеру контекст не нужен (например, админские колбэки)
+        handler_object = data.get("handler")
+        wants_context = handler_object is None or "user_ctx" in getattr(handler_object, "params", {"user_ctx"})
+
+        if user is not None and wants_context:
+            data["user_ctx"] = await run_db(load_user_context, user.id)
+
+        return await handler(event, data)
 
 
 # ==================== FTP ====================
@@ -1601,18 +4690,14 @@ async def download_image_async(url: str, timeout: int = 10) -> Optional[Image.Im
             return image_cache[url]
     
     try:
-        loop = asyncio.get_event_loop()
-        
-        def _download():
-            try:
-                response = urlopen(url, timeout=timeout)
-                image_data = response.read()
-                return Image.open(io.BytesIO(image_data))
-            except Exception as e:
-                logger.warning(f"Failed to download image from {url}: {e}")
-                return None
-        
-        image = await loop.run_in_executor(image_download_executor, _download)
+        try:
+            # Картинка не критична для PDF: один повтор, без долгих ожиданий
+            response = await http_client.get(url, timeout=timeout, retries=1)
+            response.raise_for_status()
+            image = Image.open(io.BytesIO(response.body))
+        except Exception as e:
+            logger.warning(f"Failed to download image from {url}: {e}")
+            image = None
         
         if image:
             image_cache[url] = image
@@ -2074,6 +5159,9 @@ router = Router()
 # Добавляем middleware
 dp.message.middleware(rate_limiter)
 dp.message.middleware(WebAppTimerMiddleware())
+dp.message.middleware(UserContextMiddleware())
+dp.callback_query.middleware(UserContextMiddleware())
+dp.inline_query.middleware(UserContextMiddleware())
 
 # Регистрируем роутер
 dp.include_router(router)
@@ -2082,7 +5170,7 @@ dp.include_router(router)
 # ==================== КОМАНДЫ ====================
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user_ctx: UserContext):
     """Команда /start с перепроверкой дилера"""
 
     user_id = message.from_user.id
@@ -2091,7 +5179,7 @@ async def cmd_start(message: Message, state: FSMContext):
     last_name = message.from_user.last_name
     
     # Регистрируем пользователя с полной информацией из Telegram
-    add_user(user_id, username, first_name, last_name)
+    await user_ctx.register(username, first_name, last_name)
 
     # ===== ОБНОВЛЕНИЕ ТАЙМЕРА WEBAPP =====
     update_user_start_time(user_id)
@@ -2103,8 +5191,8 @@ async def cmd_start(message: Message, state: FSMContext):
 
     asyncio.create_task(expire_webapp_keyboard())
 
-    lang = get_user_lang(user_id)
-    profile = get_user_profile(user_id)
+    lang = user_ctx.lang
+    profile = user_ctx.profile
 
     # ===== 1. ЕСЛИ ПОЛЬЗОВАТЕЛЬ НЕ ЗАРЕГИСТРИРОВАН =====
     if not profile or not all(k in profile for k in ["phone", "city", "full_name"]):
@@ -2209,9 +5297,9 @@ async def block_expired_webapp(message: Message):
         )
 
 @router.callback_query(F.data == "register")
-async def callback_register(callback: CallbackQuery, state: FSMContext):
+async def callback_register(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Начало регистрации"""
-    lang = get_user_lang(callback.from_user.id)
+    lang = user_ctx.lang
 
     if lang == "ru":
         text = "📱 Поделитесь своим номером телефона:"
@@ -2234,12 +5322,11 @@ async def callback_register(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(F.data == "toggle_lang")
-async def callback_toggle_lang(callback: CallbackQuery):
+async def callback_toggle_lang(callback: CallbackQuery, user_ctx: UserContext):
     """Переключение языка"""
-    user_id = callback.from_user.id
-    current_lang = get_user_lang(user_id)
+    current_lang = user_ctx.lang
     new_lang = "uz" if current_lang == "ru" else "ru"
-    set_user_lang(user_id, new_lang)
+    await user_ctx.set_lang(new_lang)
 
     if new_lang == "ru":
         text = "🇷🇺 Язык изменён на русский"
@@ -2249,7 +5336,7 @@ async def callback_toggle_lang(callback: CallbackQuery):
     await callback.answer(text, show_alert=True)
 
     # Обновляем меню
-    profile = get_user_profile(user_id)
+    profile = user_ctx.profile
     if not profile or not all(k in profile for k in ["phone", "city", "full_name"]):
         if new_lang == "ru":
             text = "👋 Добро пожаловать! Для начала работы необходимо зарегистрироваться."
@@ -2271,9 +5358,9 @@ async def callback_toggle_lang(callback: CallbackQuery):
 
 
 @router.message(RegistrationStates.waiting_for_phone)
-async def process_phone(message: Message, state: FSMContext):
+async def process_phone(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка номера телефона"""
-    lang = get_user_lang(message.from_user.id)
+    lang = user_ctx.lang
 
     if not message.contact:
         if lang == "ru":
@@ -2295,9 +5382,9 @@ async def process_phone(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_city)
-async def process_city(message: Message, state: FSMContext):
+async def process_city(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка города"""
-    lang = get_user_lang(message.from_user.id)
+    lang = user_ctx.lang
     city = message.text.strip()
 
     if not city:
@@ -2330,9 +5417,9 @@ async def process_city(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_location)
-async def process_location(message: Message, state: FSMContext):
+async def process_location(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка геолокации"""
-    lang = get_user_lang(message.from_user.id)
+    lang = user_ctx.lang
 
     if not message.location:
         if lang == "ru":
@@ -2356,11 +5443,11 @@ async def process_location(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_full_name)
-async def process_full_name(message: Message, state: FSMContext):
+async def process_full_name(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка полного имени + проверка дилера"""
 
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
     full_name = message.text.strip()
 
     # Проверка имени
@@ -2382,7 +5469,7 @@ async def process_full_name(message: Message, state: FSMContext):
         "latitude": data.get("latitude"),
         "longitude": data.get("longitude")
     }
-    set_user_profile(user_id, profile)
+    await user_ctx.set_profile(profile)
 
     # 🔍 ПРОВЕРКА ДИЛЕРА ЧЕРЕЗ GOOGLE SHEETS
     dealer_status = await check_dealer_status(
@@ -2450,14 +5537,14 @@ async def process_full_name(message: Message, state: FSMContext):
 
 
 @router.message(F.content_type == ContentType.WEB_APP_DATA)
-async def handle_webapp_data(message: Message, state: FSMContext):
+async def handle_webapp_data(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка данных из WebApp + проверка дилера"""
 
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
 
     # ===== 1. ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ =====
-    profile = get_user_profile(user_id)
+    profile = user_ctx.profile
 
     if not profile or not profile.get("phone"):
         if lang == "ru":
@@ -2552,10 +5639,10 @@ async def handle_webapp_data(message: Message, state: FSMContext):
         else:
             loading_msg = await message.answer("⏳ Mahsulotlar ma'lumotini yuklamoqdamiz...")
         
-        # Загружаем товары из Google Sheets
-        products = await fetch_products_from_sheets()
+        # Текущая версия каталога: по ней же заказ будет оценён при подписи
+        catalog = await product_catalog.current()
         
-        if not products:
+        if not catalog:
             await loading_msg.delete()
             if lang == "ru":
                 await message.answer("❌ Не удалось загрузить каталог товаров. Попробуйте позже.")
@@ -2564,44 +5651,22 @@ async def handle_webapp_data(message: Message, state: FSMContext):
             return
         
         # Дополняем данные заказа полной информацией
-        enriched_items = []
-        total_price = 0
-        
-        for item_data in data["items"]:
-            product_id = item_data["id"]
-            qty = item_data["qty"]
-            
-            # Получаем полную информацию о товаре
-            product = products.get(product_id)
-            
-            if not product:
-                logger.warning(f"⚠️ Product ID {product_id} not found in Google Sheets")
-                await loading_msg.delete()
-                if lang == "ru":
-                    await message.answer(f"❌ Товар с ID {product_id} не найден в каталоге.")
-                else:
-                    await message.answer(f"❌ {product_id} ID li mahsulot katalogda topilmadi.")
-                return
-            
-            # Формируем полный объект товара
-            enriched_item = {
-                "id": product_id,
-                "name": product.get("name", "Без названия"),
-                "price": int(product.get("price", 0)),
-                "qty": qty,
-                "image": product.get("image", ""),
-                "category": product.get("category", "unknown"),
-                "weight": float(product.get("weight", 0)),
-                "cube": float(product.get("cube", 0))
-            }
-            
-            enriched_items.append(enriched_item)
-            total_price += enriched_item["price"] * qty
+        try:
+            enriched_items, total_price = enrich_cart_items(catalog.products, data["items"])
+        except KeyError as e:
+            product_id = e.args[0]
+            logger.warning(f"⚠️ Product ID {product_id} not found in Google Sheets")
+            await loading_msg.delete()
+            if lang == "ru":
+                await message.answer(f"❌ Товар с ID {product_id} не найден в каталоге.")
+            else:
+                await message.answer(f"❌ {product_id} ID li mahsulot katalogda topilmadi.")
+            return
         
         # Удаляем сообщение загрузки
         await loading_msg.delete()
         
-        logger.info(f"✅ Enriched order data: {len(enriched_items)} items, total: {total_price}")
+        logger.info(f"✅ Enriched order data: {len(enriched_items)} items, total: {total_price}, catalog {catalog.version}")
         
         # Формируем полный объект заказа
         validated_data = {
@@ -2684,32 +5749,27 @@ async def handle_webapp_data(message: Message, state: FSMContext):
 
     await message.answer_document(document=pdf_file, caption=preview_text)
     
-    # Сохраняем данные заказа для подписи
-    await state.update_data(order_data=validated_data)
+    # Для подписи храним только версию каталога и корзину (id, qty);
+    # позиции заново собираются из той же версии — цены не «плывут»
+    await state.update_data(order_data={
+        "catalog_version": catalog.version,
+        "items": [{"id": item["id"], "qty": item["qty"]} for item in data["items"]],
+    })
     await state.set_state(OrderSign.waiting_name)
 
 @router.message(F.text.in_(["🏠 Главный меню", "🏠 Bosh menyu"]))
-async def expired_button_as_start(message: Message, state: FSMContext):
-    await cmd_start(message, state)
+async def expired_button_as_start(message: Message, state: FSMContext, user_ctx: UserContext):
+    await cmd_start(message, state, user_ctx)
 
 @router.message(F.text.in_(["📋 Мои заказы", "📋 Mening buyurtmalarim"]))
-async def cmd_my_orders(message: Message):
-    """Просмотр заказов пользователя"""
+async def cmd_my_orders(message: Message, user_ctx: UserContext):
+    """Просмотр заказов пользователя (первая страница)"""
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT order_id, total, status, created_at 
-            FROM orders 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        """, (user_id,))
-        orders = [dict(row) for row in cursor.fetchall()]
+    page = await run_db(get_order_groups_page, user_id)
 
-    if not orders:
+    if not page["groups"]:
         if lang == "ru":
             await message.answer("У вас пока нет заказов.")
         else:
@@ -2721,32 +5781,52 @@ async def cmd_my_orders(message: Message):
     else:
         text = "📋 Sizning buyurtmalaringiz:\n\n"
 
-    status_names = {
-        "pending": "⏳ Ожидает" if lang == "ru" else "⏳ Kutilmoqda",
-        "approved": "✅ Одобрен" if lang == "ru" else "✅ Tasdiqlandi",
-        "production_received": "📋 Производство получило" if lang == "ru" else "📋 Ishlab chiqarish qabul qildi",
-        "production_started": "🏭 В производстве" if lang == "ru" else "🏭 Ishlab chiqarilmoqda",
-        "sent_to_warehouse": "📦 На складе" if lang == "ru" else "📦 Omborga yuborildi",
-        "warehouse_received": "✅ Готов" if lang == "ru" else "✅ Tayyor",
-        "rejected": "❌ Отклонен" if lang == "ru" else "❌ Rad etildi"
-    }
+    text += format_order_groups(page["groups"], lang)
 
-    for order in orders:
-        status = status_names.get(order["status"], order["status"])
-        text += f"№{order['order_id']}\n"
-        text += f"💰 {format_currency(order['total'])}\n"
-        text += f"📅 {order['created_at'].strftime('%Y-%m-%d') if isinstance(order['created_at'], datetime) else str(order['created_at'])[:10]}\n"
-        text += f"📊 {status}\n\n"
+    await message.answer(text, reply_markup=build_orders_page_keyboard("myorders", page, lang))
 
-    await message.answer(text)
+
+@router.callback_query(F.data.startswith("myorders:"))
+async def callback_my_orders_page(callback: CallbackQuery, user_ctx: UserContext):
+    """Листание заказов пользователя"""
+    _, direction, raw_cursor = callback.data.split(":", 2)
+    cursor = decode_order_cursor(raw_cursor)
+    lang = user_ctx.lang
+
+    if not cursor:
+        await callback.answer()
+        return
+
+    page = await run_db(
+        get_order_groups_page,
+        callback.from_user.id,
+        cursor=cursor,
+        direction="next" if direction == "n" else "prev"
+    )
+
+    if not page["groups"]:
+        await callback.answer("Больше заказов нет" if lang == "ru" else "Boshqa buyurtmalar yo'q")
+        return
+
+    if lang == "ru":
+        text = "📋 Ваши заказы:\n\n"
+    else:
+        text = "📋 Sizning buyurtmalaringiz:\n\n"
+
+    text += format_order_groups(page["groups"], lang)
+
+    try:
+        await callback.message.edit_text(text, reply_markup=build_orders_page_keyboard("myorders", page, lang))
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
 
 @router.message(F.text.in_(["⚙️ Настройки", "⚙️ Sozlamalar"]))
-async def cmd_settings(message: Message):
+async def cmd_settings(message: Message, user_ctx: UserContext):
     """Настройки пользователя"""
-    user_id = message.from_user.id
-    lang = get_user_lang(user_id)
-    profile = get_user_profile(user_id)
+    lang = user_ctx.lang
+    profile = user_ctx.profile
 
     if lang == "ru":
         location_text = ""
@@ -2789,26 +5869,117 @@ async def cmd_admin(message: Message):
 
     text = f"👨‍💼 Админ-панель\nРоль: {role}\n\n"
     text += "Доступные команды:\n"
+    text += "• /orders - список заказов\n"
+    text += "• /product <ID | ID-ID | название> - поиск товара\n"
 
     if user_id == SUPER_ADMIN_ID:
-        text += "• /orders_export - экспорт заказов\n"
+        text += "• /orders_export [с] [по] [статус] - экспорт заказов\n"
         text += "• /sendall - массовая рассылка\n"
         text += "• /send - отправить сообщение пользователю\n"
         text += "• /get_pdf - получить PDF заказа\n"
+        text += "• /db_stats - метрики базы данных\n"
+        text += "• /top_products [дней] - самые заказываемые товары\n"
+        text += "• /query_stats - время SQL-запросов\n"
+        text += "• /catalog_stats - состояние каталога товаров\n"
+        text += "• /catalog_diff [старая] [новая] - изменения между версиями каталога\n"
+        text += "• /http_stats - исходящие HTTP-запросы\n"
+
+    if has_permission(user_id, AdminRole.SALES):
+        text += "• Одобрение/отклонение заказов\n"
+
+    if has_permission(user_id, AdminRole.PRODUCTION):
+        text += "• Управление производством\n"
+
+    if has_permission(user_id, AdminRole.WAREHOUSE):
+        text += "• Управление складом\n"
+
+    await message.answer(text)
+
+
+@router.message(Command("orders"))
+async def cmd_orders(message: Message):
+    """Список всех заказов с пагинацией (админы)"""
+    if message.from_user.id not in ALL_ADMIN_IDS:
+        return
+
+    page = await run_db(get_order_groups_page)
+
+    if not page["groups"]:
+        await message.answer("В базе нет заказов.")
+        return
+
+    text = "📋 Заказы:\n\n" + format_order_groups(page["groups"], with_client=True)
+    await message.answer(text, reply_markup=build_orders_page_keyboard("adminorders", page))
+
+
+@router.callback_query(F.data.startswith("adminorders:"))
+async def callback_admin_orders_page(callback: CallbackQuery):
+    """Листание списка заказов (админы)"""
+    if callback.from_user.id not in ALL_ADMIN_IDS:
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+
+    _, direction, raw_cursor = callback.data.split(":", 2)
+    cursor = decode_order_cursor(raw_cursor)
+    if not cursor:
+        await callback.answer()
+        return
+
+    page = await run_db(
+        get_order_groups_page,
+        cursor=cursor,
+        direction="next" if direction == "n" else "prev"
+    )
+
+    if not page["groups"]:
+        await callback.answer("Больше заказов нет")
+        return
+
+    text = "📋 Заказы:\n\n" + format_order_groups(page["groups"], with_client=True)
+    try:
+        await callback.message.edit_text(text, reply_markup=build_orders_page_keyboard("adminorders", page))
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
+
+# ==================== CALLBACK ОБРАБОТЧИКИ ДЛЯ СТАТУСОВ ====================
+
+async def answer_transition_lost(callback: CallbackQuery, order_id: str):
+    """Ответ администратору, если статус заказа уже изменил кто-то другой"""
+    order = await run_db(get_order_status, order_id)
+    current = STATUS_NAMES_RU.get(order.status, order.status) if order else "неизвестен"
+    await callback.answer(
+        f"⚠️ Заказ уже обработан.\nТекущий статус: {current}",
+        show_alert=True
+    )
 
-    if has_permission(user_id, AdminRole.SALES):
-        text += "• Одобрение/отклонение заказов\n"
 
-    if has_permission(user_id, AdminRole.PRODUCTION):
-        text += "• Управление производством\n"
+async def notify_client_after_transition(order: OrderRecord, completed_category: Optional[str] = None):
+    """Обновляет сводку клиента после занятого перехода.
 
-    if has_permission(user_id, AdminRole.WAREHOUSE):
-        text += "• Управление складом\n"
+    Переход уже зафиксирован в БД, поэтому сбой уведомления только
+    логируется и не мешает обновить сообщение администратора.
+    """
+    try:
+        lang = await run_db(get_user_lang, order.user_id)
+        # Отдельное уведомление о готовности категории
+        if completed_category:
+            await send_category_completion_notification(order.order_id, completed_category, order.user_id, lang)
+        await send_or_update_client_notification(order.root_order_id, order.user_id, lang)
+    except Exception:
+        logger.exception(f"❌ Failed to notify client about order {order.order_id}")
 
-    await message.answer(text)
 
+async def refresh_admin_message(callback: CallbackQuery, order_id: str, reply_markup=None):
+    """Перерисовывает сообщение администратора по истории order_events"""
+    try:
+        # Caption строится из истории order_events, а не из текста старого сообщения
+        new_caption = await run_db(build_admin_caption, order_id) or callback.message.caption
+        await callback.message.edit_caption(caption=new_caption, reply_markup=reply_markup)
+    except Exception:
+        logger.exception(f"❌ Failed to refresh admin message for order {order_id}")
 
-# ==================== CALLBACK ОБРАБОТЧИКИ ДЛЯ СТАТУСОВ ====================
 
 @router.callback_query(F.data.startswith("approve:"))
 async def callback_approve_order(callback: CallbackQuery):
@@ -2846,57 +6017,73 @@ async def callback_approve_order_confirmed(callback: CallbackQuery):
         return
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order = await run_db(get_order_record, order_id)
 
-    if not order_data:
+    if not order:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
+    # Дешёвая проверка до рендера: повторный клик по уже обработанному
+    # заказу не рендерит PDF заново
+    if order.status not in get_previous_statuses(OrderStatus.APPROVED):
+        await answer_transition_lost(callback, order_id)
+        return
+
     # ⚡ ВАЖНО: Отвечаем сразу, чтобы избежать timeout (Telegram дает только 30 сек)
     await callback.answer("⏳ Обработка заказа началась...")
 
     # Получаем категорию заказа
-    order_category = order_data.get("category")
+    order_category = order.category
+
+    # Финальный PDF рендерим ДО перехода: если рендер упадёт, заказ
+    # останется в ожидании и администратор сможет одобрить его повторно
+    try:
+        client_profile = await run_db(get_user_profile, order.user_id)
+        client_latitude = client_profile.get("latitude") if client_profile else None
+        client_longitude = client_profile.get("longitude") if client_profile else None
 
-    # Получаем координаты клиента
-    client_profile = get_user_profile(order_data["user_id"])
-    client_latitude = client_profile.get("latitude") if client_profile else None
-    client_longitude = client_profile.get("longitude") if client_profile else None
+        order_items = order.items
+        client_name = order.client_name or "Клиент"
 
-    # Генерируем финальный PDF
-    order_json = json.loads(order_data["order_json"])
-    client_name = order_data.get("client_name", "Клиент")
-    
-    # Проверяем, является ли заказ мультикатегорийным
-    is_multi_category = len(set(item.get("category") for item in order_json["items"])) > 1
-    
-    preloaded_images = await preload_order_images(order_json["items"])
-    
-    pdf_final = await asyncio.to_thread(
-        generate_order_pdf,
-        order_items=order_json["items"],
-        total=order_json["total"],
-        client_name=client_name,
-        admin_name=ADMIN_NAME,
-        order_id=order_id,
-        approved=True,
-        category=None if is_multi_category else get_order_category(order_json["items"]),
-        latitude=client_latitude,
-        longitude=client_longitude,
-        preloaded_images=preloaded_images
-    )
+        # Проверяем, является ли заказ мультикатегорийным
+        is_multi_category = len(set(item.get("category") for item in order_items)) > 1
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.APPROVED, pdf_final, user_id)
+        preloaded_images = await preload_order_images(order_items)
 
-    # Загружаем PDF
-    await upload_pdf_to_hosting_async(order_id, pdf_final)
+        pdf_final = await asyncio.to_thread(
+            generate_order_pdf,
+            order_items=order_items,
+            total=order.payload.get("total", order.total),
+            client_name=client_name,
+            admin_name=ADMIN_NAME,
+            order_id=order_id,
+            approved=True,
+            category=None if is_multi_category else get_order_category(order_items),
+            latitude=client_latitude,
+            longitude=client_longitude,
+            preloaded_images=preloaded_images
+        )
+    except Exception:
+        logger.exception(f"❌ Failed to render final PDF for order {order_id}")
+        await callback.message.answer(
+            f"❌ Не удалось сформировать PDF для заказа #{order_id}.\n"
+            f"Заказ остался в ожидании — попробуйте одобрить его ещё раз."
+        )
+        return
 
-    # Уведомляем клиента через группированное сообщение
-    client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
+    # Переход и финальный PDF фиксируются одной транзакцией
+    if not await run_db(update_order_status, order_id, OrderStatus.APPROVED, user_id, pdf_final):
+        await callback.message.answer(f"⚠️ Заказ #{order_id} уже обработан другим администратором")
+        return
+
+    # Дальше — только побочные эффекты: заказ уже одобрен и содержит PDF,
+    # поэтому их сбой логируется и не мешает обновить сообщение администратора
+    try:
+        await upload_pdf_to_hosting_async(order_id, pdf_final)
+    except Exception:
+        logger.exception(f"❌ Failed to upload final PDF for order {order_id}")
+
+    await notify_client_after_transition(order)
 
     # Уведомляем соответствующий цех производства
     if order_category:
@@ -2908,8 +6095,8 @@ async def callback_approve_order_confirmed(callback: CallbackQuery):
                 f"🔔 Новый одобренный заказ для вашего цеха!\n\n"
                 f"📋 Номер заказа: #{order_id}\n"
                 f"🏭 Категория: {category_name}\n"
-                f"👤 Клиент: {order_data['client_name']}\n"
-                f"💰 Сумма: {format_currency(order_data['total'])}\n\n"
+                f"👤 Клиент: {order.client_name}\n"
+                f"💰 Сумма: {format_currency(order.total)}\n\n"
                 f"⏰ Заказ ожидает получения производством"
             )
 
@@ -2920,28 +6107,9 @@ async def callback_approve_order_confirmed(callback: CallbackQuery):
                         text=production_text
                     )
                     logger.info(f"Notified production admin {prod_id} for category {category_name}")
-                except Exception as e:
+                except Exception:
                     logger.exception(f"Failed to notify production admin {prod_id}")
 
-    # Получаем информацию об админе
-    admin_name = get_admin_name(user_id)
-    admin_info = f"{admin_name} (ID: {user_id})"
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    # Обновляем caption с историей действий
-    original_caption = callback.message.caption
-    # Удаляем старую строку статуса и подтверждение
-    original_caption = re.sub(r'\n📊 Статус:.*?\n━━━━━━━━━━━━━━━━━━━━━━', '', original_caption)
-    original_caption = re.sub(r'\n\n⚠️ Вы уверены.*', '', original_caption)
-
-    new_caption = (
-            original_caption +
-            f"\n\n📊 Статус: ✅ Одобрен\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"✅ Одобрен: {admin_info}\n"
-            f"   Время: {current_time}"
-    )
-
     # Новые кнопки для следующего этапа
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(
@@ -2950,10 +6118,7 @@ async def callback_approve_order_confirmed(callback: CallbackQuery):
         )]
     ])
 
-    await callback.message.edit_caption(
-        caption=new_caption,
-        reply_markup=kb
-    )
+    await refresh_admin_message(callback, order_id, kb)
 
 
 @router.callback_query(F.data.startswith("admapprove_no:"))
@@ -3016,43 +6181,21 @@ async def callback_reject_order_confirmed(callback: CallbackQuery):
         return
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order = await run_db(get_order_status, order_id)
 
-    if not order_data:
+    if not order:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.REJECTED, updated_by=user_id)
+    # Обновляем статус (только если его никто не обновил раньше)
+    if not await run_db(update_order_status, order_id, OrderStatus.REJECTED, updated_by=user_id):
+        await answer_transition_lost(callback, order_id)
+        return
 
     # Уведомляем клиента через группированное сообщение
-    client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
-
-    # Получаем информацию об админе
-    admin_name = get_admin_name(user_id)
-    admin_info = f"{admin_name} (ID: {user_id})"
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    # Обновляем caption
-    original_caption = callback.message.caption
-    original_caption = re.sub(r'\n📊 Статус:.*?\n━━━━━━━━━━━━━━━━━━━━━━', '', original_caption)
-    original_caption = re.sub(r'\n\n⚠️ Вы уверены.*', '', original_caption)
-
-    new_caption = (
-            original_caption +
-            f"\n\n📊 Статус: ❌ Отклонён\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"❌ Отклонён: {admin_info}\n"
-            f"   Время: {current_time}"
-    )
+    await notify_client_after_transition(order)
 
-    await callback.message.edit_caption(
-        caption=new_caption,
-        reply_markup=None
-    )
+    await refresh_admin_message(callback, order_id, None)
     await callback.answer("❌ Заказ отклонён")
 
 
@@ -3087,14 +6230,14 @@ async def callback_production_received(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order = await run_db(get_order_status, order_id)
 
-    if not order_data:
+    if not order:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
     # Получаем категорию заказа
-    order_category = order_data.get("category")
+    order_category = order.category
 
     # Проверяем права для конкретного цеха
     if not has_permission(user_id, AdminRole.PRODUCTION, order_category):
@@ -3102,36 +6245,13 @@ async def callback_production_received(callback: CallbackQuery):
         await callback.answer(f"У вас нет прав для обработки заказов категории {category_name}", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.PRODUCTION_RECEIVED, updated_by=user_id)
+    # Обновляем статус (только если его никто не обновил раньше)
+    if not await run_db(update_order_status, order_id, OrderStatus.PRODUCTION_RECEIVED, updated_by=user_id):
+        await answer_transition_lost(callback, order_id)
+        return
 
     # Уведомляем клиента через группированное сообщение
-    client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
-
-    # Получаем информацию об админе
-    admin_name = get_admin_name(user_id)
-    admin_info = f"{admin_name} (ID: {user_id})"
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    # Обновляем caption с добавлением новой записи
-    original_caption = callback.message.caption
-    original_caption = re.sub(r'\n📊 Статус:.*?\n━━━━━━━━━━━━━━━━━━━━━━', '', original_caption)
-
-    # Находим блок с историей действий
-    history_match = re.search(r'(✅ Одобрен:.*?Время: \d{2}\.\d{2}\.\d{4} \d{2}:\d{2})', original_caption, re.DOTALL)
-    history_text = history_match.group(1) if history_match else ""
-
-    new_caption = (
-            original_caption.split("━━━━━━━━━━━━━━━━━━━━━━")[0] +
-            f"\n📊 Статус: 📋 Получен производством\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"{history_text}\n"
-            f"📋 Получено производством: {admin_info}\n"
-            f"   Время: {current_time}"
-    )
+    await notify_client_after_transition(order)
 
     # Новые кнопки
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -3141,10 +6261,7 @@ async def callback_production_received(callback: CallbackQuery):
         )]
     ])
 
-    await callback.message.edit_caption(
-        caption=new_caption,
-        reply_markup=kb
-    )
+    await refresh_admin_message(callback, order_id, kb)
     await callback.answer("✅ Заказ получен")
 
 
@@ -3154,50 +6271,27 @@ async def callback_production_started(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order = await run_db(get_order_status, order_id)
 
-    if not order_data:
+    if not order:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
     # Получаем категорию заказа и проверяем права
-    order_category = order_data.get("category")
+    order_category = order.category
 
     if not has_permission(user_id, AdminRole.PRODUCTION, order_category):
         category_name = get_category_name(order_category) if order_category else "этого заказа"
         await callback.answer(f"У вас нет прав для обработки заказов категории {category_name}", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.PRODUCTION_STARTED, updated_by=user_id)
+    # Обновляем статус (только если его никто не обновил раньше)
+    if not await run_db(update_order_status, order_id, OrderStatus.PRODUCTION_STARTED, updated_by=user_id):
+        await answer_transition_lost(callback, order_id)
+        return
 
     # Уведомляем клиента через группированное сообщение
-    client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
-
-    # Получаем информацию об админе
-    admin_name = get_admin_name(user_id)
-    admin_info = f"{admin_name} (ID: {user_id})"
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    # Обновляем caption
-    original_caption = callback.message.caption
-    original_caption = re.sub(r'\n📊 Статус:.*?\n━━━━━━━━━━━━━━━━━━━━━━', '', original_caption)
-
-    # Извлекаем всю историю
-    history_section = re.search(r'━━━━━━━━━━━━━━━━━━━━━━\n(.*)', original_caption, re.DOTALL)
-    history_text = history_section.group(1) if history_section else ""
-
-    new_caption = (
-            original_caption.split("━━━━━━━━━━━━━━━━━━━━━━")[0] +
-            f"\n📊 Статус: 🏭 Производство начато\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"{history_text}\n"
-            f"🏭 Производство начато: {admin_info}\n"
-            f"   Время: {current_time}"
-    )
+    await notify_client_after_transition(order)
 
     # Новые кнопки
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -3207,10 +6301,7 @@ async def callback_production_started(callback: CallbackQuery):
         )]
     ])
 
-    await callback.message.edit_caption(
-        caption=new_caption,
-        reply_markup=kb
-    )
+    await refresh_admin_message(callback, order_id, kb)
     await callback.answer("✅ Производство начато")
 
 
@@ -3220,50 +6311,27 @@ async def callback_sent_to_warehouse(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order = await run_db(get_order_status, order_id)
 
-    if not order_data:
+    if not order:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
     # Получаем категорию заказа и проверяем права
-    order_category = order_data.get("category")
+    order_category = order.category
 
     if not has_permission(user_id, AdminRole.PRODUCTION, order_category):
         category_name = get_category_name(order_category) if order_category else "этого заказа"
         await callback.answer(f"У вас нет прав для обработки заказов категории {category_name}", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.SENT_TO_WAREHOUSE, updated_by=user_id)
+    # Обновляем статус (только если его никто не обновил раньше)
+    if not await run_db(update_order_status, order_id, OrderStatus.SENT_TO_WAREHOUSE, updated_by=user_id):
+        await answer_transition_lost(callback, order_id)
+        return
 
     # Уведомляем клиента через группированное сообщение
-    client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
-
-    # Получаем информацию об админе
-    admin_name = get_admin_name(user_id)
-    admin_info = f"{admin_name} (ID: {user_id})"
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    # Обновляем caption
-    original_caption = callback.message.caption
-    original_caption = re.sub(r'\n📊 Статус:.*?\n━━━━━━━━━━━━━━━━━━━━━━', '', original_caption)
-
-    # Извлекаем всю историю
-    history_section = re.search(r'━━━━━━━━━━━━━━━━━━━━━━\n(.*)', original_caption, re.DOTALL)
-    history_text = history_section.group(1) if history_section else ""
-
-    new_caption = (
-            original_caption.split("━━━━━━━━━━━━━━━━━━━━━━")[0] +
-            f"\n📊 Статус: 📦 Передано на склад\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"{history_text}\n"
-            f"📦 Передано на склад: {admin_info}\n"
-            f"   Время: {current_time}"
-    )
+    await notify_client_after_transition(order)
 
     # Новые кнопки для склада
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -3273,10 +6341,7 @@ async def callback_sent_to_warehouse(callback: CallbackQuery):
         )]
     ])
 
-    await callback.message.edit_caption(
-        caption=new_caption,
-        reply_markup=kb
-    )
+    await refresh_admin_message(callback, order_id, kb)
     await callback.answer("✅ Передано на склад")
 
 
@@ -3290,55 +6355,21 @@ async def callback_warehouse_received(callback: CallbackQuery):
         return
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order = await run_db(get_order_status, order_id)
 
-    if not order_data:
+    if not order:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.WAREHOUSE_RECEIVED, updated_by=user_id)
-
-    # Уведомляем клиента
-    client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    category = order_data.get("category")
-
-    # НОВОЕ: Отправляем отдельное уведомление о готовности этой категории
-    if category:
-        await send_category_completion_notification(order_id, category, client_user_id, lang)
-
-    # Обновляем группированное сообщение со всеми категориями
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
-
-    # Получаем информацию об админе
-    admin_name = get_admin_name(user_id)
-    admin_info = f"{admin_name} (ID: {user_id})"
-    current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    # Обновляем caption - финальный статус
-    original_caption = callback.message.caption
-    original_caption = re.sub(r'\n📊 Статус:.*?\n━━━━━━━━━━━━━━━━━━━━━━', '', original_caption)
-
-    # Извлекаем всю историю
-    history_section = re.search(r'━━━━━━━━━━━━━━━━━━━━━━\n(.*)', original_caption, re.DOTALL)
-    history_text = history_section.group(1) if history_section else ""
+    # Обновляем статус (только если его никто не обновил раньше)
+    if not await run_db(update_order_status, order_id, OrderStatus.WAREHOUSE_RECEIVED, updated_by=user_id):
+        await answer_transition_lost(callback, order_id)
+        return
 
-    new_caption = (
-            original_caption.split("━━━━━━━━━━━━━━━━━━━━━━")[0] +
-            f"\n📊 Статус: ✅ Получено складом (ГОТОВО)\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"{history_text}\n"
-            f"✅ Получено складом: {admin_info}\n"
-            f"   Время: {current_time}\n\n"
-            f"🎉 Заказ полностью выполнен!"
-    )
+    # Уведомляем клиента о готовности категории и обновляем сводку
+    await notify_client_after_transition(order, completed_category=order.category)
 
-    await callback.message.edit_caption(
-        caption=new_caption,
-        reply_markup=None
-    )
+    await refresh_admin_message(callback, order_id, None)
     await callback.answer("✅ Партия получена")
 
 
@@ -3414,12 +6445,12 @@ async def cmd_send(message: Message):
 
 
 @router.message(OrderSign.waiting_name)
-async def order_signature_handler(message: Message, state: FSMContext):
+async def order_signature_handler(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка подписи заказа"""
     try:
-        lang = get_user_lang(message.from_user.id)
+        lang = user_ctx.lang
         sign_name = message.text.strip()
-        profile_name = get_user_full_name(message.from_user.id)
+        profile_name = user_ctx.full_name
 
         if not sign_name:
             if lang == "ru":
@@ -3465,11 +6496,26 @@ async def order_signature_handler(message: Message, state: FSMContext):
             await state.clear()
             return
 
+        # Цены — из той версии каталога, по которой строился предпросмотр
+        catalog_version = order_data.get("catalog_version")
+        catalog = product_catalog.get_version(catalog_version) if catalog_version else None
+        if not catalog:
+            logger.warning(f"⚠️ Catalog version {catalog_version} is gone, user {message.from_user.id} must re-order")
+            if lang == "ru":
+                await message.answer("⚠️ Каталог обновился, цены могли измениться. Пожалуйста, оформите заказ заново.")
+            else:
+                await message.answer("⚠️ Katalog yangilandi, narxlar o'zgargan bo'lishi mumkin. Iltimos, buyurtmani qaytadan bering.")
+            await state.clear()
+            return
+        items, total = enrich_cart_items(catalog.products, order_data["items"])
+        order_data = {"items": items, "total": total}
+
         # Генерируем базовый ID заказа (без суффикса)
-        base_order_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}{message.from_user.id % 10000:04d}"
+        order_created_at = datetime.now().replace(microsecond=0)
+        base_order_id = f"{order_created_at.strftime('%Y%m%d%H%M%S')}{message.from_user.id % 10000:04d}"
 
         # Получаем координаты клиента
-        client_profile = get_user_profile(message.from_user.id)
+        client_profile = user_ctx.profile
         client_latitude = client_profile.get("latitude") if client_profile else None
         client_longitude = client_profile.get("longitude") if client_profile else None
 
@@ -3477,6 +6523,27 @@ async def order_signature_handler(message: Message, state: FSMContext):
         grouped_items = group_items_by_category(order_data["items"])
         num_categories = len(grouped_items)
 
+        # Части заказа: одна на категорию
+        parts = []
+        for part_num, (category, category_items) in enumerate(sorted(grouped_items.items()), start=1):
+            parts.append({
+                "order_id": f"{base_order_id}_{part_num}",
+                "category": category,
+                "total": sum(item.get("qty", 0) * item.get("price", 0) for item in category_items),
+                "items": category_items,
+            })
+
+        # Сохраняем все части одной транзакцией ДО рендера PDF и загрузок
+        await run_db(
+            save_order_bundle,
+            base_order_id=base_order_id,
+            client_name=final_name,
+            user_id=message.from_user.id,
+            parts=parts,
+            created_at=order_created_at,
+            catalog_version=catalog.version
+        )
+
         # Регистрируем заказ
         rate_limiter.register_order(message.from_user.id)
 
@@ -3504,82 +6571,44 @@ async def order_signature_handler(message: Message, state: FSMContext):
 
         await message.answer(user_text)
 
-        # Отправляем в админ-чат (группу) - отдельные PDF для каждой категории
-        profile = get_user_profile(message.from_user.id)
-
-        # Формируем строку с координатами
-        location_text = ""
-        if client_latitude is not None and client_longitude is not None:
-            location_text = f"📍 Координаты: {client_latitude:.6f}, {client_longitude:.6f}\n"
-
-        # Создаем и отправляем PDF для каждой категории
-        part_num = 1
-        for category, category_items in sorted(grouped_items.items()):
-            # Формируем подномер заказа
-            sub_order_id = f"{base_order_id}_{part_num}"
-
-            # Вычисляем сумму для этой категории
-            category_total = sum(item.get("qty", 0) * item.get("price", 0) for item in category_items)
+        # Отправляем в админ-чат (группу) - отдельные PDF для каждой категории;
+        # заказ уже сохранён, ошибка одной части не влияет на остальные
+        for part in parts:
+            sub_order_id = part["order_id"]
+            category = part["category"]
+            category_name = get_category_name(category)
 
-            # Генерируем PDF для этой категории
-            
-            sub_preloaded = await preload_order_images(category_items)
-            
-            pdf_category = await asyncio.to_thread(
-                generate_order_pdf,
-                order_items=category_items,
-                total=category_total,
-                client_name=final_name,
-                admin_name=ADMIN_NAME,
-                order_id=sub_order_id,
-                approved=True,
-                category=category,
-                latitude=client_latitude,
-                longitude=client_longitude,
-                preloaded_images=sub_preloaded
-            )
-            # Сохраняем в БД
-            save_order(
-                order_id=sub_order_id,
-                client_name=final_name,
-                user_id=message.from_user.id,
-                total=category_total,
-                pdf_draft=pdf_category,
-                order_json={"items": category_items, "total": category_total},
-                category=category,
-                base_order_id=base_order_id
-            )
+            try:
+                sub_preloaded = await preload_order_images(part["items"])
+
+                pdf_category = await asyncio.to_thread(
+                    generate_order_pdf,
+                    order_items=part["items"],
+                    total=part["total"],
+                    client_name=final_name,
+                    admin_name=ADMIN_NAME,
+                    order_id=sub_order_id,
+                    approved=True,
+                    category=category,
+                    latitude=client_latitude,
+                    longitude=client_longitude,
+                    preloaded_images=sub_preloaded
+                )
+                await run_db(attach_order_draft_pdf, sub_order_id, pdf_category)
 
-            # Загружаем на хостинг
-            await upload_pdf_to_hosting_async(sub_order_id, pdf_category)
+                # Загружаем на хостинг
+                await upload_pdf_to_hosting_async(sub_order_id, pdf_category)
 
-            # Формируем текст для админов
-            category_name = get_category_name(category)
-            admin_text = (
-                f"🆕 Новый заказ №{sub_order_id}\n"
-                f"📋 Часть {part_num} из {num_categories} (Базовый номер: {base_order_id})\n\n"
-                f"👤 Клиент: {final_name}\n"
-                f"👤 User ID: {message.from_user.id}\n"
-                f"📱 Телефон: {profile.get('phone', 'Не указан')}\n"
-                f"🏙 Город: {profile.get('city', 'Не указан')}\n"
-                f"{location_text}"
-                f"🏭 Категория: {category_name}\n"
-                f"💰 Сумма (этой категории): {format_currency(category_total)}\n"
-                f"💰 Общая сумма заказа: {format_currency(order_data['total'])}\n"
-                f"📦 Товаров (в этой категории): {len(category_items)}\n"
-                f"📦 Товаров (всего в заказе): {len(order_data['items'])}\n\n"
-                f"📊 Статус: ⏳ Ожидает одобрения\n"
-                f"━━━━━━━━━━━━━━━━━━━━━━"
-            )
+                # Текст для админов собирается из сохранённых строк
+                admin_text = await run_db(build_admin_caption, sub_order_id)
 
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve:{sub_order_id}"),
-                    InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject:{sub_order_id}")
-                ]
-            ])
+                kb = InlineKeyboardMarkup(inline_keyboard=[
+                    [
+                        InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve:{sub_order_id}"),
+                        InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject:{sub_order_id}")
+                    ]
+                ])
 
-            try:
                 pdf_file = BufferedInputFile(pdf_category, filename=f"order_{sub_order_id}.pdf")
                 await bot.send_document(
                     chat_id=ADMIN_CHAT_ID,
@@ -3591,13 +6620,11 @@ async def order_signature_handler(message: Message, state: FSMContext):
             except Exception as e:
                 logger.exception(f"Failed to send order part {sub_order_id} to admin chat {ADMIN_CHAT_ID}")
 
-            part_num += 1
-
         await state.clear()
 
     except Exception as e:
         logger.exception(f"Error in order signature handler")
-        lang = get_user_lang(message.from_user.id)
+        lang = user_ctx.lang
         if lang == "ru":
             await message.answer("❌ Произошла ошибка при обработке заказа. Попробуйте позже.")
         else:
@@ -3611,33 +6638,48 @@ async def cmd_orders_export(message: Message):
     if message.from_user.id != SUPER_ADMIN_ID:
         return
 
-    orders = get_all_orders(limit=10000)
-
-    if not orders:
-        await message.answer("В базе нет заказов.")
+    try:
+        filters = parse_export_filters(message.text.split()[1:])
+    except ValidationError as e:
+        await message.answer(
+            f"❌ {e}\n\n"
+            "Использование: /orders_export [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [статус]\n"
+            f"Статусы: {', '.join(ORDER_STATUS_TRANSITIONS)}"
+        )
         return
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-    writer.writerow(["order_id", "client_name", "user_id", "total", "created_at", "status"])
+    await message.answer("⏳ Формирую экспорт заказов...")
 
-    for o in orders:
-        writer.writerow([
-            o["order_id"],
-            o["client_name"],
-            o["user_id"],
-            o["total"],
-            o["created_at"],
-            o["status"] or "",
-        ])
+    try:
+        parts = await run_db(export_orders_to_files, **filters)
+    except Exception:
+        logger.exception("Orders export failed")
+        await message.answer("❌ Не удалось сформировать экспорт.")
+        return
+
+    if not parts:
+        await message.answer("В базе нет заказов.")
+        return
 
-    csv_bytes = output.getvalue().encode("utf-8-sig")
-    output.close()
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    total_rows = sum(part["rows"] for part in parts)
 
-    filename = f"orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    file = BufferedInputFile(csv_bytes, filename=filename)
+    try:
+        for index, part in enumerate(parts, start=1):
+            suffix = f"_part{index}" if len(parts) > 1 else ""
+            file = FSInputFile(part["path"], filename=f"orders_export_{stamp}{suffix}.csv.gz")
+            await message.answer_document(
+                document=file,
+                caption=f"Экспорт заказов (CSV, gzip) — часть {index}/{len(parts)}, строк: {part['rows']}"
+            )
+    finally:
+        for part in parts:
+            try:
+                os.remove(part["path"])
+            except OSError:
+                pass
 
-    await message.answer_document(document=file, caption="Экспорт заказов (CSV)")
+    logger.info(f"Orders export sent: {total_rows} rows in {len(parts)} file(s)")
 
 
 @router.message(Command("users_stats"))
@@ -3646,18 +6688,304 @@ async def cmd_users_stats(message: Message):
     if message.from_user.id != SUPER_ADMIN_ID:
         return
     
-    stats = get_users_stats()
-    
+    stats = await run_db(get_users_stats)
+    dealers = count_dealer_statuses()
+
+    windows = " / ".join(f"{days}д" for days in USER_STATS_WINDOWS)
+    active = " / ".join(str(stats[f"active_{days}d"]) for days in USER_STATS_WINDOWS)
+    new = " / ".join(str(stats[f"new_{days}d"]) for days in USER_STATS_WINDOWS)
+
     text = (
         "📊 Статистика пользователей:\n\n"
         f"👥 Всего пользователей: {stats['total']}\n"
-        f"🟢 Активных (30 дней): {stats['active_30d']}\n"
-        f"✨ Новых (7 дней): {stats['new_7d']}\n"
+        f"🟢 Активных ({windows}): {active}\n"
+        f"✨ Новых ({windows}): {new}\n"
+        f"🤝 Дилеры (проверенные): активных {dealers['active']}, заблокированных {dealers['inactive']}\n"
     )
+
+    if stats["by_language"]:
+        text += "\n🌐 По языкам:\n"
+        for language, count in stats["by_language"]:
+            text += f"• {language or '—'}: {count}\n"
+
+    if stats["by_city"]:
+        text += "\n🏙 По городам (топ-10):\n"
+        for city, count in stats["by_city"][:10]:
+            text += f"• {city or '—'}: {count}\n"
+
+    if stats["refreshed_at"]:
+        text += f"\n🕒 Обновлено: {stats['refreshed_at'].strftime('%d.%m.%Y %H:%M')}"
     
     await message.answer(text)
 
 
+@router.message(Command("top_products"))
+async def cmd_top_products(message: Message):
+    """Топ товаров за период по order_items (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    args = message.text.split()
+    days = int(args[1]) if len(args) > 1 and args[1].isdigit() else 7
+
+    rows = await run_db(get_top_products, days)
+    if not rows:
+        await message.answer(f"За {days} дн. заказов нет.")
+        return
+
+    text = f"🏆 Топ товаров за {days} дн.:\n\n"
+    for index, row in enumerate(rows, start=1):
+        text += (
+            f"{index}. {row['name']} (ID: {row['product_id']})\n"
+            f"   📦 {row['qty']} шт. | 💰 {format_currency(row['amount'])} | 📐 {float(row['cube'] or 0):.3f} м³\n"
+        )
+
+    await message.answer(text)
+
+
+@router.message(Command("query_stats"))
+async def cmd_query_stats(message: Message):
+    """Статистика SQL-запросов по именам (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    stats = query_stats.snapshot()
+    if not stats:
+        await message.answer("Запросов ещё не было.")
+        return
+
+    top = sorted(stats.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:15]
+    text = f"🐢 SQL-запросы (медленных ≥ {query_stats.slow_ms:.0f} мс: {query_stats.slow_queries})\n\n"
+    for name, entry in top:
+        avg = entry["total_ms"] / entry["count"] if entry["count"] else 0.0
+        text += (
+            f"• {name}: {entry['count']} шт., всего {entry['total_ms']:.0f} мс\n"
+            f"   сред. {avg:.1f} | p95 ≤ {query_stats.percentile(name, 0.95):.0f} | макс. {entry['max_ms']:.0f} мс\n"
+            f"   строк {entry['rows']}, ~{entry['bytes'] / 1024:.0f} КБ"
+            + (f", ошибок {entry['errors']}" if entry["errors"] else "") + "\n"
+        )
+
+    await message.answer(text)
+
+
+@router.message(Command("catalog_stats"))
+async def cmd_catalog_stats(message: Message):
+    """Состояние кеша каталога товаров (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    c = product_catalog.get_metrics()
+    age = f"{c['age'] / 60:.1f} мин" if c["age"] is not None else "не загружен"
+    last = f"{c['last_refresh_ms']:.0f} мс" if c["last_refresh_ms"] is not None else "—"
+    text = (
+        "📦 Каталог товаров:\n\n"
+        f"🧾 Товаров: {c['products']} (источник: {c['source']})\n"
+        f"🔖 Версия: {c['version'] or '—'} (в памяти {c['versions']})\n"
+        f"🕒 Возраст: {age} (лимит {c['max_staleness'] // 60} мин)\n"
+        f"🔄 Обновлений: {c['refreshes']} (без изменений: {c['unchanged']}) | ❌ Ошибок: {c['failures']}\n"
+        f"🤝 Ожиданий общей загрузки: {c['shared']} | ⏸ Пропущено из-за паузы: {c['negative_hits']}\n"
+        f"⏱ Последняя загрузка: {last}\n"
+    )
+    if c["last_error"]:
+        text += f"⚠️ Последняя ошибка: {c['last_error']}\n"
+    if c["backoff"]:
+        text += f"⏸ Пауза после ошибки: {c['backoff']:.0f} с\n"
+    if c["degraded"]:
+        text += f"🟠 Деградированный режим: работаем на последнем удачном каталоге (отдано {c['degraded_hits']} раз сверх лимита)\n"
+
+    await message.answer(text)
+
+
+PRODUCT_SEARCH_LIMIT = 20
+
+
+def _product_line(product_id: int, product: Dict) -> str:
+    category = product.get("category")
+    return (
+        f"• {product_id} {product.get('name', 'Без названия')} — "
+        f"{format_currency(_product_price(product))}"
+        + (f" ({get_category_name(category)})" if category in CATEGORY_NAMES else "")
+    )
+
+
+@router.message(Command("product"))
+async def cmd_product(message: Message):
+    """Поиск товара: /product <ID | ID-ID | слова названия> (только админы)"""
+    if message.from_user.id not in ALL_ADMIN_IDS:
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Использование: /product <ID | ID-ID | название>")
+        return
+
+    catalog = await product_catalog.current()
+    if not catalog:
+        await message.answer("❌ Каталог не загружен.")
+        return
+
+    query = args[1].strip()
+    range_match = re.fullmatch(r"(\d+)\s*-\s*(\d+)", query)
+    if range_match:
+        start, end = int(range_match.group(1)), int(range_match.group(2))
+        product_ids = catalog.index.ids_in_range(start, end + 1)
+    elif query.isdigit():
+        product_ids = [int(query)] if int(query) in catalog.products else []
+    else:
+        product_ids = catalog.index.search(query, limit=len(catalog.products))
+
+    if not product_ids:
+        await message.answer("Ничего не найдено.")
+        return
+
+    text = f"🔎 Найдено: {len(product_ids)} (каталог {catalog.version})\n\n"
+    text += "\n".join(_product_line(pid, catalog.products[pid]) for pid in product_ids[:PRODUCT_SEARCH_LIMIT])
+    if len(product_ids) > PRODUCT_SEARCH_LIMIT:
+        text += f"\n… и ещё {len(product_ids) - PRODUCT_SEARCH_LIMIT}"
+    await message.answer(text)
+
+
+async def _can_search_catalog(user_ctx: UserContext) -> bool:
+    """Каталог с ценами — только админам и зарегистрированным активным дилерам"""
+    if user_ctx.user_id in ALL_ADMIN_IDS:
+        return True
+    if not (user_ctx.exists and user_ctx.is_registered):
+        return False
+    # Ещё не проверенный дилер проверяется сейчас (с кешем), а не считается активным
+    status = user_ctx.dealer_status or await check_dealer_status(user_ctx.user_id, user_ctx.phone)
+    return bool(status.get("is_active"))
+
+
+@router.inline_query()
+async def inline_product_search(query: InlineQuery, user_ctx: UserContext):
+    """Inline-поиск товаров: @бот <название или ID>"""
+    if not await _can_search_catalog(user_ctx):
+        await query.answer([], cache_time=60, is_personal=True)
+        return
+
+    catalog = product_catalog.version
+    text = query.query.strip()
+    if not catalog or not text:
+        await query.answer([], cache_time=5, is_personal=True)
+        return
+
+    results = []
+    for product_id in catalog.index.search(text, limit=PRODUCT_SEARCH_LIMIT):
+        product = catalog.products[product_id]
+        name = product.get("name", "Без названия")
+        price = format_currency(_product_price(product))
+        image = product.get("image", "")
+        results.append(InlineQueryResultArticle(
+            id=str(product_id),
+            title=name,
+            description=f"{price} • ID {product_id}",
+            thumbnail_url=image if image.startswith("https://") else None,
+            input_message_content=InputTextMessageContent(message_text=f"{name}\nID: {product_id}\n{price}"),
+        ))
+
+    # is_personal: результаты доступны не всем, Telegram не должен отдавать их из общего кеша
+    await query.answer(results, cache_time=60, is_personal=True)
+
+
+@router.message(Command("catalog_diff"))
+async def cmd_catalog_diff(message: Message):
+    """Изменения между версиями каталога (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    versions = list(product_catalog.versions)
+    args = message.text.split()[1:]
+    if args:
+        old = product_catalog.get_version(args[0])
+        new = product_catalog.get_version(args[1]) if len(args) > 1 else product_catalog.version
+    else:
+        old = versions[-2] if len(versions) > 1 else None
+        new = product_catalog.version
+
+    if not old or not new:
+        known = ", ".join(f"{v.version} ({v.loaded_at:%d.%m %H:%M})" for v in versions) or "нет"
+        await message.answer(f"Нет двух версий для сравнения.\nВ памяти: {known}")
+        return
+
+    diff = diff_catalog_versions(old, new)
+    text = (
+        f"🔖 Каталог {old.version} → {new.version}\n\n"
+        f"➕ Добавлено: {len(diff['added'])}\n"
+        f"➖ Удалено: {len(diff['removed'])}\n"
+        f"💱 Изменились цены: {len(diff['price_changes'])}\n"
+    )
+    for product_id, old_price, new_price in diff["price_changes"][:20]:
+        name = new.products[product_id].get("name", "")
+        text += f"• {product_id} {name}: {format_currency(old_price)} → {format_currency(new_price)}\n"
+    if len(diff["price_changes"]) > 20:
+        text += f"… и ещё {len(diff['price_changes']) - 20}\n"
+    if diff["added"]:
+        text += f"\n➕ {', '.join(map(str, diff['added'][:30]))}\n"
+    if diff["removed"]:
+        text += f"➖ {', '.join(map(str, diff['removed'][:30]))}\n"
+
+    await message.answer(text)
+
+
+@router.message(Command("http_stats"))
+async def cmd_http_stats(message: Message):
+    """Исходящие HTTP-запросы по хостам (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    hosts = http_client.get_metrics()
+    if not hosts:
+        await message.answer("HTTP-запросов ещё не было.")
+        return
+
+    text = "🌐 Исходящие HTTP-запросы:\n\n"
+    for host, h in sorted(hosts.items(), key=lambda item: item[1]["requests"], reverse=True):
+        avg = h["total_ms"] / h["requests"] if h["requests"] else 0.0
+        text += (
+            f"• {host}: {h['requests']} шт., сред. {avg:.0f} мс, макс. {h['max_ms']:.0f} мс\n"
+            f"   ошибок {h['errors']}, повторов {h['retries']}\n"
+        )
+
+    await message.answer(text)
+
+
+@router.message(Command("db_stats"))
+async def cmd_db_stats(message: Message):
+    """Метрики пула соединений MySQL (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    m = db_pool.get_metrics()
+
+    text = (
+        "🗄 Пул соединений MySQL:\n\n"
+        f"🔌 Открыто: {m['size']} / {m['max_size']}\n"
+        f"🟢 Занято: {m['in_use']}\n"
+        f"⚪ Свободно: {m['idle']}\n"
+        f"⏳ В очереди: {m['waiting']}\n\n"
+        f"📥 Выдано соединений: {m['checkouts']}\n"
+        f"❌ Ошибок выдачи: {m['checkout_failures']}\n"
+        f"⏱ Ожидание: среднее {m['avg_wait_ms']:.1f} мс, максимум {m['max_wait_ms']:.1f} мс\n"
+        f"♻️ Создано: {m['created']} | Пересоздано: {m['recycled']} | Сломано: {m['broken']}\n"
+    )
+
+    if replica_router:
+        r = replica_router.get_metrics()
+        rm = replica_router.pool.get_metrics()
+        lag = f"{r['lag']:.0f} с" if r['lag'] is not None else "нет данных"
+        text += (
+            f"\n🪞 Реплика: {'🟢 используется' if r['healthy'] else '🔴 отключена'}\n"
+            f"⏱ Отставание: {lag} (допустимо {r['max_lag']} с)\n"
+            f"🔌 Открыто: {rm['size']} / {rm['max_size']} | Занято: {rm['in_use']}\n"
+            f"🔍 Проверок: {r['lag_checks']} | Ошибок: {r['lag_check_failures']}\n"
+        )
+        text += "\n🧭 Маршруты (маршрут → база: запросов):\n"
+        for (route, target), count in sorted(r["routed"].items()):
+            text += f"• {route} → {target}: {count}\n"
+
+    await message.answer(text)
+
+
 @router.message(Command("sendall"))
 async def cmd_sendall(message: Message):
     """Массовая рассылка (только супер-админ)"""
@@ -3685,7 +7013,7 @@ async def cmd_sendall(message: Message):
         )
         return
 
-    user_ids = get_all_user_ids()
+    user_ids = await run_db(get_all_user_ids)
     if not user_ids:
         await message.answer("Нет пользователей.")
         return
@@ -3729,10 +7057,10 @@ async def cmd_sendall(message: Message):
 
 
 @router.message(Command("get_pdf"))
-async def cmd_get_pdf(message: Message):
+async def cmd_get_pdf(message: Message, user_ctx: UserContext):
     """Получить PDF заказа"""
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
 
     args = message.text.split()
     if len(args) < 2:
@@ -3746,18 +7074,20 @@ async def cmd_get_pdf(message: Message):
 
     # Админы могут получать любые заказы
     if user_id in ALL_ADMIN_IDS:
-        record = get_order_raw(order_id)
+        pdf_ref = await run_db(get_order_pdf_ref, order_id)
     else:
-        record = get_order_for_user(order_id, user_id)
+        pdf_ref = await run_db(get_order_pdf_ref, order_id, user_id)
 
-    if not record:
+    if not pdf_ref:
         if lang == "ru":
             await message.answer("Заказ не найден.")
         else:
             await message.answer("Buyurtma topilmadi.")
         return
 
-    pdf_bytes = record.get("pdf_final") or record.get("pdf_draft")
+    # PDF загружается только здесь, по ссылке из заказа
+    pdf_sha = pdf_ref.get("pdf_final_sha") or pdf_ref.get("pdf_draft_sha")
+    pdf_bytes = await run_db(get_blob, pdf_sha) if pdf_sha else None
     if not pdf_bytes:
         if lang == "ru":
             await message.answer("PDF не доступен.")
@@ -3775,8 +7105,201 @@ async def cmd_get_pdf(message: Message):
     await message.answer_document(document=pdf_file, caption=caption)
 
 
+# ==================== БЕНЧМАРК ХРАНИЛИЩА ====================
+
+def run_storage_benchmark(orders: int = 200) -> Dict[str, Dict[str, float]]:
+    """Прогон конвейера заказа на текущем бэкенде (DB_BACKEND).
+
+    Запуск: python main.py --benchmark [заказов]. Пишет синтетические
+    заказы и пользователей — используйте отдельную базу (для SQLite —
+    отдельный SQLITE_PATH). Результат одинаков по форме для MySQL и SQLite.
+    """
+    init_db()
+
+    timings: Dict[str, List[float]] = defaultdict(list)
+
+    def timed(name: str, func: Callable[..., Any], *args, **kwargs):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[name].append((time.perf_counter() - started) * 1000)
+        return result
+
+    run_id = datetime.now().strftime("%H%M%S")
+    categories = sorted(CATEGORY_NAMES)[:2] or [None]
+    pdf_stub = b"%PDF-1.4 benchmark"
+
+    for i in range(orders):
+        user_id = 9_000_000_000 + i % 50
+        base_order_id = f"bench{run_id}{i:06d}"
+        timed("add_user", add_user, user_id, f"bench{i}", "Bench", "User")
+
+        parts = []
+        for part_num, category in enumerate(categories, start=1):
+            items = [
+                {"id": 1000 + n, "name": f"Товар {n}", "qty": n + 1, "price": 10000,
+                 "weight": 1.5, "cube": 0.01, "category": category}
+                for n in range(3)
+            ]
+            parts.append({
+                "order_id": f"{base_order_id}_{part_num}",
+                "category": category,
+                "total": sum(item["qty"] * item["price"] for item in items),
+                "items": items,
+            })
+
+        timed("save_order_bundle", save_order_bundle, base_order_id, "Bench User", user_id, parts)
+        for part in parts:
+            timed("attach_order_draft_pdf", attach_order_draft_pdf, part["order_id"], pdf_stub)
+            timed("update_order_status", update_order_status, part["order_id"], OrderStatus.APPROVED, 1)
+            timed("build_admin_caption", build_admin_caption, part["order_id"])
+        timed("build_grouped_status_message", build_grouped_status_message, base_order_id)
+        timed("get_order_groups_page", get_order_groups_page, user_id)
+        activity_buffer.touch(user_id)
+
+    timed("activity_flush", activity_buffer.flush)
+    timed("refresh_users_stats_rollup", refresh_users_stats_rollup)
+
+    report = {}
+    for name, samples in timings.items():
+        samples.sort()
+        report[name] = {
+            "count": len(samples),
+            "avg_ms": sum(samples) / len(samples),
+            "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "total_ms": sum(samples),
+        }
+        logger.info(
+            f"⏱ {name}: n={len(samples)} avg={report[name]['avg_ms']:.2f} ms "
+            f"p95={report[name]['p95_ms']:.2f} ms total={report[name]['total_ms']:.0f} ms"
+        )
+    return report
+
+
+# ==================== ЭНДПОИНТ МЕТРИК ====================
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — эндпоинт выключен
+metrics_runner: Optional[web.AppRunner] = None
+
+
+def _metric_labels(**labels) -> str:
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_prometheus_metrics() -> str:
+    """Метрики пула и SQL-запросов в текстовом формате Prometheus"""
+    lines = []
+
+    lines.append("# TYPE bot_db_query_duration_seconds histogram")
+    for name, entry in sorted(query_stats.snapshot().items()):
+        cumulative = 0
+        for bound, count in zip(query_stats.buckets, entry["buckets"]):
+            cumulative += count
+            lines.append(f"bot_db_query_duration_seconds_bucket{_metric_labels(query=name, le=bound / 1000)} {cumulative}")
+        lines.append(f"bot_db_query_duration_seconds_bucket{_metric_labels(query=name, le='+Inf')} {entry['count']}")
+        lines.append(f"bot_db_query_duration_seconds_sum{_metric_labels(query=name)} {entry['total_ms'] / 1000:.6f}")
+        lines.append(f"bot_db_query_duration_seconds_count{_metric_labels(query=name)} {entry['count']}")
+
+    lines.append("# TYPE bot_db_query_rows_total counter")
+    lines.append("# TYPE bot_db_query_bytes_total counter")
+    lines.append("# TYPE bot_db_query_errors_total counter")
+    for name, entry in sorted(query_stats.snapshot().items()):
+        lines.append(f"bot_db_query_rows_total{_metric_labels(query=name)} {entry['rows']}")
+        lines.append(f"bot_db_query_bytes_total{_metric_labels(query=name)} {entry['bytes']}")
+        lines.append(f"bot_db_query_errors_total{_metric_labels(query=name)} {entry['errors']}")
+
+    lines.append("# TYPE bot_db_slow_queries_total counter")
+    lines.append(f"bot_db_slow_queries_total {query_stats.slow_queries}")
+
+    pools = [("primary", db_pool)]
+    if replica_router:
+        pools.append(("replica", replica_router.pool))
+    lines.append("# TYPE bot_db_pool_connections gauge")
+    lines.append("# TYPE bot_db_pool_checkouts_total counter")
+    for pool_name, pool in pools:
+        m = pool.get_metrics()
+        for state in ("size", "idle", "in_use", "waiting"):
+            lines.append(f"bot_db_pool_connections{_metric_labels(pool=pool_name, state=state)} {m[state]}")
+        lines.append(f"bot_db_pool_checkouts_total{_metric_labels(pool=pool_name)} {m['checkouts']}")
+
+    if replica_router:
+        r = replica_router.get_metrics()
+        lines.append("# TYPE bot_db_routed_queries_total counter")
+        for (route, target), count in sorted(r["routed"].items()):
+            lines.append(f"bot_db_routed_queries_total{_metric_labels(route=route, target=target)} {count}")
+        lines.append("# TYPE bot_db_replica_lag_seconds gauge")
+        lines.append(f"bot_db_replica_lag_seconds {r['lag'] if r['lag'] is not None else 'NaN'}")
+
+    c = product_catalog.get_metrics()
+    lines.append("# TYPE bot_catalog_products gauge")
+    lines.append(f"bot_catalog_products {c['products']}")
+    lines.append("# TYPE bot_catalog_age_seconds gauge")
+    lines.append(f"bot_catalog_age_seconds {c['age'] if c['age'] is not None else 'NaN'}")
+    lines.append("# TYPE bot_catalog_refresh_duration_seconds summary")
+    lines.append(f"bot_catalog_refresh_duration_seconds_sum {c['refresh_total_ms'] / 1000:.6f}")
+    lines.append(f"bot_catalog_refresh_duration_seconds_count {c['refreshes'] + c['failures']}")
+    lines.append("# TYPE bot_catalog_refreshes_total counter")
+    lines.append(f"bot_catalog_refreshes_total{_metric_labels(result='ok')} {c['refreshes']}")
+    lines.append(f"bot_catalog_refreshes_total{_metric_labels(result='error')} {c['failures']}")
+    lines.append(f"bot_catalog_refreshes_total{_metric_labels(result='shared')} {c['shared']}")
+    lines.append(f"bot_catalog_refreshes_total{_metric_labels(result='backoff')} {c['negative_hits']}")
+    lines.append(f"bot_catalog_refreshes_total{_metric_labels(result='unchanged')} {c['unchanged']}")
+    http_hosts = http_client.get_metrics()
+    lines.append("# TYPE bot_http_requests_total counter")
+    lines.append("# TYPE bot_http_errors_total counter")
+    lines.append("# TYPE bot_http_retries_total counter")
+    lines.append("# TYPE bot_http_request_duration_seconds summary")
+    for host, h in sorted(http_hosts.items()):
+        lines.append(f"bot_http_requests_total{_metric_labels(host=host)} {h['requests']}")
+        lines.append(f"bot_http_errors_total{_metric_labels(host=host)} {h['errors']}")
+        lines.append(f"bot_http_retries_total{_metric_labels(host=host)} {h['retries']}")
+        lines.append(f"bot_http_request_duration_seconds_sum{_metric_labels(host=host)} {h['total_ms'] / 1000:.6f}")
+        lines.append(f"bot_http_request_duration_seconds_count{_metric_labels(host=host)} {h['requests']}")
+
+    lines.append("# TYPE bot_catalog_degraded gauge")
+    lines.append(f"bot_catalog_degraded {int(c['degraded'])}")
+    lines.append("# TYPE bot_catalog_degraded_reads_total counter")
+    lines.append(f"bot_catalog_degraded_reads_total {c['degraded_hits']}")
+
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_prometheus_metrics(), content_type="text/plain")
+
+
+async def start_metrics_server():
+    """HTTP-эндпоинт /metrics для Prometheus (если задан METRICS_PORT)"""
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, "0.0.0.0", METRICS_PORT).start()
+    logger.info(f"✅ Metrics endpoint on :{METRICS_PORT}/metrics")
+
+
 # ==================== ЗАПУСК ====================
 
+# Фоновые задачи, которые нужно остановить при выключении
+background_tasks: List[asyncio.Task] = []
+
+
+async def run_periodic(name: str, interval: float, func: Callable[..., Any], *args):
+    """Периодически выполняет DB-функцию в фоне; ошибки не останавливают цикл"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_db(func, *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"❌ Periodic task {name} failed")
+
+
 async def on_startup(bot: Bot):
     """Действия при запуске"""
     logger.info("=" * 50)
@@ -3787,26 +7310,58 @@ async def on_startup(bot: Bot):
     logger.info(f"Production Admins: {PRODUCTION_ADMIN_IDS}")
     logger.info(f"Warehouse Admins: {WAREHOUSE_ADMIN_IDS}")
     logger.info(f"Rate limiting: ✅")
-    logger.info(f"Database: MySQL at {DB_CONFIG['host']}:{DB_CONFIG['port']}")
+    if DB_BACKEND == "sqlite":
+        logger.info(f"Database: SQLite (WAL) at {SQLITE_PATH} (pool {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+    else:
+        logger.info(f"Database: MySQL at {DB_CONFIG['host']}:{DB_CONFIG['port']} (pool {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+    if DB_REPLICA_CONFIG:
+        logger.info(f"Replica: MySQL at {DB_REPLICA_CONFIG['host']}:{DB_REPLICA_CONFIG['port']} (max lag {DB_REPLICA_MAX_LAG}s)")
     logger.info(f"Async FTP: {'✅' if AIOFTP_AVAILABLE else '⚠️  Fallback to sync'}")
     logger.info("=" * 50)
 
+    await http_client.start()
+
     try:
-        init_db()
+        await run_db(db_pool.warmup)
+        if replica_router:
+            await run_db(replica_router.pool.warmup)
+            await run_db(replica_router.refresh)
+        await run_db(init_db)
         logger.info("✅ Database initialized")
         
         # Миграция данных из локальных файлов в БД
-        migrate_users_from_files()
+        await run_db(migrate_users_from_files)
     except Exception as e:
         logger.exception(f"❌ Database init failed: {e}")
         raise
 
-    # ✅ Предзагружаем товары в кеш
-    try:
-        products = await fetch_products_from_sheets()
-        logger.info(f"✅ Pre-loaded {len(products)} products into cache")
-    except Exception as e:
-        logger.warning(f"⚠️ Failed to pre-load products: {e}")
+    # ✅ Каталог: со снимка на диске сразу, из Google Sheets — в фоне.
+    # Без снимка (первый запуск) ждём загрузку, как раньше.
+    from_snapshot = await asyncio.to_thread(product_catalog.load_snapshot)
+    if not from_snapshot:
+        if await product_catalog.refresh():
+            logger.info(f"✅ Pre-loaded {len(product_catalog.products)} products into cache")
+        else:
+            logger.warning("⚠️ Failed to pre-load products, background refresher will retry")
+    background_tasks.append(asyncio.create_task(
+        product_catalog.run_refresher(CATALOG_REFRESH_INTERVAL, CATALOG_REFRESH_JITTER, refresh_now=from_snapshot)
+    ))
+
+    background_tasks.append(asyncio.create_task(
+        run_periodic("activity_flush", ACTIVITY_FLUSH_INTERVAL, activity_buffer.flush)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodic("users_stats_rollup", USER_STATS_REFRESH_INTERVAL, refresh_users_stats_rollup)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodic("retention", RETENTION_INTERVAL, run_retention)
+    ))
+
+    if METRICS_PORT:
+        try:
+            await start_metrics_server()
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to start metrics endpoint: {e}")
 
 
 
@@ -3818,17 +7373,23 @@ async def on_shutdown(bot: Bot):
     except:
         pass
 
-async def background_cache_updater():
-    """Фоновое обновление кеша товаров"""
-    await asyncio.sleep(60)  # Подождать 1 минуту после старта
-    
-    while True:
-        try:
-            await asyncio.sleep(1800)  # 30 минут
-            products = await fetch_products_from_sheets()
-            logger.info(f"🔄 Background cache update: {len(products)} products")
-        except Exception as e:
-            logger.exception(f"❌ Background cache update failed: {e}")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+    # Дописываем накопленную активность до закрытия пула
+    await run_db(activity_buffer.flush)
+
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+    await http_client.close()
+
+    db_pool.close()
+    if replica_router:
+        replica_router.pool.close()
+    db_executor.shutdown(wait=False)
 
 async def main():
     """Главная функция"""
@@ -3847,6 +7408,22 @@ async def main():
 
 
 if __name__ == "__main__":
+    if "--explain-check" in sys.argv:
+        # Проверка планов горячих запросов без запуска бота
+        init_db()
+        passed = check_query_plans()
+        db_pool.close()
+        sys.exit(0 if passed else 1)
+
+    if "--benchmark" in sys.argv:
+        # Бенчмарк хранилища на текущем DB_BACKEND без запуска бота
+        position = sys.argv.index("--benchmark")
+        count = sys.argv[position + 1] if len(sys.argv) > position + 1 else ""
+        logger.info(f"Storage benchmark on {DB_BACKEND}")
+        run_storage_benchmark(int(count) if count.isdigit() else 200)
+        db_pool.close()
+        sys.exit(0)
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,173 @@
+"""Конвейер заказа на обоих бэкендах хранилища: сохранение, переход статуса,
+пагинация и экспорт.
+
+SQLite проверяется всегда (отдельный файл во временном каталоге). MySQL —
+только если заданы TEST_MYSQL_HOST / TEST_MYSQL_PORT / TEST_MYSQL_NAME /
+TEST_MYSQL_USER / TEST_MYSQL_PASS: тест пишет заказы в эту базу, поэтому
+указывайте отдельную тестовую базу, а не рабочую.
+"""
+import csv
+import gzip
+import importlib.util
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(REPO_ROOT, "main.py")
+
+BASE_ENV = {
+    "API_TOKEN": "123456:TEST",
+    "SUPER_ADMIN_ID": "1",
+    "ADMIN_CHAT_ID": "1",
+    "WEBAPP_URL": "https://example.invalid",
+    "HOSTING_FTP_HOST": "ftp.example.invalid",
+    "HOSTING_FTP_USER": "test",
+    "HOSTING_FTP_PASS": "test",
+    "GOOGLE_SHEETS_URL": "https://example.invalid/sheet",
+    # Реплика и эндпоинт метрик в тестах не нужны
+    "DB_REPLICA_HOST": "",
+    "METRICS_PORT": "0",
+}
+
+MYSQL_ENV_KEYS = ["HOST", "PORT", "NAME", "USER", "PASS"]
+
+
+def _backend_env(backend: str, tmp_dir) -> dict:
+    env = dict(BASE_ENV, DB_BACKEND=backend)
+    if backend == "sqlite":
+        env["SQLITE_PATH"] = str(tmp_dir / "orders.sqlite3")
+        return env
+
+    missing = [f"TEST_MYSQL_{key}" for key in MYSQL_ENV_KEYS if not os.getenv(f"TEST_MYSQL_{key}")]
+    if missing:
+        pytest.skip(f"MySQL backend not configured ({', '.join(missing)})")
+    for key in MYSQL_ENV_KEYS:
+        env[f"DB_{key}"] = os.environ[f"TEST_MYSQL_{key}"]
+    return env
+
+
+@pytest.fixture(scope="module", params=["sqlite", "mysql"])
+def bot(request, tmp_path_factory):
+    """Свежий экземпляр main.py, настроенный на выбранный бэкенд"""
+    env = _backend_env(request.param, tmp_path_factory.mktemp(request.param))
+    with pytest.MonkeyPatch.context() as mp:
+        for key, value in env.items():
+            mp.setenv(key, value)
+        mp.chdir(REPO_ROOT)  # шрифты PDF лежат рядом с main.py
+
+        spec = importlib.util.spec_from_file_location(f"bot_main_{request.param}", MAIN_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.init_db()
+        try:
+            yield module
+        finally:
+            module.db_pool.close()
+
+
+def _unique_user_id() -> int:
+    return random.randint(8_000_000_000, 8_999_999_999)
+
+
+def _make_parts(base_order_id: str, categories) -> list:
+    parts = []
+    for part_num, category in enumerate(categories, start=1):
+        items = [{"id": 1000 + n, "name": f"Товар {n}", "qty": n + 1, "price": 10000, "category": category}
+                 for n in range(2)]
+        parts.append({
+            "order_id": base_order_id if part_num == 1 else f"{base_order_id}-{part_num}",
+            "category": category,
+            "total": sum(item["qty"] * item["price"] for item in items),
+            "items": items,
+        })
+    return parts
+
+
+def test_save_bundle_and_status_cas(bot):
+    user_id = _unique_user_id()
+    base_order_id = f"t{uuid.uuid4().hex[:12]}"
+    created_at = datetime(2024, 5, 6, 7, 8, 9, 654321)
+    bot.save_order_bundle(base_order_id, "Test Client", user_id, _make_parts(base_order_id, ["a", "b"]),
+                          created_at=created_at)
+
+    parts = bot.get_orders_by_base_id(base_order_id)
+    assert [part.order_id for part in parts] == [base_order_id, f"{base_order_id}-2"]
+    # Все части — с общим created_at секундной точности
+    assert {part.created_at for part in parts} == {created_at.replace(microsecond=0)}
+
+    pdf = b"%PDF-1.4 final"
+    assert bot.update_order_status(base_order_id, bot.OrderStatus.APPROVED, 1, pdf) is True
+    # Повторный переход проигрывает и не меняет PDF
+    assert bot.update_order_status(base_order_id, bot.OrderStatus.APPROVED, 2, b"%PDF-1.4 other") is False
+
+    record = bot.get_order_status(base_order_id)
+    assert record.status == bot.OrderStatus.APPROVED
+    ref = bot.get_order_pdf_ref(base_order_id, user_id)
+    assert bot.get_blob(ref["pdf_final_sha"]) == pdf
+
+    # Недопустимый переход: pending -> production_started
+    assert bot.update_order_status(f"{base_order_id}-2", bot.OrderStatus.PRODUCTION_STARTED, 1) is False
+
+
+def test_paging_walks_same_second_orders_without_gaps(bot):
+    user_id = _unique_user_id()
+    # Все заказы в одну секунду, с разными долями — граница страницы внутри секунды
+    created_at = datetime(2024, 5, 6, 7, 8, 9)
+    expected = []
+    for n in range(7):
+        base_order_id = f"p{uuid.uuid4().hex[:12]}"
+        categories = ["a", "b"] if n % 2 else ["a"]
+        bot.save_order_bundle(base_order_id, "Test Client", user_id, _make_parts(base_order_id, categories),
+                              created_at=created_at + timedelta(microseconds=n * 100_000))
+        expected.append(base_order_id)
+
+    seen = []
+    pages = []
+    cursor = None
+    while True:
+        page = bot.get_order_groups_page(user_id, cursor, "next", page_size=2)
+        pages.append(page)
+        for group in page["groups"]:
+            assert len({part.root_order_id for part in group}) == 1
+            seen.append(group[0].root_order_id)
+        if not page["has_next"]:
+            break
+        cursor = bot.decode_order_cursor(page["next_cursor"])
+
+    assert sorted(seen) == sorted(expected)
+    assert len(seen) == len(set(seen))
+
+    # Назад от последней страницы — те же группы, что и на предпоследней
+    back = bot.get_order_groups_page(user_id, bot.decode_order_cursor(pages[-1]["prev_cursor"]), "prev", page_size=2)
+    assert [group[0].root_order_id for group in back["groups"]] == \
+           [group[0].root_order_id for group in pages[-2]["groups"]]
+
+
+def test_export_contains_saved_orders(bot):
+    user_id = _unique_user_id()
+    day = datetime(2001, 2, 3) + timedelta(days=random.randint(0, 3000))
+    ids = []
+    for n in range(3):
+        base_order_id = f"e{uuid.uuid4().hex[:12]}"
+        bot.save_order_bundle(base_order_id, "Export Client", user_id, _make_parts(base_order_id, ["a"]),
+                              created_at=day + timedelta(hours=n))
+        ids.append(base_order_id)
+
+    files = bot.export_orders_to_files(date_from=day, date_to=day + timedelta(days=1))
+    try:
+        rows = []
+        for file in files:
+            with gzip.open(file["path"], "rt", encoding="utf-8-sig", newline="") as handle:
+                reader = csv.reader(handle, delimiter=";")
+                assert next(reader) == bot.EXPORT_COLUMNS
+                rows.extend(reader)
+        exported = [row[0] for row in rows if row[3] == str(user_id)]
+        assert exported == ids
+        assert sum(file["rows"] for file in files) == len(rows)
+    finally:
+        for file in files:
+            os.remove(file["path"])